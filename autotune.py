@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import socket
+import struct
+import threading
+import time
+
+# 连接参数自动调整：每次传输开始后的几秒内测量吞吐量和往返时间，按带宽时延积设置收发缓冲区，
+# 按吞吐量设置每次读取的块大小。本机回环、千兆局域网和无线网络需要的参数相差很大，
+# 结果按对方地址记录在用户目录下，下次连接同一对方时直接使用。
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TUNING_PATH = os.path.join(os.path.expanduser("~"), ".file_transfer_tuning.json")
+
+DEFAULT_CHUNK_SIZE = 262144  # 没有测量结果时每块 256KB
+DEFAULT_SEND_BUFFER = 1048576  # 没有测量结果时发送缓冲区 1MB
+DEFAULT_RECV_BUFFER = 524288  # 没有测量结果时接收缓冲区 512KB
+MIN_CHUNK_SIZE = 65536
+MAX_CHUNK_SIZE = 4194304
+MIN_BUFFER = 262144
+MAX_BUFFER = 16777216
+CHUNK_TIME = 0.01  # 每块约为 10 毫秒的数据，慢速网络上进度和限速仍然平滑
+JITTER_TIME = 0.005  # 缓冲区至少容纳 5 毫秒的数据，线程调度的停顿不会让连接空闲
+PROBE_TIME = 2.0  # 传输开始后测量 2 秒
+PROBE_MIN_BYTES = 262144  # 测量期间传输的数据太少时不调整
+BUSY_FRACTION = 0.5  # 测量期间发送方阻塞在网络上的时间不足一半时，吞吐量受本机限制（读盘、计算），不调整
+
+
+def configure_socket(sock, send_buffer=None, recv_buffer=None):
+    """设置连接选项：关闭 Nagle 算法，按需设置收发缓冲区；设置失败时保持系统默认值"""
+    options = (
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer),
+        (socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer),
+    )
+    for level, option, value in options:
+        if value:
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError as e:
+                logger.warning(f"设置连接选项失败: {str(e)}")
+
+
+def measure_rtt(sock):
+    """读取内核统计的平滑往返时间（秒），只在 Linux 上可用，其他系统或读取失败时返回 None"""
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+        rtt = struct.unpack_from('I', info, 68)[0]  # struct tcp_info 的 tcpi_rtt，单位微秒
+    except (OSError, struct.error):
+        return None
+    return rtt / 1000000 if rtt else None
+
+
+def _clamp(value, low, high):
+    return max(low, min(high, int(value)))
+
+
+def _chunk_for(throughput):
+    """每块约为 CHUNK_TIME 秒的数据，取 2 的幂"""
+    size = _clamp(throughput * CHUNK_TIME, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE)
+    return 1 << (size.bit_length() - 1)
+
+
+def _buffer_for(throughput, rtt):
+    """两倍带宽时延积：测量时吞吐量可能受当前缓冲区限制，留出余量，下次测量会继续增大"""
+    return _clamp(max(2 * throughput * rtt, throughput * JITTER_TIME), MIN_BUFFER, MAX_BUFFER)
+
+
+class PeerTuning:
+    """与一个对方传输时使用的参数，发送和接收方向分别测量"""
+
+    def __init__(self, send_chunk=DEFAULT_CHUNK_SIZE, send_buffer=DEFAULT_SEND_BUFFER,
+                 recv_chunk=DEFAULT_CHUNK_SIZE, recv_buffer=DEFAULT_RECV_BUFFER,
+                 rtt=None, send_rate=None, recv_rate=None):
+        self.send_chunk = send_chunk  # 发送时每次读取文件的大小
+        self.send_buffer = send_buffer  # SO_SNDBUF
+        self.recv_chunk = recv_chunk  # 接收时每次读取连接的大小
+        self.recv_buffer = recv_buffer  # SO_RCVBUF
+        self.rtt = rtt  # 最近测得的往返时间（秒）
+        self.send_rate = send_rate  # 最近测得的发送吞吐量（字节/秒）
+        self.recv_rate = recv_rate  # 最近测得的接收吞吐量（字节/秒）
+
+    def update(self, sending, throughput, rtt):
+        """按测得的吞吐量和往返时间重新计算一个方向的参数"""
+        if rtt:
+            self.rtt = rtt
+        rtt = self.rtt or 0
+        if sending:
+            self.send_rate = throughput
+            self.send_chunk = _chunk_for(throughput)
+            self.send_buffer = _buffer_for(throughput, rtt)
+        else:
+            self.recv_rate = throughput
+            self.recv_chunk = _chunk_for(throughput)
+            self.recv_buffer = _buffer_for(throughput, rtt)
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, data):
+        tuning = cls()
+        for key in vars(tuning):
+            if key in data:
+                setattr(tuning, key, data[key])
+        return tuning
+
+
+class TuningStore:
+    """按对方地址记录的传输参数
+
+    保存在用户目录下的 JSON 文件中，文件无法读写时只在内存中保留，不影响传输。
+    """
+
+    def __init__(self, path=DEFAULT_TUNING_PATH, max_peers=256):
+        self.path = path
+        self.max_peers = max_peers  # 最多记录的对方数量，超过时丢弃最早记录的
+        self._lock = threading.Lock()
+        self._peers = {}  # 对方地址 -> PeerTuning
+        try:
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    for host, data in json.load(f).items():
+                        self._peers[host] = PeerTuning.from_dict(data)
+        except Exception as e:
+            logger.warning(f"读取传输参数失败，使用默认值: {str(e)}")
+
+    def get(self, host):
+        """返回这个对方的参数，没有记录时使用默认值；同一对方的多个会话共用同一个对象"""
+        with self._lock:
+            tuning = self._peers.get(host)
+            if tuning is None:
+                tuning = self._peers[host] = PeerTuning()
+            return tuning
+
+    def save(self):
+        with self._lock:
+            while len(self._peers) > self.max_peers:
+                del self._peers[next(iter(self._peers))]
+            data = {host: tuning.to_dict() for host, tuning in self._peers.items()}
+        try:
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=1)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            logger.warning(f"保存传输参数失败: {str(e)}")
+
+
+class TransferTuner:
+    """一次传输的测量：开始后 PROBE_TIME 秒内的吞吐量加上往返时间，据此调整参数并应用到连接
+
+    往返时间优先读取内核的统计，不可用时使用 rtt_sample，例如发送前协商所花的时间。
+    吞吐量只有在网络是瓶颈时才能说明网络的情况：增量和压缩传输由调用方 cancel()，
+    发送方另外传入阻塞在发送上的累计时间，网络没有一直忙碌时不调整。
+    """
+
+    def __init__(self, sock, tuning, store, sending, rtt_sample=None):
+        self.sock = sock
+        self.tuning = tuning
+        self.store = store
+        self.sending = sending
+        self.rtt_sample = rtt_sample
+        self.start_time = None
+        self.start_bytes = 0
+        self.start_busy = 0.0
+        self.done = False
+
+    def cancel(self):
+        """本次传输的吞吐量不能反映网络（如增量或压缩传输），不再测量"""
+        self.done = True
+
+    def update(self, total_bytes, busy_time=None):
+        """传输中定期调用，busy_time 为阻塞在发送上的累计秒数；参数被调整时返回 True"""
+        if self.done:
+            return False
+        now = time.monotonic()
+        if self.start_time is None:
+            # 从第一次调用开始计时，跳过连接刚开始的慢启动
+            self.start_time = now
+            self.start_bytes = total_bytes
+            self.start_busy = busy_time or 0.0
+            return False
+        elapsed = now - self.start_time
+        if elapsed < PROBE_TIME:
+            return False
+        self.done = True
+        transferred = total_bytes - self.start_bytes
+        if transferred < PROBE_MIN_BYTES:
+            return False
+        if busy_time is not None and busy_time - self.start_busy < elapsed * BUSY_FRACTION:
+            return False
+
+        throughput = transferred / elapsed
+        rtt = measure_rtt(self.sock) or self.rtt_sample
+        self.tuning.update(self.sending, throughput, rtt)
+        if self.sending:
+            configure_socket(self.sock, send_buffer=self.tuning.send_buffer)
+        else:
+            configure_socket(self.sock, recv_buffer=self.tuning.recv_buffer)
+        logger.info(f"调整传输参数: 吞吐量 {throughput / 1048576:.1f}MB/s，"
+                    f"往返时间 {(rtt or 0) * 1000:.2f}ms，{vars(self.tuning)}")
+        if self.store is not None:
+            self.store.save()
+        return True
@@ -0,0 +1,120 @@
+import lzma
+import struct
+import zlib
+
+# 传输时的数据压缩：每个数据块单独压缩，接收方逐块解压，压缩效果不明显的块原样发送。
+# zstd 在 Python 3.14 中进入标准库，较早的版本安装了 zstandard 包时也可以使用。
+try:
+    from compression import zstd as _zstd
+except ImportError:
+    _zstd = None
+try:
+    import zstandard as _zstandard
+except ImportError:
+    _zstandard = None
+
+COMPRESSED_HEADER = struct.Struct('!BI')  # 压缩算法编号 + 压缩前的长度，之后是压缩后的数据
+SAMPLE_SIZE = 65536  # 先压缩每块开头的 64KB 估计压缩率
+MIN_SAVING = 0.1  # 至少节省 10% 才发送压缩后的数据
+MAX_BACKOFF = 64  # 连续不可压缩时最多跳过 64 块再重新尝试
+
+
+def _zlib_decompress(data, size):
+    return zlib.decompressobj().decompress(data, size)
+
+
+def _lzma_decompress(data, size):
+    return lzma.LZMADecompressor().decompress(data, size)
+
+
+def _zstd_compress(data):
+    if _zstd is not None:
+        return _zstd.compress(data, level=3)
+    return _zstandard.ZstdCompressor(level=3).compress(data)
+
+
+def _zstd_decompress(data, size):
+    if _zstd is not None:
+        return _zstd.ZstdDecompressor().decompress(data, size)
+    return _zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+
+
+# 算法名称 -> (编号, 压缩函数, 解压函数)，按优先顺序排列
+CODECS = {}
+if _zstd is not None or _zstandard is not None:
+    CODECS['zstd'] = (3, _zstd_compress, _zstd_decompress)
+CODECS['zlib'] = (1, lambda data: zlib.compress(data, 1), _zlib_decompress)
+CODECS['lzma'] = (2, lambda data: lzma.compress(data, preset=1), _lzma_decompress)
+_CODECS_BY_ID = {codec_id: decompress for codec_id, _, decompress in CODECS.values()}
+
+
+def available_codecs():
+    """本机支持的压缩算法，按优先顺序排列"""
+    return list(CODECS)
+
+
+def decompress_payload(payload, limit):
+    """解压一个压缩数据帧的负载，解压后的长度不能超过 limit（由接收方按剩余的数据量决定）"""
+    if len(payload) < COMPRESSED_HEADER.size:
+        raise ValueError("压缩数据不完整")
+    codec_id, size = COMPRESSED_HEADER.unpack_from(payload)
+    # 压缩方不会发送空的压缩帧；长度为 0 时解压函数会把它当作不限制长度，必须拒绝
+    if size <= 0:
+        raise ValueError("声明的解压后长度无效")
+    if size > limit:
+        raise ValueError(f"声明的解压后长度 {size} 超出允许的 {limit}")
+    decompress = _CODECS_BY_ID.get(codec_id)
+    if decompress is None:
+        raise ValueError(f"不支持的压缩算法: {codec_id}")
+    # 限制解压后的长度，异常数据不会占满内存
+    data = decompress(memoryview(payload)[COMPRESSED_HEADER.size:], size)
+    if len(data) != size:
+        raise ValueError("解压后的数据长度不符")
+    return data
+
+
+class ChunkCompressor:
+    """按块压缩要发送的数据
+
+    每块先压缩开头的一小段样本估计压缩率，压缩效果不明显时整块原样发送；连续遇到不可压缩的数据时
+    成倍增加跳过的块数，已经压缩过的媒体文件几乎不消耗额外的 CPU
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.codec_id, self._compress, _ = CODECS[name]
+        self.raw_bytes = 0  # 经过压缩器的原始数据量
+        self.wire_bytes = 0  # 实际发送的数据量
+        self._skip = 0
+        self._backoff = 1
+
+    def _worth(self, compressed_size, raw_size):
+        return compressed_size <= raw_size * (1 - MIN_SAVING)
+
+    def _give_up(self, data):
+        self._skip = self._backoff
+        self._backoff = min(self._backoff * 2, MAX_BACKOFF)
+        self.wire_bytes += len(data)
+        return None
+
+    def compress(self, data):
+        """返回压缩数据帧的负载，不值得压缩时返回 None，由调用方原样发送"""
+        self.raw_bytes += len(data)
+        if not data:
+            return None
+        if self._skip:
+            self._skip -= 1
+            self.wire_bytes += len(data)
+            return None
+
+        if len(data) > SAMPLE_SIZE:
+            sample = memoryview(data)[:SAMPLE_SIZE]
+            if not self._worth(len(self._compress(sample)), SAMPLE_SIZE):
+                return self._give_up(data)
+        compressed = self._compress(data)
+        if not self._worth(len(compressed), len(data)):
+            return self._give_up(data)
+
+        self._backoff = 1
+        self.wire_bytes += COMPRESSED_HEADER.size + len(compressed)
+        return COMPRESSED_HEADER.pack(self.codec_id, len(data)) + compressed
@@ -0,0 +1,201 @@
+import base64
+import hashlib
+import math
+import struct
+import zlib
+
+# 增量传输：接收方已有旧版本文件时，只发送变化的数据
+#
+# 接收方把已有文件切成固定大小的块，每块计算一个可滚动的弱校验（adler32）和一个强校验
+# （16字节 BLAKE2b）发给发送方；发送方在源文件中查找这些块，相同的部分只发送块编号，
+# 接收方从已有文件中复制，其余部分照常作为文件数据发送。
+
+MIN_BLOCK_SIZE = 16384
+MAX_BLOCK_SIZE = 131072
+MAX_BLOCKS = 1048576  # 签名最多约 20MB，可以放进一个控制消息
+SIGNATURE = struct.Struct('!I16s')  # 弱校验 + 强校验
+ADLER_MOD = 65521
+READ_SIZE = 8388608  # 发送方每次读取 8MB 源文件
+LITERAL_LIMIT = 4194304  # 连续的变化数据每 4MB 发送一次
+SAMPLE_BLOCKS = 64  # 查找过这么多个块之后开始检查匹配率
+MIN_MATCH_RATE = 0.1  # 匹配的块少于这个比例时不再查找，其余数据直接作为变化的数据发送
+
+
+def block_size_for(file_size):
+    """块大小约为文件大小的平方根，按4KB取整；块越大签名越少，但每处变化重传的数据越多"""
+    size = max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, math.isqrt(file_size)))
+    size = max(size, -(-file_size // MAX_BLOCKS))
+    return -(-size // 4096) * 4096
+
+
+def strong_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def file_signatures(path, block_size):
+    """计算已有文件每个块的签名，编码为可以放进 JSON 消息的字符串"""
+    signatures = bytearray()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            signatures += SIGNATURE.pack(zlib.adler32(block), strong_digest(block))
+    return base64.b64encode(signatures).decode('ascii')
+
+
+def block_count(basis_size, block_size):
+    return -(-basis_size // block_size)
+
+
+def blocks_length(basis_size, block_size, start, count):
+    """已有文件从第 start 块开始的 count 个块的字节数，块编号无效时抛出 ValueError"""
+    if start < 0 or count <= 0 or start + count > block_count(basis_size, block_size):
+        raise ValueError("无效的块编号")
+    return min(count * block_size, basis_size - start * block_size)
+
+
+def copy_blocks(basis, basis_size, block_size, start, count, out, hasher):
+    """把已有文件从第 start 块开始的 count 个块写入 out 并更新摘要，返回复制的字节数"""
+    remaining = blocks_length(basis_size, block_size, start, count)
+    basis.seek(start * block_size)
+    copied = 0
+    while remaining > 0:
+        data = basis.read(min(remaining, READ_SIZE))
+        if not data:
+            raise ValueError("已有文件在传输过程中被截断")
+        hasher.update(data)
+        out.write(data)
+        copied += len(data)
+        remaining -= len(data)
+    return copied
+
+
+class DeltaEncoder:
+    """根据接收方已有文件的块签名，把源文件转换为增量指令"""
+
+    def __init__(self, block_size, basis_size, signatures):
+        raw = base64.b64decode(signatures)
+        if (block_size <= 0 or len(raw) % SIGNATURE.size
+                or len(raw) // SIGNATURE.size != block_count(basis_size, block_size)):
+            raise ValueError("无效的块签名")
+        self.block_size = block_size
+        self.basis_size = basis_size
+        # 滚动弱校验的代价在 Python 中较高，未匹配时只在块开头之后的一小段范围内逐字节查找，
+        # 足以找回小段插入或删除造成的错位；原地修改的文件（虚拟机镜像、数据库）总是按块对齐
+        self.search_limit = block_size // 16
+        self.blocks = {}  # 弱校验 -> {强校验: 块编号}
+        self.tail = None  # 已有文件最后一个不足整块的块：(长度, 弱校验, 强校验, 块编号)
+        for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(raw)):
+            length = min(block_size, basis_size - index * block_size)
+            if length < block_size:
+                self.tail = (length, weak, strong, index)
+            else:
+                # 内容相同的块只记录第一个
+                self.blocks.setdefault(weak, {}).setdefault(strong, index)
+
+    def _lookup(self, weak, data):
+        candidates = self.blocks.get(weak)
+        if candidates is None:
+            return None
+        return candidates.get(strong_digest(data))
+
+    def _search(self, view, offset, available):
+        """从 offset 开始查找与已有文件相同的块，返回 (跳过的字节数, 块编号, 块长度)，找不到时块编号为 None"""
+        n = self.block_size
+        if available < n:
+            # 剩余数据不足一个整块，只可能与已有文件的最后一块相同
+            if self.tail and available == self.tail[0]:
+                data = view[offset:offset + available]
+                if zlib.adler32(data) == self.tail[1] and strong_digest(data) == self.tail[2]:
+                    return 0, self.tail[3], available
+            return 0, None, available
+
+        weak = zlib.adler32(view[offset:offset + n])
+        index = self._lookup(weak, view[offset:offset + n])
+        if index is not None:
+            return 0, index, n
+
+        # 窗口每向后移动一个字节，弱校验可以由上一个位置的值直接算出
+        a = weak & 0xffff
+        b = weak >> 16
+        blocks = self.blocks
+        for skip in range(1, min(self.search_limit, available - n) + 1):
+            removed = view[offset + skip - 1]
+            added = view[offset + skip - 1 + n]
+            a = (a - removed + added) % ADLER_MOD
+            b = (b - n * removed + a - 1) % ADLER_MOD
+            weak = (b << 16) | a
+            if weak in blocks:
+                index = self._lookup(weak, view[offset + skip:offset + skip + n])
+                if index is not None:
+                    return skip, index, n
+        return 0, None, n
+
+    def instructions(self, f, file_size, hasher):
+        """依次产生 ('data', 数据) 和 ('copy', 起始块编号, 块数, 字节数)，同时用源文件的全部内容更新 hasher
+
+        逐字节滚动查找在 Python 中很慢，大部分内容都已变化时查找几乎没有收益；查找过 SAMPLE_BLOCKS
+        个块后匹配率低于 MIN_MATCH_RATE 时不再查找，剩余的数据全部作为变化的数据发送
+        """
+        need = self.block_size + self.search_limit
+        searched = matched = 0  # 已查找的块数和其中找到相同块的次数
+        searching = True
+        buf = b""
+        offset = 0  # 当前位置在 buf 中的偏移
+        position = 0  # 当前位置在源文件中的偏移
+        literal = bytearray()
+        run_start = run_count = run_length = 0
+
+        while position < file_size:
+            available = min(len(buf) - offset, file_size - position)
+            if available < need and len(buf) - offset < file_size - position:
+                chunk = f.read(READ_SIZE)
+                if not chunk:
+                    raise ValueError("源文件在发送过程中被截断")
+                buf = buf[offset:] + chunk
+                offset = 0
+                continue
+
+            view = memoryview(buf)
+            if searching:
+                skip, index, length = self._search(view, offset, available)
+                searched += 1
+                if index is not None:
+                    matched += 1
+                elif searched >= SAMPLE_BLOCKS and matched < searched * MIN_MATCH_RATE:
+                    searching = False
+            else:
+                index, length = None, min(available, LITERAL_LIMIT - len(literal))
+            if index is None:
+                # 没有相同的块，这一段作为变化的数据发送
+                skip, length = length, 0
+            if skip:
+                if run_count:
+                    yield 'copy', run_start, run_count, run_length
+                    run_count = run_length = 0
+                literal += view[offset:offset + skip]
+                hasher.update(view[offset:offset + skip])
+                if len(literal) >= LITERAL_LIMIT:
+                    yield 'data', literal
+                    literal = bytearray()
+            if index is not None:
+                if literal:
+                    yield 'data', literal
+                    literal = bytearray()
+                # 连续的块合并成一条复制指令
+                if run_count and index != run_start + run_count:
+                    yield 'copy', run_start, run_count, run_length
+                    run_count = run_length = 0
+                if not run_count:
+                    run_start = index
+                run_count += 1
+                run_length += length
+                hasher.update(view[offset + skip:offset + skip + length])
+            offset += skip + length
+            position += skip + length
+
+        if literal:
+            yield 'data', literal
+        if run_count:
+            yield 'copy', run_start, run_count, run_length
@@ -0,0 +1,146 @@
+import os
+import zlib
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_HASH_ALGORITHM = 'blake2b'
+TREE_LEAF_SIZE = 4194304  # 哈希树每个叶子块 4MB
+READ_SIZE = 1048576  # 计算文件摘要时每次读取 1MB
+
+
+class Crc32Hash:
+    """CRC32 校验和，适用于可信局域网的快速完整性检查，不具备抗篡改能力"""
+    name = 'crc32'
+
+    def __init__(self, value=0):
+        self._value = value
+
+    def update(self, data):
+        self._value = zlib.crc32(data, self._value)
+
+    def hexdigest(self):
+        return f"{self._value:08x}"
+
+    def copy(self):
+        return Crc32Hash(self._value)
+
+
+class TreeHash:
+    """分块哈希树：文件按固定大小切成叶子块分别计算摘要，根摘要对所有叶子摘要再做一次哈希
+
+    流式计算与多线程并行计算得到的结果相同，因此大文件可以在多个核心上同时计算
+    """
+
+    def __init__(self, name, leaf_factory, leaf_size=TREE_LEAF_SIZE):
+        self.name = name
+        self._leaf_factory = leaf_factory
+        self._leaf_size = leaf_size
+        self._leaves = []
+        self._leaf = leaf_factory()
+        self._leaf_filled = 0
+
+    def update(self, data):
+        view = memoryview(data).cast('B')
+        pos = 0
+        while pos < len(view):
+            take = min(self._leaf_size - self._leaf_filled, len(view) - pos)
+            self._leaf.update(view[pos:pos + take])
+            self._leaf_filled += take
+            pos += take
+            if self._leaf_filled == self._leaf_size:
+                self._leaves.append(self._leaf.digest())
+                self._leaf = self._leaf_factory()
+                self._leaf_filled = 0
+
+    def hexdigest(self):
+        leaves = list(self._leaves)
+        if self._leaf_filled:
+            leaves.append(self._leaf.digest())
+        return self.root_hexdigest(leaves)
+
+    def root_hexdigest(self, leaves):
+        """根据叶子摘要列表计算根摘要"""
+        root = self._leaf_factory()
+        for leaf in leaves:
+            root.update(leaf)
+        return root.hexdigest()
+
+    def copy(self):
+        other = TreeHash(self.name, self._leaf_factory, self._leaf_size)
+        other._leaves = list(self._leaves)
+        other._leaf = self._leaf.copy()
+        other._leaf_filled = self._leaf_filled
+        return other
+
+
+def _blake2b():
+    return hashlib.blake2b(digest_size=32)
+
+
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha256': hashlib.sha256,
+    'blake2b': _blake2b,
+    'crc32': Crc32Hash,
+    'tree-blake2b': lambda: TreeHash('tree-blake2b', _blake2b),
+    'tree-sha256': lambda: TreeHash('tree-sha256', hashlib.sha256),
+}
+
+
+def is_supported(algorithm):
+    """判断摘要算法是否受支持"""
+    return algorithm in HASH_ALGORITHMS
+
+
+def new_hasher(algorithm=DEFAULT_HASH_ALGORITHM):
+    """创建摘要计算对象，提供 update / hexdigest / copy 接口"""
+    if not is_supported(algorithm):
+        raise ValueError(f"不支持的摘要算法: {algorithm}")
+    return HASH_ALGORITHMS[algorithm]()
+
+
+def hash_range(file_path, hasher, offset, length):
+    """读取文件中的一段数据并更新摘要"""
+    buffer = bytearray(min(READ_SIZE, max(length, 1)))
+    view = memoryview(buffer)
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        while length > 0:
+            n = f.readinto(view[:min(length, len(buffer))])
+            if not n:
+                raise ValueError("文件长度在计算摘要时发生了变化")
+            hasher.update(view[:n])
+            length -= n
+    return hasher
+
+
+def hash_ranges(file_path, algorithm, ranges, workers=None):
+    """分别计算文件中若干段 (偏移, 长度) 的摘要，各段在线程池中同时读取和计算"""
+    def hash_one(item):
+        offset, length = item
+        return hash_range(file_path, new_hasher(algorithm), offset, length).hexdigest()
+
+    with ThreadPoolExecutor(max_workers=workers or min(len(ranges), os.cpu_count() or 1) or 1) as pool:
+        return list(pool.map(hash_one, ranges))
+
+
+def hash_file(file_path, algorithm=DEFAULT_HASH_ALGORITHM, workers=None):
+    """计算文件摘要，哈希树算法会在多个线程中并行计算各叶子块"""
+    hasher = new_hasher(algorithm)
+    file_size = os.path.getsize(file_path)
+
+    if not isinstance(hasher, TreeHash) or file_size <= hasher._leaf_size:
+        return hash_range(file_path, hasher, 0, file_size).hexdigest()
+
+    # hashlib 在处理大块数据时会释放 GIL，因此线程池即可利用多个核心
+    leaf_size = hasher._leaf_size
+    offsets = range(0, file_size, leaf_size)
+
+    def hash_leaf(offset):
+        leaf = hash_range(file_path, hasher._leaf_factory(), offset,
+                          min(leaf_size, file_size - offset))
+        return leaf.digest()
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+        leaves = list(pool.map(hash_leaf, offsets))
+    return hasher.root_hexdigest(leaves)
@@ -0,0 +1,107 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from digest import hash_file
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".file_transfer_digests.sqlite")
+
+
+class DigestCache:
+    """文件摘要的磁盘缓存
+
+    按 (路径, 算法) 记录摘要以及计算时文件的设备号、inode、大小和纳秒修改时间，这些值都没有变化时
+    直接使用记录的摘要，刚发送或接收过的大文件再次发送时不需要重新读取。记录数超过上限时淘汰
+    最久未使用的记录。缓存只是加速手段，数据库无法打开或读写失败时照常计算摘要。
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=100000, min_size=1048576):
+        self.path = path
+        self.max_entries = max_entries  # 最多保留的记录数
+        self.min_size = min_size  # 小文件计算摘要很快，不记录，避免频繁写数据库
+        self._lock = threading.Lock()
+        self._db = None
+        try:
+            # 图形界面和命令行可能同时使用同一个缓存文件
+            db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS digests (
+                    path TEXT NOT NULL,
+                    algorithm TEXT NOT NULL,
+                    dev INTEGER NOT NULL,
+                    ino INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    digest TEXT NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (path, algorithm)
+                )""")
+            db.execute("CREATE INDEX IF NOT EXISTS digests_last_used ON digests (last_used)")
+            db.commit()
+            self._db = db
+        except Exception as e:
+            logger.warning(f"无法打开摘要缓存，不使用缓存: {str(e)}")
+
+    @staticmethod
+    def _file_key(stat):
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def get(self, file_path, algorithm, stat=None):
+        """返回缓存中的摘要，文件变化过或没有记录时返回 None"""
+        if self._db is None:
+            return None
+        try:
+            path = os.path.abspath(file_path)
+            stat = stat or os.stat(path)
+            if stat.st_size < self.min_size:
+                return None
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT dev, ino, size, mtime_ns, digest FROM digests WHERE path = ? AND algorithm = ?",
+                    (path, algorithm)).fetchone()
+                if row is None or tuple(row[:4]) != self._file_key(stat):
+                    return None
+                self._db.execute(
+                    "UPDATE digests SET last_used = ? WHERE path = ? AND algorithm = ?",
+                    (time.time(), path, algorithm))
+                self._db.commit()
+            return row[4]
+        except Exception as e:
+            logger.warning(f"读取摘要缓存失败: {str(e)}")
+            return None
+
+    def put(self, file_path, algorithm, digest, stat):
+        """记录摘要，stat 是计算摘要前文件的状态，文件在计算期间被修改时不记录"""
+        if self._db is None or stat.st_size < self.min_size:
+            return
+        try:
+            path = os.path.abspath(file_path)
+            if self._file_key(os.stat(path)) != self._file_key(stat):
+                return
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (path, algorithm, *self._file_key(stat), digest, time.time()))
+                count = self._db.execute("SELECT COUNT(*) FROM digests").fetchone()[0]
+                if count > self.max_entries:
+                    self._db.execute(
+                        "DELETE FROM digests WHERE rowid IN "
+                        "(SELECT rowid FROM digests ORDER BY last_used LIMIT ?)",
+                        (count - self.max_entries,))
+                self._db.commit()
+        except Exception as e:
+            logger.warning(f"写入摘要缓存失败: {str(e)}")
+
+    def hash_file(self, file_path, algorithm):
+        """计算文件摘要，缓存中有记录时直接返回"""
+        stat = os.stat(file_path)
+        digest = self.get(file_path, algorithm, stat)
+        if digest is None:
+            digest = hash_file(file_path, algorithm)
+            self.put(file_path, algorithm, digest, stat)
+        return digest
+
@@ -0,0 +1,3304 @@
+import logging
+import os
+import errno
+import mmap
+import shutil
+import socket
+import threading
+import json
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from digest import DEFAULT_HASH_ALGORITHM, new_hasher, hash_file, hash_range, hash_ranges, is_supported
+from digest_cache import DigestCache
+from delta import DeltaEncoder, block_size_for, blocks_length, copy_blocks, file_signatures
+from compress import ChunkCompressor, available_codecs, decompress_payload
+from ratelimit import RateLimiter, pace_size, scheduled_rate, throttle
+from autotune import PeerTuning, TransferTuner, TuningStore, configure_socket
+from pipeline import DEFAULT_PIPELINE_DEPTH, BufferPool, BufferQueue, StallCounter, WriteBehind
+from metrics import MetricsRecorder, TransferMetrics
+from protocol import (FrameSocket, ProtocolError, ConnectionClosed, decode_json, MSG_JSON, MSG_FILE_HEADER,
+                      MSG_FILE_DATA, MSG_FILE_TRAILER, MSG_STREAM_HELLO, MSG_SESSION_HELLO,
+                      MSG_FOLDER_HEADER, MSG_FILE_COPY, MSG_FILE_COMPRESSED, MAX_FRAME_SIZE)
+
+logger = logging.getLogger(__name__)
+
+
+class FileTransferSignals:
+    """自定义信号类"""
+    def __init__(self):
+        self._callbacks = {
+            'progress_updated': [],
+            'transfer_completed': [],
+            'error_occurred': [],
+            'remote_files_updated': [],  # 对方目录列表的一页：(目录项列表, 对方路径, 是否第一页, 是否最后一页)
+            'speed_updated': [],
+            'status_updated': [],  # 添加状态更新信号
+            'warning_occurred': [],  # 不影响连接的错误提示
+            'connection_changed': [],  # 连接建立或断开：(是否已连接, 对方地址)
+            'queue_item_added': [],  # 传输项加入：(文件路径, 大小)
+            'queue_item_updated': []  # 传输项更新：(文件路径, 状态, 进度)，不变的值为 None
+        }
+    
+    def connect(self, signal, callback):
+        """连接信号到回调函数"""
+        if signal in self._callbacks:
+            self._callbacks[signal].append(callback)
+    
+    def disconnect(self, signal, callback):
+        """断开信号与回调函数的连接"""
+        if callback in self._callbacks.get(signal, []):
+            self._callbacks[signal].remove(callback)
+    
+    def emit(self, signal, *args):
+        """发送信号"""
+        if signal in self._callbacks:
+            for callback in list(self._callbacks[signal]):
+                callback(*args)
+
+def is_sparse(stat):
+    """文件占用的磁盘空间小于它的大小时为稀疏文件（如虚拟机镜像），Windows 上不判断"""
+    blocks = getattr(stat, 'st_blocks', None)
+    return blocks is not None and blocks * 512 < stat.st_size
+
+
+_zero_blocks = {}  # 长度 -> 全零的 bytearray，用于快速判断数据是否全为零
+
+
+def is_zero(data):
+    """判断一段数据是否全为零；bytearray 与其他缓冲区比较时直接比较内存，很快"""
+    zero = _zero_blocks.get(len(data))
+    if zero is None:
+        if len(_zero_blocks) >= 16:
+            _zero_blocks.clear()
+        zero = _zero_blocks[len(data)] = bytearray(len(data))
+    return zero == data
+
+
+def check_free_space(path, needed):
+    """确认 path 所在的磁盘至少还有 needed 字节可用，不够时立即报错，而不是传输到最后才发现磁盘已满"""
+    free = shutil.disk_usage(path).free
+    if needed > free:
+        raise OSError(errno.ENOSPC, f"磁盘空间不足: 需要 {format_size(needed)}，可用 {format_size(free)}")
+
+
+def valid_ranges(ranges, file_size):
+    """检查并行传输的区间 [偏移, 长度, 已完成] 是否依次覆盖整个文件，返回整理后的列表，无效时返回 None"""
+    try:
+        result = [[int(offset), int(length), int(done)] for offset, length, done in ranges]
+    except (TypeError, ValueError):
+        return None
+    position = 0
+    for offset, length, done in result:
+        if offset != position or length < 0 or not 0 <= done <= length:
+            return None
+        position += length
+    return result if result and position == file_size else None
+
+
+def write_resume_state(state_path, state):
+    """写入续传记录：先写临时文件再改名，中断时不会留下不完整的记录"""
+    temp_path = state_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(temp_path, state_path)
+
+
+def preallocate(f, size, sparse=False):
+    """把文件扩展到 size 字节
+
+    一次分配全部空间，机械硬盘上文件不会因逐块追加而产生碎片，空间不足时也立即报错；
+    sparse 为 True 时只设置长度，之后跳过全零的数据，未写入的部分在磁盘上保持为空洞。
+    系统或文件系统不支持预分配时只设置长度（Windows 上设置长度时即分配空间）。
+    """
+    f.flush()
+    fd = f.fileno()
+    if not sparse and size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+    os.ftruncate(fd, size)
+
+
+def read_ahead(f, offset, length):
+    """提示内核在后台读入文件的这一段，之后的 sendfile 直接从页缓存发送；系统不支持时忽略"""
+    if length > 0 and hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(f.fileno(), offset, length, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+
+
+class FileTransferThread(threading.Thread):
+    """发送文件的线程，发送单个文件、文件夹或一批小文件"""
+    def __init__(self, connection, file_path, save_path, signals=None,
+                 hash_algorithm=DEFAULT_HASH_ALGORITHM, streams=1, peer_address=None,
+                 wait_reply=None, request_id=None, batch_files=None, compression=None,
+                 digest_cache=None, send_slot=None, rate_limiters=None, tuning=None, tuning_store=None,
+                 pipeline_depth=DEFAULT_PIPELINE_DEPTH, buffer_pool=None, metrics_recorder=None, retries=0):
+        super().__init__()
+        self.connection = connection  # FrameSocket，发送加锁，可与其他线程共用连接
+        self.socket = connection.sock
+        self.file_path = file_path
+        self.save_path = save_path
+        self.hash_algorithm = hash_algorithm
+        self.streams = streams  # 大文件使用的并行连接数
+        self.peer_address = peer_address  # 对方监听地址，用于建立并行数据连接
+        self.wait_reply = wait_reply  # 等待对方回复的回调，用于协商续传位置
+        self.request_id = request_id  # 响应对方拉取请求时带上请求编号
+        self.batch_files = batch_files  # 作为一批发送的多个小文件，此时忽略 file_path
+        self.compression = compression  # 压缩算法名称，或返回它的函数（协商可能要等待对方的参数，在传输线程中调用）
+        self._compressor = None  # 与对方协商的压缩算法，开始传输时创建
+        self.digest_cache = digest_cache  # 摘要缓存，源文件没有变化时不再重新计算
+        self.send_slot = send_slot  # 与同一连接上的其他发送互斥的锁，连接上同一时间只能有一个文件的数据
+        self.rate_limiters = rate_limiters or []  # 发送前需要预约额度的限速器：全局、对方和本次传输
+        self.tuning = tuning or PeerTuning()  # 与这个对方传输时使用的块大小和缓冲区，传输开始后按测量结果调整
+        self.tuning_store = tuning_store  # 调整后的参数保存在这里，下次传输时使用
+        self._tuner = None  # 本次传输的测量，开始发送数据时创建
+        self._rtt_sample = None  # 协商续传所花的时间，系统不提供往返时间时用来估计
+        self.pipeline_depth = pipeline_depth  # 逐块发送时提前读入的块数
+        self.buffer_pool = buffer_pool or BufferPool()  # 读取文件数据使用的缓冲区，与其他传输共用
+        self.disk_stalls = StallCounter()  # 发送线程等待读取线程的次数和时间，多说明磁盘是瓶颈
+        self.network_stalls = StallCounter()  # 读取线程等待发送的次数和时间，多说明网络是瓶颈
+        self.metrics_recorder = metrics_recorder  # 传输结束时把性能记录交给它
+        self.metrics = None  # 本次传输的性能记录，开始传输时创建
+        self.retries = retries  # 队列已重新安排这个传输项的次数，计入性能记录
+        self._succeeded = False
+        self.running = True
+        self.signals = signals or FileTransferSignals()
+        self._last_time = time.time()
+        self._last_update = time.time()
+        self._update_interval = 0.5
+        self._last_bytes = 0
+        self._chunk_size = self.tuning.send_chunk  # 逐块发送时每次读取的大小
+        self._delta = False  # 正在进行增量传输，发送量不反映网络吞吐量
+        self._sendfile_slice = 8388608  # 每次 sendfile 调用发送 8MB
+        self._use_sendfile = True
+        self._progress_update_interval = 0.2
+        self._timeout = 30  # 30秒超时
+        self._retry_count = 3  # 最大重试次数
+        self._reply_timeout = 600  # 对方需要先校验已接收部分，等待时间较长
+        self._parallel_threshold = 268435456  # 超过256MB的文件才使用并行传输
+        self._parallel_alignment = 1048576  # 并行区间按1MB对齐
+        self._parallel_sent = 0
+        self._parallel_lock = threading.Lock()
+        self._progress_base = 0  # 发送文件夹时，之前各文件已发送的字节数
+        self._progress_total = None  # 发送文件夹时，需要发送的总字节数
+        self._batch_file_limit = 1048576  # 小于1MB的文件打包发送
+        self._batch_size = 4194304  # 每批数据约4MB
+        self._batch_max_files = 1024  # 每批最多1024个文件
+        self._delta_min_size = 1048576  # 1MB以上的文件在对方已有旧版本时只发送变化的块
+
+    def _send_frame(self, operation):
+        """发送完整的帧；帧发送到一半时超时或出错，对方会把剩余的数据当作帧头解析，连接无法继续使用，
+        因此不重试，立即断开连接，之后重新推送时从中断处续传"""
+        try:
+            return operation()
+        except OSError as e:
+            self._break_connection()
+            raise Exception(f"发送失败，连接已断开: {str(e)}")
+
+    def _break_connection(self):
+        """断开控制连接，会话的接收线程随之结束并清理"""
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def run(self):
+        compression = self.compression() if callable(self.compression) else self.compression
+        self._compressor = ChunkCompressor(compression) if compression else None
+        if self.send_slot is not None:
+            with self.send_slot:
+                self._run()
+        else:
+            self._run()
+
+    def _transfer_name(self):
+        if self.batch_files:
+            return f"{len(self.batch_files)} 个文件"
+        return os.path.basename(os.path.normpath(self.file_path))
+
+    def _complete(self, message):
+        """传输成功结束"""
+        self._succeeded = True
+        self.signals.emit('transfer_completed', message)
+
+    def _record_metrics(self):
+        """传输结束时补全并提交性能记录"""
+        metrics = self.metrics
+        metrics.chunk_size = self._chunk_size
+        if self.disk_stalls.count or self.network_stalls.count:
+            metrics.stalls = {'disk': self.disk_stalls.seconds, 'network': self.network_stalls.seconds}
+        metrics.finish(self._succeeded)
+        if self.metrics_recorder is not None:
+            self.metrics_recorder.record(metrics)
+
+    def _run(self):
+        # 从取得发送权时开始计时，不包括等待其他传输的时间
+        self.metrics = TransferMetrics('send', self._transfer_name(),
+                                       self.peer_address[0] if self.peer_address else "")
+        self.metrics.retries = self.retries
+        try:
+            if self.batch_files:
+                self._upload_batch()
+            elif os.path.isdir(self.file_path):
+                self._upload_folder()
+            else:
+                self._upload_file()
+        except Exception as e:
+            self.signals.emit('error_occurred', str(e))
+        finally:
+            self._record_metrics()
+
+    def _upload_file(self):
+        try:
+            stat = os.stat(self.file_path)
+            file_size = stat.st_size
+            file_name = os.path.basename(self.file_path)
+            # 摘要已在缓存中时随文件信息发给对方，发送数据时也不再计算
+            cached_digest = None
+            if self.digest_cache is not None:
+                cached_digest = self.digest_cache.get(self.file_path, self.hash_algorithm, stat)
+            
+            self.signals.emit('status_updated', f"正在发送: {file_name}")
+
+            # 发送文件信息（包含摘要算法），摘要在发送数据的同时计算，发送完毕后作为尾部追加
+            transfer_id = uuid.uuid4().hex
+            header = {
+                'file_name': file_name,
+                'file_size': file_size,
+                'save_path': self.save_path,
+                'hash_algorithm': self.hash_algorithm,
+                'transfer_id': transfer_id,
+                'request_id': self.request_id,
+                'mtime': stat.st_mtime,
+                'digest': cached_digest,  # 对方已有摘要相同的文件时不需要发送
+                'delta': file_size >= self._delta_min_size,  # 对方已有同名文件时请对方发送块签名
+                'sparse': is_sparse(stat)  # 对方跳过全零的数据，保持为空洞
+            }
+            self._send_frame(lambda: self.connection.send_message(MSG_FILE_HEADER, header))
+            
+            # 与接收方协商传输方式：续传、增量传输，或者大文件改用多条并行连接
+            negotiated = self._negotiate_resume(transfer_id, file_size)
+            if negotiated is None:
+                self.signals.emit('progress_updated', 100)
+                self._complete(f"对方已有相同文件: {file_name}")
+                self.signals.emit('status_updated', "传输完成")
+                return
+            offset, hasher, encoder, stream_sockets, ranges = negotiated
+            if stream_sockets:
+                self._upload_parallel(file_name, file_size, stream_sockets, ranges)
+                return
+
+            self.socket.settimeout(self._timeout)
+            
+            # 发送文件内容
+            self._last_bytes = offset
+            self._last_update = time.time()
+            
+            with open(self.file_path, 'rb') as f:
+                self._delta = encoder is not None
+                if encoder is not None:
+                    bytes_sent = self._send_delta(f, file_size, hasher, encoder)
+                elif self._can_use_sendfile():
+                    bytes_sent = self._send_with_sendfile(
+                        f, file_size, None if cached_digest else hasher, offset)
+                else:
+                    bytes_sent = self._send_with_loop(
+                        f, file_size, None if cached_digest else hasher, offset)
+
+            if bytes_sent == file_size:
+                # 数据发送完毕后追加摘要尾部
+                digest = cached_digest or hasher.hexdigest()
+                if self.digest_cache is not None and not cached_digest:
+                    self.digest_cache.put(self.file_path, self.hash_algorithm, digest, stat)
+                trailer = {'transfer_id': transfer_id, 'digest': digest}
+                self._send_frame(lambda: self.connection.send_message(MSG_FILE_TRAILER, trailer))
+                self._report_stalls(file_name)
+                self._wait_verified(transfer_id)
+                self.signals.emit('progress_updated', 100)
+                self._update_speed(bytes_sent)
+                self._complete(f"已发送: {file_name}")
+                self.signals.emit('status_updated', "传输完成")
+            else:
+                raise Exception("传输未完成")
+            
+        except Exception as e:
+            self.signals.emit('error_occurred', f"上传失败: {str(e)}")
+            self.signals.emit('status_updated', "传输失败")
+        finally:
+            self.running = False
+
+    def _upload_folder(self):
+        """发送整个文件夹：先发送一份清单，对方据此一次建好目录结构，之后依次发送各文件的数据"""
+        folder_name = os.path.basename(os.path.normpath(self.file_path))
+        self.signals.emit('status_updated', f"正在发送文件夹: {folder_name}")
+        dirs, files = build_manifest(self.file_path)
+        sources = [os.path.join(self.file_path, *entry['path'].split('/')) for entry in files]
+        self._upload_manifest(folder_name, dirs, sources, files,
+                              f"已发送文件夹: {folder_name}（{len(files)} 个文件）")
+
+    def _upload_batch(self):
+        """将多个小文件作为一批发送：一份清单、连续的数据流、一次完成通知"""
+        self.signals.emit('status_updated', f"正在发送 {len(self.batch_files)} 个文件")
+        files = []
+        for source_path in self.batch_files:
+            stat = os.stat(source_path)
+            files.append({
+                'path': os.path.basename(source_path),
+                'size': stat.st_size,
+                'mtime': stat.st_mtime
+            })
+        # 文件夹名为空时，各文件直接保存到对方的保存目录
+        self._upload_manifest("", [], self.batch_files, files, f"已发送 {len(files)} 个文件")
+
+    def _upload_manifest(self, folder_name, dirs, sources, files, done_message):
+        """发送清单以及清单中各文件的数据"""
+        try:
+            transfer_id = uuid.uuid4().hex
+            header = {
+                'folder_name': folder_name,
+                'save_path': self.save_path,
+                'hash_algorithm': self.hash_algorithm,
+                'transfer_id': transfer_id,
+                'request_id': self.request_id,
+                'dirs': dirs,
+                'files': files
+            }
+            self._send_frame(lambda: self.connection.send_message(MSG_FOLDER_HEADER, header))
+
+            self.socket.settimeout(self._timeout)
+
+            self._progress_total = sum(entry['size'] for entry in files)
+            self._progress_base = 0
+            self._last_bytes = 0
+            self._last_update = time.time()
+            self._send_manifest_entries(transfer_id, sources, files)
+            self._report_stalls(folder_name or f"{len(files)} 个文件")
+            self._wait_verified(transfer_id)
+
+            self.signals.emit('progress_updated', 100)
+            self._update_speed(self._progress_base)
+            self._complete(done_message)
+            self.signals.emit('status_updated', "传输完成")
+
+        except Exception as e:
+            self.signals.emit('error_occurred', f"上传失败: {str(e)}")
+            self.signals.emit('status_updated', "传输失败")
+        finally:
+            self.running = False
+
+    def _send_manifest_entries(self, transfer_id, sources, files):
+        """按清单顺序发送各文件的数据
+
+        大文件单独发送，之后是它的摘要尾部；小文件的内容拼接成一个数据帧整批发送，
+        尾部带有批内每个文件的摘要，避免每个小文件都产生帧头、尾部和系统调用的开销
+        """
+        batch = bytearray()
+        batch_digests = []
+        batch_start = 0
+        for index, (source_path, entry) in enumerate(zip(sources, files)):
+            if not self.running:
+                raise Exception("传输已取消")
+
+            if entry['size'] < self._batch_file_limit:
+                if not batch_digests:
+                    batch_start = index
+                with self.metrics.timing('disk_read'):
+                    with open(source_path, 'rb') as f:
+                        data = f.read(entry['size'])
+                if len(data) != entry['size']:
+                    raise Exception(f"文件在发送过程中被截断: {entry['path']}")
+                hasher = new_hasher(self.hash_algorithm)
+                with self.metrics.timing('hashing'):
+                    hasher.update(data)
+                batch += data
+                batch_digests.append(hasher.hexdigest())
+                if len(batch) >= self._batch_size or len(batch_digests) >= self._batch_max_files:
+                    self._flush_batch(transfer_id, batch, batch_start, batch_digests)
+                    batch = bytearray()
+                    batch_digests = []
+                continue
+
+            # 数据按清单顺序到达接收方，发送大文件前先发出已打包的小文件
+            if batch_digests:
+                self._flush_batch(transfer_id, batch, batch_start, batch_digests)
+                batch = bytearray()
+                batch_digests = []
+
+            # 摘要已在缓存中时发送过程中不再计算
+            stat = os.stat(source_path)
+            cached_digest = None
+            if self.digest_cache is not None and stat.st_size == entry['size']:
+                cached_digest = self.digest_cache.get(source_path, self.hash_algorithm, stat)
+            hasher = None if cached_digest else new_hasher(self.hash_algorithm)
+            with open(source_path, 'rb') as f:
+                if self._can_use_sendfile():
+                    bytes_sent = self._send_with_sendfile(f, entry['size'], hasher,
+                                                          source_path=source_path)
+                else:
+                    bytes_sent = self._send_with_loop(f, entry['size'], hasher)
+            if bytes_sent != entry['size']:
+                raise Exception(f"传输未完成: {entry['path']}")
+            digest = cached_digest or hasher.hexdigest()
+            if self.digest_cache is not None and not cached_digest:
+                self.digest_cache.put(source_path, self.hash_algorithm, digest, stat)
+
+            trailer = {'transfer_id': transfer_id, 'index': index, 'digests': [digest]}
+            self._send_frame(lambda: self.connection.send_message(MSG_FILE_TRAILER, trailer))
+            self._progress_base += entry['size']
+
+        if batch_digests:
+            self._flush_batch(transfer_id, batch, batch_start, batch_digests)
+
+    def _flush_batch(self, transfer_id, batch, batch_start, digests):
+        """发送一批小文件的数据和它们的摘要"""
+        if batch:
+            self._send_frame(lambda: self._send_data(batch))
+        trailer = {'transfer_id': transfer_id, 'index': batch_start, 'digests': digests}
+        self._send_frame(lambda: self.connection.send_message(MSG_FILE_TRAILER, trailer))
+
+        self._progress_base += len(batch)
+        current_time = time.time()
+        if self._progress_total and current_time - self._last_update >= self._progress_update_interval:
+            self._report_progress(0, self._progress_total)
+
+    def _wait_verified(self, transfer_id):
+        """等待对方校验的结果：数据发完不代表对方收到的是正确的文件，校验失败时抛出异常，由传输队列决定是否重传"""
+        self.signals.emit('status_updated', "等待对方校验...")
+        reply = self.wait_reply(transfer_id, self._reply_timeout)
+        if not reply.get('ok'):
+            raise Exception(f"对方校验失败: {reply.get('error') or '未知错误'}")
+
+    def _negotiate_resume(self, transfer_id, file_size):
+        """根据接收方的回复确定传输方式
+
+        返回 (起始位置, 已包含前缀数据的摘要对象, 增量编码器, 并行数据连接, 并行区间)：接收方有 .part 文件时
+        从中断处续传，并行传输中断的文件从各区间中断处继续；接收方已有旧版本时增量传输；
+        都没有时大文件改用多条并行连接。接收方已有摘要相同的文件时返回 None
+        """
+        if self.wait_reply is None:
+            raise Exception("缺少接收方响应通道")
+        
+        hasher = new_hasher(self.hash_algorithm)
+        start_time = time.monotonic()
+        offer = self.wait_reply(transfer_id, self._reply_timeout)
+        self._rtt_sample = time.monotonic() - start_time
+        while offer.get('pending'):
+            # 对方仍在校验已接收部分或计算块签名
+            self.signals.emit('status_updated', "等待对方准备接收...")
+            offer = self.wait_reply(transfer_id, self._reply_timeout)
+        if offer.get('identical'):
+            # 对方已有摘要相同的文件，传输到此结束
+            logger.info("对方已有相同文件，跳过发送")
+            return None
+        if offer.get('error'):
+            raise Exception(f"对方无法接收: {offer['error']}")
+        offset = int(offer.get('offset', 0))
+        
+        # 核对接收方已有部分与源文件是否一致
+        if offset:
+            self.signals.emit('status_updated', "校验续传位置...")
+            hash_range(self.file_path, hasher, 0, offset)
+            if hasher.hexdigest() != offer.get('prefix_digest'):
+                logger.warning("接收方已有数据与源文件不一致，从头开始传输")
+                offset = 0
+                hasher = new_hasher(self.hash_algorithm)
+            else:
+                logger.info(f"从偏移 {offset} 处续传")
+
+        encoder = None
+        delta = offer.get('delta')
+        if not offset and delta:
+            try:
+                encoder = DeltaEncoder(int(delta['block_size']), int(delta['basis_size']),
+                                       delta['signatures'])
+                logger.info(f"对方已有旧版本，增量传输，块大小 {format_size(encoder.block_size)}")
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning(f"块签名无效，完整传输: {str(e)}")
+
+        stream_sockets = None
+        ranges = None
+        if not offset and encoder is None and self._should_use_parallel(file_size):
+            if offer.get('ranges'):
+                ranges = self._verify_ranges(offer['ranges'], file_size)
+            if ranges is None:
+                ranges = [[start, length, 0] for start, length in self._split_ranges(file_size, self.streams)]
+            stream_sockets = self._open_streams(len(ranges))
+
+        start = {
+            'type': 'resume_start',
+            'transfer_id': transfer_id,
+            'offset': offset,
+            'delta': encoder is not None,
+            'parallel': stream_sockets is not None  # 对方放弃这次接收，等待随后的并行传输
+        }
+        try:
+            self._send_frame(lambda: self.connection.send_json(start))
+        except Exception:
+            for sock in stream_sockets or []:
+                sock.close()
+            raise
+        return offset, hasher, encoder, stream_sockets, ranges
+
+    def _verify_ranges(self, offered, file_size):
+        """核对接收方各区间已接收部分的摘要，返回 [偏移, 长度, 已完成]，不一致的区间从头发送
+
+        区间无效或全部不一致时返回 None，重新切分区间
+        """
+        try:
+            ranges = valid_ranges([r[:3] for r in offered], file_size)
+            digests = [r[3] for r in offered]
+        except (TypeError, IndexError, KeyError):
+            return None
+        if ranges is None:
+            return None
+        self.signals.emit('status_updated', "校验续传位置...")
+        actual = hash_ranges(self.file_path, self.hash_algorithm, [(start, done) for start, _, done in ranges])
+        for r, digest, expected in zip(ranges, actual, digests):
+            if r[2] and digest != expected:
+                logger.warning(f"接收方区间 {r[0]} 的数据与源文件不一致，重新发送这个区间")
+                r[2] = 0
+        done = sum(r[2] for r in ranges)
+        if not done:
+            return None
+        logger.info(f"并行续传，对方已接收 {format_size(done)}")
+        return ranges
+
+    def _send_delta(self, f, file_size, hasher, encoder):
+        """增量传输：变化的数据作为数据帧发送，与对方已有文件相同的块只发送复制指令"""
+        self.signals.emit('status_updated', f"增量发送: {os.path.basename(self.file_path)}")
+        bytes_done = 0
+        bytes_sent = 0
+        last_progress_update = time.time()
+        for instruction in encoder.instructions(f, file_size, hasher):
+            if not self.running:
+                break
+            if instruction[0] == 'data':
+                data = instruction[1]
+                self._send_frame(lambda: self._send_data(data))
+                bytes_done += len(data)
+                bytes_sent += len(data)
+            else:
+                _, start, count, length = instruction
+                copy = {'block': start, 'count': count}
+                self._send_frame(lambda: self.connection.send_message(MSG_FILE_COPY, copy))
+                bytes_done += length
+
+            # 降低进度更新频率
+            current_time = time.time()
+            if current_time - last_progress_update >= self._progress_update_interval:
+                self._report_progress(bytes_done, file_size)
+                last_progress_update = current_time
+
+        logger.info(f"增量传输发送了 {format_size(bytes_sent)}，文件大小 {format_size(file_size)}")
+        return bytes_done
+
+    def _should_use_parallel(self, file_size):
+        """判断是否使用多连接并行传输"""
+        # 并行连接直接发送原始数据，启用压缩时在控制连接上逐块压缩发送
+        return (self.streams > 1 and self.peer_address is not None
+                and file_size >= self._parallel_threshold and self._compressor is None)
+
+    def _split_ranges(self, file_size, count):
+        """将文件切分为若干个按对齐大小取整的字节区间"""
+        range_size = -(-file_size // count)
+        align = self._parallel_alignment
+        range_size = -(-range_size // align) * align
+        return [(offset, min(range_size, file_size - offset))
+                for offset in range(0, file_size, range_size)]
+
+    def _open_streams(self, count):
+        """为每个字节区间建立一条数据连接，任何一条失败都返回 None，改用单连接传输"""
+        stream_sockets = []
+        try:
+            for _ in range(count):
+                sock = socket.create_connection(self.peer_address, timeout=self._timeout)
+                configure_socket(sock, send_buffer=self.tuning.send_buffer)
+                stream_sockets.append(sock)
+        except Exception as e:
+            logger.warning(f"建立并行连接失败，改用单连接传输: {str(e)}")
+            for sock in stream_sockets:
+                sock.close()
+            return None
+        return stream_sockets
+
+    def _upload_parallel(self, file_name, file_size, stream_sockets, ranges):
+        """通过已建立的多条并行TCP连接把各字节区间发送到对方的监听端口
+
+        ranges 为各区间的 [偏移, 长度, 已完成]，续传时每个区间从已完成的位置继续发送
+        """
+        resumed = sum(done for _, _, done in ranges)
+        transfer_id = uuid.uuid4().hex
+        errors = []
+        digest_result = {}
+        
+        try:
+            # 通过控制连接通知对方准备接收
+            header = {
+                'type': 'parallel_file',
+                'transfer_id': transfer_id,
+                'file_name': file_name,
+                'file_size': file_size,
+                'save_path': self.save_path,
+                'hash_algorithm': self.hash_algorithm,
+                'streams': len(ranges),
+                'ranges': ranges,
+                'resume': resumed > 0,  # 对方在原有的 .part 文件上继续接收
+                'sparse': is_sparse(os.stat(self.file_path)),
+                'request_id': self.request_id
+            }
+            self._send_frame(lambda: self.connection.send_json(header))
+            
+            self._last_bytes = resumed
+            self._last_update = time.time()
+            self._parallel_sent = resumed
+            
+            # 摘要与数据发送同时进行，哈希树算法会利用多个核心
+            def compute_digest():
+                try:
+                    digest_start = time.perf_counter()
+                    if self.digest_cache is not None:
+                        digest_result['digest'] = self.digest_cache.hash_file(
+                            self.file_path, self.hash_algorithm)
+                    else:
+                        digest_result['digest'] = hash_file(self.file_path, self.hash_algorithm)
+                    self.metrics.add('hashing', time.perf_counter() - digest_start)
+                except Exception as e:
+                    errors.append(e)
+            
+            digest_thread = threading.Thread(target=compute_digest, daemon=True)
+            workers = [
+                threading.Thread(
+                    target=self._send_range,
+                    args=(sock, transfer_id, index, offset + done, length - done, errors),
+                    daemon=True
+                )
+                for index, (sock, (offset, length, done)) in enumerate(zip(stream_sockets, ranges))
+            ]
+            digest_thread.start()
+            for worker in workers:
+                worker.start()
+            
+            # 汇总各连接的进度
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(self._progress_update_interval)
+                    with self._parallel_lock:
+                        bytes_sent = self._parallel_sent
+                    self.signals.emit('progress_updated', int((bytes_sent / file_size) * 100))
+                    self._update_speed(bytes_sent)
+            digest_thread.join()
+        finally:
+            for sock in stream_sockets:
+                try:
+                    sock.close()
+                except:
+                    pass
+        
+        if errors or not self.running:
+            error = f"并行传输失败: {str(errors[0])}" if errors else "传输已取消"
+            # 告知对方不会再有数据，对方立即结束接收，不必等到超时
+            try:
+                self.connection.send_json({'type': 'parallel_abort', 'transfer_id': transfer_id, 'error': error})
+            except Exception:
+                pass
+            raise Exception(error)
+        
+        # 所有区间发送完毕后发送整体摘要
+        done = {
+            'type': 'parallel_done',
+            'transfer_id': transfer_id,
+            'digest': digest_result['digest'],
+            'mtime': os.path.getmtime(self.file_path)
+        }
+        self._send_frame(lambda: self.connection.send_json(done))
+        self._wait_verified(transfer_id)
+        
+        self.signals.emit('progress_updated', 100)
+        self._update_speed(file_size)
+        self._complete(f"已发送: {file_name}")
+        self.signals.emit('status_updated', "传输完成")
+
+    def _send_range(self, sock, transfer_id, index, offset, length, errors):
+        """在一条数据连接上发送文件的第 index 个区间中从 offset 开始的 length 字节"""
+        try:
+            hello = {
+                'transfer_id': transfer_id,
+                'range': index,
+                'offset': offset,
+                'length': length
+            }
+            FrameSocket(sock).send_message(MSG_STREAM_HELLO, hello)
+            
+            with open(self.file_path, 'rb') as f:
+                range_sent = 0
+                while range_sent < length and self.running:
+                    count = pace_size(self.rate_limiters, min(self._sendfile_slice, length - range_sent))
+                    read_ahead(f, offset + range_sent + count, count)
+                    with self.metrics.timing('throttle'):
+                        throttle(self.rate_limiters, count)
+                    with self.metrics.timing('socket_send'):
+                        sent = sock.sendfile(f, offset + range_sent, count)
+                    if sent == 0:
+                        raise Exception("文件在发送过程中被截断")
+                    range_sent += sent
+                    self.metrics.add_bytes(sent)
+                    with self._parallel_lock:
+                        self._parallel_sent += sent
+            
+            if range_sent == length:
+                # 等待接收方写完并关闭连接，保证发送完成通知晚于数据到达
+                sock.shutdown(socket.SHUT_WR)
+                sock.recv(1)
+        except Exception as e:
+            errors.append(e)
+
+    def _can_use_sendfile(self):
+        """判断是否可以使用内核 sendfile 零拷贝发送"""
+        # 压缩需要经过用户态，启用压缩时逐块读取
+        return self._use_sendfile and hasattr(os, 'sendfile') and self._compressor is None
+
+    def _send_data(self, data):
+        """发送一段文件数据，启用压缩且值得压缩时发送压缩后的数据"""
+        payload = None
+        if self._compressor:
+            with self.metrics.timing('compression'):
+                payload = self._compressor.compress(data)
+        with self.metrics.timing('throttle'):
+            throttle(self.rate_limiters, len(data) if payload is None else len(payload))
+        with self.metrics.timing('socket_send'):
+            if payload is None:
+                self.connection.send_frame(MSG_FILE_DATA, data)
+            else:
+                self.connection.send_frame(MSG_FILE_COMPRESSED, payload)
+        self.metrics.add_bytes(len(data))
+
+    def _send_with_sendfile(self, f, file_size, hasher, offset=0, source_path=None):
+        """使用 socket.sendfile 发送文件内容，数据不经过用户态缓冲区"""
+        bytes_sent = offset
+        bytes_hashed = offset
+        last_progress_update = time.time()
+        retry_count = 0
+
+        # sendfile 不经过用户态，另开一个句柄从页缓存读取刚发送的分片来计算摘要；
+        # hasher 为 None 表示摘要已知，不需要再读一遍
+        with open(source_path or self.file_path, 'rb') as hash_file:
+            hash_file.seek(offset)
+            while bytes_sent < file_size and self.running:
+                # 每个分片作为一个数据帧，帧头之后用 sendfile 发送帧负载；
+                # 分片之间释放发送锁，其他线程的控制消息可以穿插发送
+                count = pace_size(self.rate_limiters, min(self._sendfile_slice, file_size - bytes_sent))
+                frame_end = bytes_sent + count
+                # 发送这一片的同时让内核预读下一片，磁盘和网络同时工作
+                read_ahead(f, frame_end, count)
+                with self.metrics.timing('throttle'):
+                    throttle(self.rate_limiters, count)  # 在取得发送锁之前等待，不妨碍控制消息
+                send_start = time.perf_counter()
+                with self.connection.send_lock:
+                    self.connection.send_frame_header(MSG_FILE_DATA, count)
+                    while bytes_sent < frame_end:
+                        try:
+                            sent = self.socket.sendfile(f, bytes_sent, frame_end - bytes_sent)
+                        except socket.timeout:
+                            # sendfile 出错时文件位置停在实际已发送的位置
+                            bytes_sent = max(bytes_sent, f.tell())
+                            retry_count += 1
+                            self.metrics.retries += 1
+                            if retry_count > self._retry_count:
+                                raise Exception(f"发送数据超时，已重试{self._retry_count}次")
+                            time.sleep(1)
+                            continue
+                        except Exception as e:
+                            self._break_connection()  # 帧已发出一部分，连接无法继续使用
+                            raise Exception(f"发送数据时发生错误: {str(e)}")
+
+                        if sent == 0:
+                            raise Exception("文件在发送过程中被截断")
+
+                        bytes_sent += sent
+                        retry_count = 0  # 成功发送后重置重试计数
+                self.metrics.add('socket_send', time.perf_counter() - send_start)
+                self.metrics.add_bytes(count)
+
+                if hasher is not None:
+                    self._hash_sent_range(hash_file, bytes_sent - bytes_hashed, hasher)
+                bytes_hashed = bytes_sent
+
+                # 降低进度更新频率
+                current_time = time.time()
+                if current_time - last_progress_update >= self._progress_update_interval:
+                    self._report_progress(bytes_sent, file_size)
+                    last_progress_update = current_time
+
+        return bytes_sent
+
+    def _hash_sent_range(self, hash_file, length, hasher):
+        """顺序读取已发送的数据并更新摘要"""
+        buffer = self.buffer_pool.acquire(min(length, self._chunk_size))
+        view = memoryview(buffer)
+        while length > 0:
+            with self.metrics.timing('disk_read'):
+                n = hash_file.readinto(view[:min(length, len(buffer))])
+            if not n:
+                raise Exception("文件在发送过程中被截断")
+            with self.metrics.timing('hashing'):
+                hasher.update(view[:n])
+            length -= n
+        self.buffer_pool.release(buffer)
+
+    def _send_with_loop(self, f, file_size, hasher, offset=0):
+        """不支持 sendfile 或需要压缩时逐块发送
+
+        读取线程提前把文件数据读入有界队列并计算摘要，与发送同时进行，磁盘和网络都不必等待对方
+        """
+        f.seek(offset)
+        pipeline = BufferQueue(self.pipeline_depth, self.buffer_pool)
+        reader = threading.Thread(target=self._read_ahead,
+                                  args=(f, file_size - offset, hasher, pipeline), daemon=True)
+        reader.start()
+        bytes_sent = offset
+        last_progress_update = time.time()
+
+        try:
+            while self.running:
+                item = pipeline.get()
+                if item is None:
+                    break
+                buffer, n = item
+                chunk = memoryview(buffer)[:n]
+
+                try:
+                    self._send_frame(lambda: self._send_data(chunk))
+                except Exception as e:
+                    raise Exception(f"发送数据时发生错误: {str(e)}")
+                pipeline.recycle(buffer)
+                bytes_sent += n
+
+                # 降低进度更新频率
+                current_time = time.time()
+                if current_time - last_progress_update >= self._progress_update_interval:
+                    self._report_progress(bytes_sent, file_size)
+                    last_progress_update = current_time
+        finally:
+            # 发送结束或出错时让读取线程停下
+            pipeline.close(Exception("发送已结束"))
+            reader.join()
+
+        self._add_stalls(pipeline.consumer_stalls, pipeline.producer_stalls)
+        return bytes_sent
+
+    def _read_ahead(self, f, length, hasher, pipeline):
+        """读取线程：按块读入文件数据、计算摘要并放入发送队列，队列满时等待发送"""
+        try:
+            while length > 0 and self.running:
+                size = min(length, pace_size(self.rate_limiters, self._chunk_size))
+                buffer = pipeline.take_buffer(size)
+                view = memoryview(buffer)[:size]
+                with self.metrics.timing('disk_read'):
+                    n = f.readinto(view)
+                if not n:
+                    break  # 文件被截断，由调用方检查发送的字节数
+                if hasher is not None:
+                    with self.metrics.timing('hashing'):
+                        hasher.update(view[:n])
+                pipeline.put((buffer, n))
+                length -= n
+            pipeline.close()
+        except Exception as e:
+            pipeline.close(e)
+
+    def _add_stalls(self, disk_stalls, network_stalls):
+        """累计发送时等待读盘和等待网络的次数和时间"""
+        for total, stalls in ((self.disk_stalls, disk_stalls), (self.network_stalls, network_stalls)):
+            total.count += stalls.count
+            total.seconds += stalls.seconds
+
+    def _report_stalls(self, name):
+        if self.disk_stalls.count or self.network_stalls.count:
+            logger.info(f"发送 {name}: 等待读取磁盘 {self.disk_stalls}，等待网络发送 {self.network_stalls}")
+
+    def _report_progress(self, bytes_sent, file_size):
+        """发送进度，发送文件夹时按所有文件的总量计算"""
+        total_sent = self._progress_base + bytes_sent
+        total_size = self._progress_total or file_size
+        self.signals.emit('progress_updated', int((total_sent / total_size) * 100))
+        self._update_speed(total_sent)
+        self._autotune(total_sent)
+
+    def _autotune(self, total_sent):
+        """传输开始几秒后按测得的吞吐量调整块大小和发送缓冲区
+
+        限速时测到的是限速值，增量和压缩传输的发送量受计算速度限制，都不调整
+        """
+        if self._tuner is None:
+            if any(limiter.current_rate() for limiter in self.rate_limiters):
+                return
+            self._tuner = TransferTuner(self.socket, self.tuning, self.tuning_store,
+                                        sending=True, rtt_sample=self._rtt_sample)
+        if self._delta or self._compressor is not None:
+            self._tuner.cancel()
+        if self._tuner.update(total_sent, self.metrics.phases['socket_send']):
+            self._chunk_size = self.tuning.send_chunk
+
+    def _update_speed(self, total_bytes):
+        """计算实际每秒传输速度"""
+        current_time = time.time()
+        
+        # 检查是否达到更新间隔
+        if current_time - self._last_update >= self._update_interval:
+            # 计算这个间隔内传输的字节数
+            bytes_diff = total_bytes - self._last_bytes
+            time_diff = current_time - self._last_update
+            
+            if time_diff > 0:
+                # 计算实际每秒速度
+                speed = bytes_diff / time_diff
+                compressor = self._compressor
+                if compressor is not None:
+                    speed_str = format_speed(speed, compressor.raw_bytes, compressor.wire_bytes)
+                else:
+                    speed_str = format_speed(speed)
+                self.signals.emit('speed_updated', speed_str)
+            
+            # 更新记录
+            self._last_bytes = total_bytes
+            self._last_update = current_time
+
+
+class ParallelFileReceiver:
+    """并行传输的接收端，多条数据连接按各自的偏移写入同一个文件
+
+    数据先写入 .part 文件，整个文件校验通过后才改名为正式文件，已有的同名文件在此之前不受影响。
+    ranges 为各区间的 [偏移, 长度, 已完成]，给出 state_path 时定期把数据落盘并记录各区间已完成的长度，
+    中断后 resume 为 True 时在原有的 .part 文件上从各区间已完成的位置继续接收。
+    use_mmap 为 True 时把整个文件映射到内存，各连接直接接收到映射中自己的位置，不需要定位，
+    也不经过中间缓冲区；映射失败（如 32 位系统上的超大文件）或稀疏文件时改用按偏移写入。
+    文件在所有数据连接的接收线程退出后才关闭，不会有线程写入已关闭的文件句柄。
+    """
+    def __init__(self, transfer_id, file_path, file_size, hash_algorithm, signals, request_id=None,
+                 buffer_pool=None, sparse=False, use_mmap=False, peer="", session=None,
+                 ranges=None, state_path=None, checkpoint_interval=2, resume=False):
+        self.transfer_id = transfer_id
+        self.request_id = request_id
+        self.session = session  # 发起这次接收的会话，会话断开时一起结束
+        self.file_path = file_path
+        self.part_path = file_path + ".part"  # 校验通过前数据写在这里
+        self.file_size = file_size
+        self.hash_algorithm = hash_algorithm
+        self.signals = signals
+        self.ranges = [list(r) for r in ranges] if ranges else None  # 各区间的 [偏移, 长度, 已完成]
+        self.state_path = state_path if self.ranges else None  # 续传记录，None 时不记录
+        self.checkpoint_interval = checkpoint_interval  # 每隔多少秒记录一次续传位置
+        self.bytes_received = sum(r[2] for r in self.ranges) if resume and self.ranges else 0
+        self.error = None
+        self.last_activity = time.monotonic()  # 最近一次收到数据的时间，长时间没有数据时由引擎清理
+        self._last_checkpoint = time.monotonic()
+        self._checkpoint_lock = threading.Lock()  # 同一时间只有一个接收线程记录续传位置
+        self._condition = threading.Condition()
+        self._progress_update_interval = 0.2
+        self._last_progress_update = time.time()
+        self._sockets = set()  # 正在接收的数据连接
+        self._closing = False  # 不再接受新的数据连接，最后一个接收线程退出后关闭文件
+        self._closed = False
+        self.buffer_pool = buffer_pool or BufferPool()  # 各数据连接接收时使用的缓冲区
+        self.sparse = sparse  # 源文件是稀疏文件，全零的数据不写入
+        self.metrics = TransferMetrics('receive', os.path.basename(file_path), peer)  # 各数据连接共同累计
+        self.metrics.chunk_size = 262144
+        
+        # 预先分配整个文件，各区间直接写到自己的偏移；内存映射要求文件可读写
+        if resume and self.ranges:
+            self._file = open(self.part_path, 'r+b')
+            if os.fstat(self._file.fileno()).st_size != file_size:
+                self._file.close()
+                raise ValueError("续传的 .part 文件长度不符")
+        else:
+            if self.ranges:
+                for r in self.ranges:
+                    r[2] = 0
+            self._file = open(self.part_path, 'w+b')
+            preallocate(self._file, file_size, sparse)
+        self._fd = self._file.fileno()
+        self._map = None
+        if use_mmap and not sparse and file_size:
+            try:
+                self._map = mmap.mmap(self._fd, file_size)
+            except (OSError, ValueError, OverflowError) as e:
+                logger.warning(f"无法映射文件，改用普通写入: {str(e)}")
+        if self.state_path:
+            self.checkpoint()
+
+    def write_at(self, offset, data, index=None):
+        """在指定偏移写入数据，index 为数据所属的区间"""
+        with self.metrics.timing('disk_write'):
+            self._write_at(offset, data)
+        self._add_received(len(data), index)
+
+    def _write_at(self, offset, data):
+        if self.sparse and is_zero(data):
+            pass  # 文件已设置好长度，不写入的部分保持为空洞
+        elif hasattr(os, 'pwrite'):
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(self._fd, view, offset)
+                view = view[written:]
+                offset += written
+        else:
+            with self._condition:
+                self._file.seek(offset)
+                self._file.write(data)
+
+    def _add_received(self, n, index):
+        self.metrics.add_bytes(n)
+        with self._condition:
+            self.bytes_received += n
+            if index is not None:
+                self.ranges[index][2] += n
+            self.last_activity = time.monotonic()
+            self._condition.notify_all()
+            
+            current_time = time.time()
+            if current_time - self._last_progress_update >= self._progress_update_interval:
+                self._last_progress_update = current_time
+                progress = int((self.bytes_received / self.file_size) * 100)
+                self.signals.emit('progress_updated', progress)
+
+        # 定期记录续传位置，正在记录时其他接收线程不等待
+        if (self.state_path and time.monotonic() - self._last_checkpoint >= self.checkpoint_interval
+                and self._checkpoint_lock.acquire(blocking=False)):
+            try:
+                self.checkpoint()
+            finally:
+                self._checkpoint_lock.release()
+
+    def checkpoint(self):
+        """把已接收的数据落盘，然后记录各区间已完成的长度；记录不会超前于磁盘上的数据"""
+        with self._condition:
+            ranges = [list(r) for r in self.ranges]
+        try:
+            with self.metrics.timing('disk_write'):
+                if self._map is not None:
+                    self._map.flush()
+                else:
+                    with self._condition:
+                        self._file.flush()
+                os.fsync(self._fd)
+            write_resume_state(self.state_path, {
+                'file_name': os.path.basename(self.file_path),
+                'file_size': self.file_size,
+                'hash_algorithm': self.hash_algorithm,
+                'ranges': ranges
+            })
+        except Exception as e:
+            logger.warning(f"记录续传位置失败: {str(e)}")
+        self._last_checkpoint = time.monotonic()
+
+    def receive_range(self, sock, offset, length, index=None):
+        """从一条数据连接接收一个字节区间，index 为区间的序号，区间必须从已完成的位置接到区间末尾"""
+        self._enter(sock)
+        try:
+            if index is not None:
+                if self.ranges is None or not 0 <= index < len(self.ranges):
+                    raise ValueError("无效的区间序号")
+                range_offset, range_length, done = self.ranges[index]
+                if offset != range_offset + done or offset + length != range_offset + range_length:
+                    raise ValueError("数据连接的区间与传输信息不符")
+            if self._map is not None:
+                self._receive_into_map(sock, offset, length, index)
+            else:
+                self._receive_into_file(sock, offset, length, index)
+        except Exception as e:
+            self.fail(e)
+            raise
+        finally:
+            self._leave(sock)
+
+    def _receive_into_file(self, sock, offset, length, index):
+        buffer = self.buffer_pool.acquire(262144)
+        view = memoryview(buffer)
+        try:
+            position = offset
+            end = offset + length
+            while position < end:
+                with self.metrics.timing('socket_recv'):
+                    n = sock.recv_into(view[:min(len(buffer), end - position)])
+                if not n:
+                    raise ConnectionError("数据连接已断开")
+                self.write_at(position, view[:n], index)
+                position += n
+        finally:
+            self.buffer_pool.release(buffer)
+
+    def _receive_into_map(self, sock, offset, length, index):
+        """直接接收到文件映射中这个区间的位置"""
+        position = offset
+        end = offset + length
+        while position < end:
+            # 每次接收后立即释放对映射的引用，关闭映射时不会有残留的视图；
+            # 数据直接进入页缓存，写盘由内核在之后完成，不单独计时
+            with memoryview(self._map)[position:min(end, position + 262144)] as target, \
+                    self.metrics.timing('socket_recv'):
+                n = sock.recv_into(target)
+            if not n:
+                raise ConnectionError("数据连接已断开")
+            position += n
+            self._add_received(n, index)
+
+    def _enter(self, sock):
+        with self._condition:
+            if self._closing:
+                raise ConnectionError("并行接收已结束")
+            self._sockets.add(sock)
+
+    def _leave(self, sock):
+        with self._condition:
+            self._sockets.discard(sock)
+            self._condition.notify_all()
+            close_now = self._closing and not self._sockets and not self._closed
+            if close_now:
+                self._closed = True
+        if close_now:
+            self._close_file()
+
+    def fail(self, error):
+        """记录错误并唤醒等待者"""
+        with self._condition:
+            if self.error is None:
+                self.error = error
+            self._condition.notify_all()
+
+    def wait_complete(self, timeout):
+        """等待所有区间写入完成"""
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.error is not None or self.bytes_received >= self.file_size,
+                timeout
+            )
+            if self.error is not None:
+                raise Exception(f"并行接收失败: {str(self.error)}")
+            if self.bytes_received < self.file_size:
+                raise Exception("并行接收超时")
+
+    def close(self, abort=False, timeout=10):
+        """结束接收，abort 时断开各数据连接，让接收线程尽快退出
+
+        等各接收线程退出后关闭文件；timeout 秒后仍有线程在写入（如磁盘很慢）时由最后退出的线程关闭
+        """
+        with self._condition:
+            self._closing = True
+            sockets = list(self._sockets)
+        if abort:
+            for sock in sockets:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        with self._condition:
+            self._condition.wait_for(lambda: not self._sockets, timeout)
+            if self._sockets or self._closed:
+                return
+            self._closed = True
+        self._close_file()
+
+    def abort(self, error):
+        """放弃这次接收：断开数据连接并关闭文件；有续传记录时保留 .part 文件，之后可以续传"""
+        self.fail(error)
+        self.close(abort=True)
+        if not self.state_path:
+            self.discard()
+
+    def discard(self):
+        """删除 .part 文件和续传记录，用于校验失败等不能续传的情况"""
+        self.state_path = None
+        for path in (self.part_path, self.part_path + ".json"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _close_file(self):
+        if self.state_path:
+            self.checkpoint()  # 关闭前记录最终的位置
+        if self._map is not None:
+            try:
+                self._map.close()
+            except:
+                pass
+        try:
+            self._file.close()
+        except:
+            pass
+
+class ManifestReceiver:
+    """按清单顺序把连续的数据流拆分写入各个文件
+
+    数据帧可以跨越文件边界，多个小文件的内容可能在同一帧中；摘要尾部一次校验连续的若干个文件，
+    校验通过后才把 .part 文件改名为正式文件
+    """
+    def __init__(self, files, file_paths, hash_algorithm, digest_cache=None, metrics=None):
+        self.files = files  # [(相对路径, 大小, 修改时间)]
+        self.file_paths = file_paths
+        self.hash_algorithm = hash_algorithm
+        self.digest_cache = digest_cache  # 校验通过的摘要记入缓存
+        self.metrics = metrics or TransferMetrics('receive', "")  # 写盘和摘要的时间
+        self.verified = 0  # 已校验完成的文件数
+        self._next_index = 0  # 下一个开始写入的文件
+        self._current = None  # 正在写入的文件序号
+        self._file = None
+        self._hasher = None
+        self._remaining = 0
+        self._completed = {}  # 已写完、等待校验的文件摘要对象，按序号索引
+
+    def _open_next(self):
+        index = self._next_index
+        self._next_index += 1
+        size = self.files[index][1]
+        self._current = index
+        # 小文件使用默认缓冲区，避免每个文件都分配大缓冲
+        self._file = open(self.file_paths[index] + ".part", 'wb',
+                          buffering=262144 if size > 262144 else -1)
+        if size > 262144:
+            preallocate(self._file, size)  # 大文件预先分配空间，减少碎片
+        self._hasher = new_hasher(self.hash_algorithm)
+        self._remaining = size
+        if size == 0:
+            self._finish_current()
+
+    def _finish_current(self):
+        self._file.close()
+        self._file = None
+        self._completed[self._current] = self._hasher
+
+    def write(self, data):
+        """写入一段数据，按各文件的大小依次分配"""
+        view = memoryview(data)
+        pos = 0
+        while pos < len(view):
+            if self._file is None:
+                if self._next_index >= len(self.files):
+                    raise ProtocolError("文件数据超出清单声明的大小")
+                self._open_next()
+                continue
+            n = min(self._remaining, len(view) - pos)
+            chunk = view[pos:pos + n]
+            with self.metrics.timing('disk_write'):
+                self._file.write(chunk)
+            with self.metrics.timing('hashing'):
+                self._hasher.update(chunk)
+            self._remaining -= n
+            pos += n
+            if self._remaining == 0:
+                self._finish_current()
+
+    def verify(self, index, digests):
+        """校验从 index 开始的连续若干个文件，通过后改名并恢复修改时间"""
+        end = index + len(digests)
+        # 空文件没有数据帧，在校验时补建
+        while self._file is None and self._next_index < min(end, len(self.files)):
+            self._open_next()
+
+        for offset, digest in enumerate(digests):
+            current = index + offset
+            hasher = self._completed.pop(current, None)
+            if hasher is None:
+                raise ProtocolError("文件数据不完整")
+            path, _, mtime = self.files[current]
+            if hasher.hexdigest() != digest:
+                raise ValueError(f"文件校验失败，传输可能不完整: {path}")
+            full_save_path = self.file_paths[current]
+            os.replace(full_save_path + ".part", full_save_path)
+            os.utime(full_save_path, (mtime, mtime))  # 保留源文件的修改时间
+            if self.digest_cache is not None:
+                self.digest_cache.put(full_save_path, self.hash_algorithm, digest, os.stat(full_save_path))
+            self.verified += 1
+
+    def abort(self):
+        """出错时关闭并删除未完成的 .part 文件"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._completed[self._current] = None
+        for index in self._completed:
+            try:
+                os.remove(self.file_paths[index] + ".part")
+            except:
+                pass
+        self._completed.clear()
+
+class ListingCache:
+    """目录列表缓存：路径 -> (目录修改时间, 缓存时间, 目录项列表)
+
+    目录中增加、删除或重命名文件时目录的修改时间会变化，据此判断缓存是否还有效。目录项总数超过上限时
+    淘汰最久未使用的目录
+    """
+
+    def __init__(self, max_entries=500000):
+        self.max_entries = max_entries  # 所有目录的目录项总数上限
+        self._listings = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """返回 (目录修改时间, 缓存时间, 目录项列表)，没有缓存时返回 None"""
+        with self._lock:
+            listing = self._listings.get(path)
+            if listing is not None:
+                self._listings.move_to_end(path)
+            return listing
+
+    def lookup(self, path, dir_mtime, max_age):
+        """目录修改时间相同且缓存不超过 max_age 秒时返回目录项列表，否则返回 None"""
+        listing = self.get(path)
+        if listing is None or listing[0] != dir_mtime or time.time() - listing[1] > max_age:
+            return None
+        return listing[2]
+
+    def put(self, path, dir_mtime, entries):
+        with self._lock:
+            old = self._listings.pop(path, None)
+            if old is not None:
+                self._size -= len(old[2])
+            if len(entries) > self.max_entries:
+                return
+            self._listings[path] = (dir_mtime, time.time(), entries)
+            self._size += len(entries)
+            while self._size > self.max_entries:
+                _, (_, _, evicted) = self._listings.popitem(last=False)
+                self._size -= len(evicted)
+
+LISTING_FIRST_PAGE = 200  # 目录列表第一页的项数，尽快显示
+LISTING_PAGE_SIZE = 2000  # 之后每页的项数
+LISTING_PAGE_INTERVAL = 0.2  # 扫描较慢时至少每 0.2 秒发送一次已扫描的目录项
+
+def list_drives():
+    """获取本机驱动器列表，Windows 返回盘符，其他系统返回根目录"""
+    if os.name == 'nt':  # Windows系统
+        import win32api
+        drives = win32api.GetLogicalDriveStrings().split('\000')[:-1]
+        return [drive.rstrip('\\') for drive in drives if drive]  # 移除空值并去掉反斜杠
+    return ['/']  # Linux/Mac系统
+
+def scan_entries(path):
+    """用 os.scandir 逐项列出目录内容：{name, type (dir/file), size, mtime, mode}
+
+    目录项的类型来自 scandir 本身，Windows 上大小和时间也已包含在目录项中，其他系统每项只需一次 stat
+    """
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+                stat = entry.stat()
+            except OSError:
+                # 失效的符号链接等，显示链接本身
+                try:
+                    is_dir = False
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError as e:
+                    logger.warning(f"处理文件 {entry.name} 时出错: {str(e)}")
+                    continue
+            yield {
+                'name': entry.name,
+                'type': 'dir' if is_dir else 'file',
+                'size': 0 if is_dir else stat.st_size,
+                'mtime': int(stat.st_mtime),
+                'mode': stat.st_mode & 0o7777
+            }
+
+def format_size(size):
+    """格式化文件大小显示"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TB"
+
+def format_speed(speed, raw_bytes=0, wire_bytes=0):
+    """速度显示，启用压缩时附带压缩前后的数据量"""
+    speed_str = f"{speed / (1024 * 1024):.2f} MB/s"
+    if wire_bytes:
+        speed_str += f"（原始 {format_size(raw_bytes)}，传输 {format_size(wire_bytes)}）"
+    return speed_str
+
+def build_manifest(root):
+    """遍历文件夹，返回 (目录列表, 文件列表)
+
+    路径都是相对于 root、以 / 分隔的相对路径，文件项包含大小和修改时间
+    """
+    dirs = []
+    files = []
+    for current, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        relative = os.path.relpath(current, root)
+        prefix = "" if relative == "." else relative.replace(os.sep, "/") + "/"
+        dirs.extend(prefix + name for name in dir_names)
+        for name in sorted(file_names):
+            try:
+                stat = os.stat(os.path.join(current, name))
+            except Exception as e:
+                logger.warning(f"处理文件 {name} 时出错: {str(e)}")
+                continue
+            files.append({
+                'path': prefix + name,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime
+            })
+    return dirs, files
+
+def path_size(path):
+    """文件返回大小，文件夹返回其中所有文件的总大小"""
+    if os.path.isdir(path):
+        return sum(entry['size'] for entry in build_manifest(path)[1])
+    return os.path.getsize(path)
+
+def remote_join(root, relative_path):
+    """把以 / 分隔的相对路径拼接到对方的目录上，按对方路径的风格使用分隔符"""
+    if not relative_path:
+        return root
+    sep = '\\' if '\\' in root or root[1:2] == ':' else '/'
+    return root.rstrip('/\\') + sep + relative_path.replace('/', sep)
+
+def safe_join(root, relative_path):
+    """将清单中的相对路径拼接到 root 下，拒绝绝对路径和 .. 等会越出 root 的路径"""
+    parts = relative_path.split('/')
+    for part in parts:
+        if (part in ('', '.', '..') or os.sep in part or (os.altsep and os.altsep in part)
+                or os.path.splitdrive(part)[0]):
+            raise ProtocolError(f"无效的路径: {relative_path}")
+    return os.path.join(root, *parts)
+
+class TransferEngine:
+    """与界面无关的传输引擎
+
+    负责监听和连接，每条控制连接是一个 PeerSession，各自维护浏览目录、传输队列和进行中的传输，
+    多个对方可以同时连接和传输。图形界面和命令行都是它的客户端，操作的是主会话：本机主动
+    建立的连接，或者没有主动连接时最先连入的对方。状态变化通过 signals 通知，回调在引擎的
+    工作线程中执行，界面需要自行切换到主线程。
+    """
+    def __init__(self, port=5000, signals=None):
+        self.port = port
+        self.signals = signals or FileTransferSignals()
+        self.server_socket = None
+        self.sessions = []  # 所有已连接的会话
+        self.session = None  # 主会话，界面和命令行的操作都发往这个会话
+        self._sessions_lock = threading.Lock()
+        self.max_sessions = 64  # 同时服务的对方数量上限
+        self.listen_backlog = 64  # 多个对方同时连接时，等待接受的连接数
+        self.handshake_timeout = 10  # 新连接需在10秒内发送握手消息
+        self.save_dir = os.path.join(os.path.expanduser("~"), "Downloads")  # 对方未指定保存位置时使用
+        self.current_local_directory = ""  # 新会话浏览本机的初始目录，初始为空，显示所有驱动器
+        self.listing_cache = ListingCache()  # 对方浏览过的本机目录，目录没有变化时不重新扫描
+        # 目录列表、目录清单和摘要等可能很慢的磁盘操作在这里执行，不占用消息接收线程和界面线程
+        self.io_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="io")
+        self.listing_cache_ttl = 60  # 文件大小变化不会改变目录的修改时间，缓存最多使用 60 秒
+        self.hash_algorithm = DEFAULT_HASH_ALGORITHM  # 文件校验使用的摘要算法
+        self.parallel_streams = 4  # 大文件并行传输使用的连接数，设为1关闭并行传输
+        self.parallel_transfers = {}  # 所有会话正在进行的并行接收，按 transfer_id 索引
+        self.parallel_condition = threading.Condition()
+        self.parallel_idle_timeout = 120  # 并行接收超过2分钟没有收到数据时放弃，对方可能已经不再发送
+        self._parallel_watchdog = None  # 定期检查并行接收是否空闲的定时器
+        self.resume_checkpoint_interval = 2  # 接收时每2秒记录一次续传位置
+        self.offer_keepalive_interval = 30  # 准备续传信息较久时每30秒告知发送方仍在准备
+        self.transfer_retry_limit = 3  # 传输失败后自动续传的次数
+        self.batch_file_limit = 1048576  # 队列中连续的小于1MB的推送合成一批发送
+        self.batch_max_files = 1024  # 每批最多1024个文件
+        self.max_active_transfers = 4  # 每个会话同时进行的传输项数：推送一次只有一项，其余为向对方请求的拉取
+        self.prepare_ahead = 4  # 推送进行时提前在后台计算接下来几个文件的摘要
+        self.prepare_digest_limit = 67108864  # 只提前计算64MB以下的文件，发送时仍在页缓存中，不需要再读一遍磁盘
+        self.delta_transfer = True  # 已有同名文件时请发送方只发送变化的块
+        self.digest_cache = DigestCache()  # 文件摘要的磁盘缓存，与界面的历史记录一起放在用户目录下
+        self.tuning = TuningStore()  # 按对方地址记录的块大小和缓冲区，传输时自动调整
+        self.pipeline_depth = DEFAULT_PIPELINE_DEPTH  # 发送时提前读入、接收时等待写盘的最多块数
+        self.buffer_pool = BufferPool()  # 所有传输共用的数据缓冲区，空闲部分最多保留 64MB
+        self.mmap_writes = False  # 并行接收大文件时通过内存映射写入
+        self.mmap_min_size = 1073741824  # 1GB以上的文件才使用内存映射
+        self.metrics = MetricsRecorder()  # 每次传输的性能记录，追加到用户目录下的 JSON lines 文件
+        self.compression = None  # 希望使用的压缩算法列表，按优先顺序，为空时不主动压缩
+        self.sync_mtime_tolerance = 2  # 同步时修改时间相差2秒以内视为相同（FAT 文件系统的精度为2秒）
+        # 发送限速（字节/秒，None 为不限速），可以随时修改，正在进行的传输立即按新的限速发送
+        self.rate_limit = None  # 所有对方共用的总限速
+        self.rate_schedule = []  # 限速时段 [(开始分钟, 结束分钟, 限速)]，当前时刻在某个时段内时代替 rate_limit
+        self.peer_rate_limit = None  # 发送给每个对方的限速
+        self.transfer_rate_limit = None  # 每次传输的限速
+        self.rate_limiter = RateLimiter(lambda: scheduled_rate(self.rate_schedule, self.rate_limit))
+
+    @property
+    def connected(self):
+        return self.session is not None and self.session.connected
+
+    def start_server(self):
+        """开始监听对方的连接，成功返回 True"""
+        try:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.bind(('0.0.0.0', self.port))
+            self.server_socket.listen(self.listen_backlog)
+            threading.Thread(target=self.accept_connections, daemon=True).start()
+            return True
+        except Exception as e:
+            self.server_socket = None
+            self.signals.emit('error_occurred', f"启动服务器失败: {str(e)}")
+            return False
+
+    def accept_connections(self):
+        server_socket = self.server_socket
+        while self.server_socket is server_socket:
+            try:
+                client_socket, addr = server_socket.accept()
+            except Exception as e:
+                if self.server_socket is server_socket:
+                    self.signals.emit('error_occurred', str(e))
+                break
+            # 握手在单独线程中读取，慢速或异常的连接不会阻塞其他对方
+            threading.Thread(
+                target=self.handle_new_connection,
+                args=(client_socket, addr[0]),
+                daemon=True
+            ).start()
+
+    def handle_new_connection(self, client_socket, host):
+        """根据握手消息区分控制连接和并行数据连接"""
+        try:
+            client_socket.settimeout(self.handshake_timeout)
+            msg_type, hello = FrameSocket(client_socket).recv_message()
+        except Exception as e:
+            logger.warning(f"读取握手消息失败: {str(e)}")
+            client_socket.close()
+            return
+
+        if msg_type == MSG_STREAM_HELLO:
+            configure_socket(client_socket, recv_buffer=self.tuning.get(host).recv_buffer)
+            self.handle_stream_connection(client_socket, hello)
+        elif msg_type == MSG_SESSION_HELLO:
+            self.add_session(PeerSession(self, client_socket, host, is_server=True))
+        else:
+            logger.warning(f"无效的握手消息: {msg_type}")
+            client_socket.close()
+
+    def connect(self, host):
+        """连接到对方，失败时抛出异常"""
+        if self.connected:
+            raise Exception("已经连接到对方")
+        client_socket = socket.create_connection((host, self.port))
+        try:
+            FrameSocket(client_socket).send_message(MSG_SESSION_HELLO, {})
+        except Exception:
+            client_socket.close()
+            raise
+        self.add_session(PeerSession(self, client_socket, host, is_server=False))
+
+    def add_session(self, session):
+        """登记新会话并开始接收消息，超过上限时拒绝"""
+        with self._sessions_lock:
+            if len(self.sessions) >= self.max_sessions:
+                rejected = True
+            else:
+                rejected = False
+                self.sessions.append(session)
+                is_primary = self.session is None
+                if is_primary:
+                    self.session = session
+                count = len(self.sessions)
+        if rejected:
+            logger.warning(f"连接数已达上限，拒绝: {session.peer_host}")
+            session.client_socket.close()
+            return
+
+        logger.info(f"对方已连接: {session.peer_host}，当前 {count} 个连接")
+        if is_primary:
+            self.signals.emit('connection_changed', True, session.peer_host)
+        else:
+            self.signals.emit('status_updated', f"已连接 {count} 个对方")
+        session.start()
+
+    def remove_session(self, session):
+        """会话断开后移除，主会话断开时由下一个会话接替"""
+        with self._sessions_lock:
+            if session not in self.sessions:
+                return
+            self.sessions.remove(session)
+            was_primary = self.session is session
+            if was_primary:
+                self.session = self.sessions[0] if self.sessions else None
+            next_session = self.session
+            count = len(self.sessions)
+
+        logger.info(f"对方已断开: {session.peer_host}，当前 {count} 个连接")
+        if was_primary:
+            self.signals.emit('connection_changed', False, "")
+            if next_session is not None:
+                self.signals.emit('connection_changed', True, next_session.peer_host)
+        else:
+            self.signals.emit('status_updated', f"已连接 {count} 个对方")
+
+    def disconnect(self):
+        """断开主会话，停止其传输并清空其传输队列"""
+        session = self.session
+        if session is not None:
+            session.close()
+
+    def close(self):
+        """断开所有会话并停止监听"""
+        server_socket = self.server_socket
+        self.server_socket = None
+        if server_socket:
+            try:
+                server_socket.close()
+            except:
+                pass
+        with self._sessions_lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            session.close()
+        with self.parallel_condition:
+            if self._parallel_watchdog is not None:
+                self._parallel_watchdog.cancel()
+                self._parallel_watchdog = None
+        self.io_pool.shutdown(wait=False, cancel_futures=True)
+        self.metrics.close()
+
+    def require_session(self):
+        session = self.session
+        if session is None or not session.connected:
+            raise Exception("未连接到对方")
+        return session
+
+    def request_file_list(self, path=None, use_cache=True):
+        """请求对方的文件列表，path 为 None 时列出对方当前所在的目录，use_cache 为 False 时要求对方重新扫描"""
+        self.require_session().request_file_list(path, use_cache)
+
+    def list_remote(self, path=None, timeout=30):
+        """请求并等待对方的文件列表，返回 (文件列表, 对方路径)"""
+        return self.require_session().list_remote(path, timeout)
+
+    def enqueue_push(self, file_path, save_path=""):
+        """将本地文件加入主会话的传输队列，推送到对方的 save_path（为空时由对方决定）"""
+        return self.require_session().enqueue_push(file_path, save_path)
+
+    def enqueue_pull(self, remote_path, save_path="", file_size=0):
+        """将对方的文件加入主会话的传输队列，拉取到本机的 save_path"""
+        return self.require_session().enqueue_pull(remote_path, save_path, file_size)
+
+    def plan_sync(self, local_dir, remote_dir, compare_digest=False):
+        """比较本地目录与对方目录的清单，列出让对方目录与本地一致需要推送的文件
+
+        默认按大小和修改时间判断文件是否变化；compare_digest 时大小相同的文件再比较摘要，
+        修改时间不同但内容相同的文件不会重传。返回 (同步计划, 只有对方才有的文件)，
+        同步计划的每一项包含 action（新增/更新）、path（相对路径）、local_path、save_path 和 size
+        """
+        session = self.require_session()
+        if not remote_dir:
+            raise Exception("未指定对方目录")
+        local_dir = os.path.abspath(local_dir)
+        if not os.path.isdir(local_dir):
+            raise Exception(f"本地目录不存在: {local_dir}")
+        _, local_files = build_manifest(local_dir)
+        _, remote_files = session.list_remote_tree(remote_dir)
+        remote = {entry['path']: entry for entry in remote_files}
+
+        if compare_digest:
+            # 只有大小相同的文件需要对方计算摘要
+            same_size = [entry['path'] for entry in local_files
+                         if entry['path'] in remote and remote[entry['path']]['size'] == entry['size']]
+            if same_size:
+                _, remote_files = session.list_remote_tree(remote_dir, same_size, self.hash_algorithm)
+                remote = {entry['path']: entry for entry in remote_files}
+
+        plan = []
+        for entry in local_files:
+            other = remote.get(entry['path'])
+            local_path = os.path.join(local_dir, *entry['path'].split('/'))
+            if other is None:
+                action = "新增"
+            elif other['size'] != entry['size']:
+                action = "更新"
+            elif compare_digest:
+                if other.get('digest') == self.calculate_digest(local_path):
+                    continue
+                action = "更新"
+            elif abs(other['mtime'] - entry['mtime']) <= self.sync_mtime_tolerance:
+                continue
+            else:
+                action = "更新"
+            plan.append({
+                'action': action,
+                'path': entry['path'],
+                'local_path': local_path,
+                'save_path': remote_join(remote_dir, entry['path'].rpartition('/')[0]),
+                'size': entry['size']
+            })
+
+        local_paths = {entry['path'] for entry in local_files}
+        extra = [entry['path'] for entry in remote_files if entry['path'] not in local_paths]
+        return plan, extra
+
+    def wait_idle(self, timeout=None):
+        """等待主会话的传输队列清空或连接断开，超时返回 False"""
+        session = self.session
+        if session is None:
+            return True
+        return session.wait_idle(timeout)
+
+    def add_parallel_receive(self, receiver):
+        """登记并行接收，数据连接据 transfer_id 找到它"""
+        with self.parallel_condition:
+            self.parallel_transfers[receiver.transfer_id] = receiver
+            self.parallel_condition.notify_all()
+            if self._parallel_watchdog is None:
+                self._schedule_parallel_check()
+
+    def _schedule_parallel_check(self):
+        """调用方需持有 parallel_condition"""
+        self._parallel_watchdog = threading.Timer(self.parallel_idle_timeout / 4, self.check_parallel_receives)
+        self._parallel_watchdog.daemon = True
+        self._parallel_watchdog.start()
+
+    def drop_parallel_receives(self, matches, reason):
+        """移除并放弃满足 matches(接收端) 的并行接收，返回被移除的接收端"""
+        with self.parallel_condition:
+            dropped = [receiver for receiver in self.parallel_transfers.values() if matches(receiver)]
+            for receiver in dropped:
+                del self.parallel_transfers[receiver.transfer_id]
+        for receiver in dropped:
+            receiver.abort(ConnectionError(reason))
+        return dropped
+
+    def check_parallel_receives(self):
+        """清理长时间没有收到数据的并行接收，还有进行中的并行接收时继续定期检查"""
+        deadline = time.monotonic() - self.parallel_idle_timeout
+        for receiver in self.drop_parallel_receives(lambda r: r.last_activity < deadline, "并行接收超时"):
+            if receiver.session is not None:
+                receiver.session.abandon_parallel_receive(receiver, "并行接收超时")
+        with self.parallel_condition:
+            self._parallel_watchdog = None
+            if self.parallel_transfers and self.server_socket is not None:
+                self._schedule_parallel_check()
+
+    def handle_stream_connection(self, sock, hello):
+        """处理对方建立的并行数据连接"""
+        receiver = None
+        try:
+            sock.settimeout(60)
+
+            # 数据连接可能先于控制消息到达，稍等接收端就绪
+            transfer_id = hello['transfer_id']
+            with self.parallel_condition:
+                self.parallel_condition.wait_for(
+                    lambda: transfer_id in self.parallel_transfers, 10)
+                receiver = self.parallel_transfers.get(transfer_id)
+            if receiver is None:
+                raise ConnectionError("未知的并行传输")
+
+            index = hello.get('range')
+            receiver.receive_range(sock, int(hello['offset']), int(hello['length']),
+                                   None if index is None else int(index))
+        except Exception as e:
+            logger.warning(f"数据连接接收失败: {str(e)}")
+        finally:
+            try:
+                sock.close()
+            except:
+                pass
+
+    def calculate_digest(self, file_path, algorithm=None):
+        """计算文件摘要，哈希树算法会并行计算，文件没有变化时使用缓存的摘要"""
+        return self.digest_cache.hash_file(file_path, algorithm or self.hash_algorithm)
+
+class PeerSession:
+    """与一个对方之间的会话：一条控制连接及其浏览目录、传输队列和进行中的传输
+
+    每个会话在自己的线程中接收消息，会话之间互不影响；摘要算法、保存位置等设置来自引擎。
+    """
+    def __init__(self, engine, client_socket, host, is_server):
+        self.engine = engine
+        self.signals = engine.signals
+        self.client_socket = client_socket
+        self.connection = FrameSocket(client_socket, wait_on_timeout=True)  # 控制连接上的帧收发器
+        self.connected = True
+        self.is_server = is_server
+        self.peer_host = host
+        self.tuning = engine.tuning.get(host)  # 上次与这个对方传输时调整好的参数
+        configure_socket(client_socket, self.tuning.send_buffer, self.tuning.recv_buffer)
+        self._close_lock = threading.Lock()
+        self.current_local_directory = engine.current_local_directory  # 对方浏览本机时所在的目录
+        self.pending_replies = {}  # 对方针对某个传输的回复，按 transfer_id 索引
+        self.pending_receives = {}  # 已回复续传信息、等待发送方开始发送的文件，按 transfer_id 索引
+        self.reply_condition = threading.Condition()
+        # 传输队列，每项的 state 为 queued（等待）、preparing（正在提前计算摘要）、ready（已准备好）、
+        # active（传输中）或 retry（失败后等待续传），结束的项目移出队列
+        self.transfer_queue = []
+        self.queue_condition = threading.Condition()  # 保护传输队列，队列变化时通知等待者
+        self.transfer_thread = None  # 正在进行的推送
+        self.send_slot = threading.Lock()  # 控制连接上同一时间只能发送一个文件的数据，推送和响应拉取共用
+        self.rate_limiter = RateLimiter(lambda: engine.peer_rate_limit)  # 发送给这个对方的限速
+        self.retry_timer = None
+        self.last_transfer_time = time.time()
+        self.last_speed_update = time.time()
+        self.speed_update_interval = 0.5
+        self.last_bytes = 0
+        self.compression_saved = 0  # 当前接收中压缩数据节省的字节数，用于速度显示
+        self.peer_capabilities = None  # 对方支持的压缩算法等，连接建立后由对方告知
+        self.listing_id = None  # 本机最近一次请求的目录列表编号，旧请求的后续分页不再显示
+        self.serving_listing = None  # 正在发送给对方的目录列表编号，对方请求新列表时旧的停止发送
+        self.remote_listings = ListingCache(max_entries=200000)  # 最近浏览过的对方目录，再次打开时立即显示
+        self.listing_entries = []  # 正在接收的目录列表已收到的目录项
+
+    def start(self):
+        threading.Thread(target=self.receive_files, daemon=True).start()
+        # 告知对方本机可以解压的算法，以及本机是否希望压缩传输
+        try:
+            self.connection.send_json({
+                'type': 'capabilities',
+                'codecs': available_codecs(),
+                'compression': self.engine.compression or []
+            })
+        except Exception as e:
+            logger.warning(f"发送连接参数失败: {str(e)}")
+
+    def negotiated_compression(self):
+        """本次连接发送数据使用的压缩算法，任何一方启用压缩时取双方都支持的第一个算法，否则返回 None"""
+        with self.reply_condition:
+            # 对方的参数在连接建立后立即发出，通常早已到达
+            self.reply_condition.wait_for(
+                lambda: self.peer_capabilities is not None or not self.connected, 5)
+            capabilities = self.peer_capabilities or {}
+        preferred = self.engine.compression or capabilities.get('compression') or []
+        peer_codecs = capabilities.get('codecs') or []
+        for name in preferred:
+            if name in peer_codecs and name in available_codecs():
+                return name
+        return None
+
+    def close(self):
+        """断开控制连接，停止当前传输并清空传输队列"""
+        with self._close_lock:
+            if not self.connected:
+                return
+            self.connected = False
+
+        transfer_thread = self.transfer_thread
+        if transfer_thread and transfer_thread.is_alive():
+            transfer_thread.running = False
+        try:
+            self.client_socket.shutdown(socket.SHUT_RDWR)
+            self.client_socket.close()
+        except:
+            pass
+
+        # 唤醒等待对方回复的发送线程
+        with self.reply_condition:
+            self.reply_condition.notify_all()
+        if (transfer_thread and transfer_thread.is_alive()
+                and transfer_thread is not threading.current_thread()):
+            transfer_thread.join(5)
+
+        with self.queue_condition:
+            self.transfer_queue.clear()
+            self.queue_condition.notify_all()
+        if self.retry_timer is not None:
+            self.retry_timer.cancel()
+
+        self.pending_receives.clear()
+        # 对方不会再发送 parallel_done，这个会话的并行接收全部放弃
+        for receiver in self.engine.drop_parallel_receives(lambda r: r.session is self, "连接已断开"):
+            self.record_receive_metrics(receiver.metrics, False)
+
+        self.engine.remove_session(self)
+
+    def receive_files(self):
+        connection = self.connection
+        while self.connected:
+            try:
+                # 添加超时设置
+                self.client_socket.settimeout(60)  # 60秒超时
+
+                # 每个消息都是一个带类型和长度的帧，按类型分发
+                try:
+                    msg_type, payload = connection.recv_frame()
+                except ConnectionClosed:
+                    # 在两条消息之间断开是对方正常关闭连接；文件数据接收到一半时断开仍按错误报告
+                    if self.connected:
+                        logger.info("对方已关闭连接")
+                    break
+                if msg_type == MSG_JSON:
+                    message = decode_json(payload)
+                    if message.get('type') == 'resume_start':
+                        # 之后是文件数据，在接收线程中接收；接收失败时与其他消息的错误一样断开连接
+                        self.receive_file_data(message)
+                    else:
+                        self.handle_json_message(message)
+                elif msg_type == MSG_FILE_HEADER:
+                    self.handle_file_transfer(decode_json(payload))
+                elif msg_type == MSG_FOLDER_HEADER:
+                    self.handle_folder_transfer(decode_json(payload))
+                else:
+                    raise ProtocolError(f"意外的消息类型: {msg_type}")
+
+            except Exception as e:
+                # 本机主动断开时套接字已关闭，接收失败属于正常退出，不再报告
+                if self.connected:
+                    prefix = "连接错误" if isinstance(e, ConnectionError) else "接收错误"
+                    logger.warning(f"{prefix}: {str(e)}")
+                    self.signals.emit('error_occurred', str(e))
+                break
+
+        self.close()
+
+    def request_file_list(self, path=None, use_cache=True):
+        """请求对方的文件列表，path 为 None 时列出对方当前所在的目录
+
+        最近浏览过的目录先显示缓存的列表，同时请求对方确认目录是否变化，变化时再显示新的列表
+        """
+        if not self.connected:
+            raise Exception("未连接到对方")
+        logger.info("发送文件列表请求")
+        self.listing_id = uuid.uuid4().hex
+        request = {
+            'type': 'list_request',
+            'listing_id': self.listing_id
+        }
+        if not use_cache:
+            request['refresh'] = True
+        if path is not None:
+            request['path'] = path
+            cached = self.remote_listings.get(path) if use_cache else None
+            if cached is not None:
+                request['known_mtime'] = cached[0]
+                self.signals.emit('remote_files_updated', cached[2], path, True, True)
+        self.connection.send_json(request)
+
+    def list_remote(self, path=None, timeout=30):
+        """请求并等待对方的完整文件列表，返回 (目录项列表, 对方路径)"""
+        result = {'entries': []}
+        received = threading.Event()
+
+        def on_page(entries, current_path, first, done):
+            if first:
+                result['entries'] = []
+            result['entries'].extend(entries)
+            result['path'] = current_path
+            if done:
+                received.set()
+
+        self.signals.connect('remote_files_updated', on_page)
+        try:
+            self.request_file_list(path, use_cache=False)
+            if not received.wait(timeout):
+                raise Exception("等待文件列表超时")
+        finally:
+            self.signals.disconnect('remote_files_updated', on_page)
+        return result['entries'], result['path']
+
+    def send_file_list(self, current_path, listing_id=None, known_mtime=None, use_cache=True):
+        """分页发送本机目录 current_path 的列表给对方，路径为空时发送驱动器列表
+
+        目录项在扫描过程中按页发送，很大的目录也能立即显示开头的部分；对方发来新的列表请求时
+        停止发送旧的列表。对方已有的列表（known_mtime 为当时目录的修改时间）仍然有效时只回复未变化，
+        use_cache 为 False 时总是重新扫描
+        """
+        listing_cache = self.engine.listing_cache
+        dir_mtime = None
+        page = []
+        page_number = 0
+        last_sent = time.monotonic()
+
+        def send_page(done, **extra):
+            nonlocal page, page_number, last_sent
+            self.connection.send_json({
+                'type': 'file_list',
+                'listing_id': listing_id,
+                'path': current_path,
+                'dir_mtime': dir_mtime,
+                'page': page_number,
+                'entries': page,
+                'done': done,
+                **extra
+            })
+            page = []
+            page_number += 1
+            last_sent = time.monotonic()
+
+        try:
+            if not current_path:
+                # 空路径表示列出驱动器，Windows 为各个盘符，其他系统只有根目录
+                page = [{'name': drive, 'type': 'drive'} for drive in list_drives()]
+            else:
+                try:
+                    # 扫描前取目录的修改时间，扫描期间目录发生变化时缓存的列表不会被当作最新的
+                    dir_mtime = os.stat(current_path).st_mtime_ns
+                    cached = None
+                    if use_cache:
+                        cached = listing_cache.lookup(current_path, dir_mtime, self.engine.listing_cache_ttl)
+                    if cached is not None and known_mtime == dir_mtime:
+                        send_page(True, not_modified=True)
+                        logger.info(f"目录未变化: {current_path}")
+                        return
+                    scanned = [] if cached is None else None
+                    for entry in cached if cached is not None else scan_entries(current_path):
+                        if self.serving_listing != listing_id or not self.connected:
+                            logger.info(f"停止发送目录列表: {current_path}")
+                            return
+                        page.append(entry)
+                        if scanned is not None:
+                            scanned.append(entry)
+                        limit = LISTING_FIRST_PAGE if page_number == 0 else LISTING_PAGE_SIZE
+                        # 网络目录扫描较慢时，已扫描的部分也定期发送
+                        if len(page) >= limit or time.monotonic() - last_sent >= LISTING_PAGE_INTERVAL:
+                            send_page(False)
+                    if scanned is not None:
+                        listing_cache.put(current_path, dir_mtime, scanned)
+                except Exception as e:
+                    logger.warning(f"读取目录 {current_path} 失败: {str(e)}")
+                    if page_number > 0:
+                        # 已经发送了一部分，保留已发送的目录项
+                        send_page(True, error=str(e))
+                        return
+                    # 如果读取失败，返回到驱动器列表
+                    current_path = ""
+                    dir_mtime = None
+                    page = [{'name': drive, 'type': 'drive'} for drive in list_drives()]
+            send_page(True)
+            logger.info(f"文件列表已发送: {current_path}，共 {page_number} 页")
+        except Exception as e:
+            logger.warning(f"发送文件列表失败: {str(e)}")
+            self.signals.emit('warning_occurred', f"发送文件列表失败: {str(e)}")
+
+    def list_remote_tree(self, path, digest_paths=None, hash_algorithm=None, timeout=600):
+        """请求对方目录的递归清单，返回 (目录列表, 文件列表)，目录不存在时都为空
+
+        digest_paths 中的文件（相对路径）由对方同时计算摘要，放在文件项的 digest 中
+        """
+        if not self.connected:
+            raise Exception("未连接到对方")
+        request_id = uuid.uuid4().hex
+        request = {
+            'type': 'list_request',
+            'recursive': True,
+            'request_id': request_id,
+            'path': path
+        }
+        if digest_paths:
+            request['digest_paths'] = list(digest_paths)
+            request['hash_algorithm'] = hash_algorithm or self.engine.hash_algorithm
+        self.connection.send_json(request)
+        reply = self.wait_for_reply(request_id, timeout)
+        if reply.get('error'):
+            raise Exception(f"对方无法列出目录: {reply['error']}")
+        return reply.get('dirs', []), reply.get('files', [])
+
+    def send_manifest(self, msg_data):
+        """发送目录的递归清单，文件项包含相对路径、大小和修改时间"""
+        path = msg_data.get('path') or ""
+        response = {
+            'type': 'file_list',
+            'recursive': True,
+            'request_id': msg_data.get('request_id'),
+            'path': path
+        }
+        try:
+            dirs, files = build_manifest(path) if os.path.isdir(path) else ([], [])
+            digest_paths = set(msg_data.get('digest_paths') or [])
+            if digest_paths:
+                hash_algorithm = msg_data.get('hash_algorithm')
+                if not is_supported(hash_algorithm):
+                    raise ValueError(f"不支持的摘要算法: {hash_algorithm}")
+                for entry in files:
+                    if entry['path'] in digest_paths:
+                        entry['digest'] = self.engine.calculate_digest(
+                            os.path.join(path, *entry['path'].split('/')), hash_algorithm)
+            response['dirs'] = dirs
+            response['files'] = files
+        except Exception as e:
+            logger.warning(f"生成目录清单失败: {str(e)}")
+            response['error'] = str(e)
+        try:
+            self.connection.send_json(response)
+        except Exception as e:
+            logger.warning(f"发送目录清单失败: {str(e)}")
+
+    def enqueue_push(self, file_path, save_path=""):
+        """将本地文件或文件夹加入传输队列，推送到对方的 save_path（为空时由对方决定），返回传输项的路径"""
+        file_size = path_size(file_path)
+        return self.add_to_queue({
+            'file_path': file_path,
+            'save_path': save_path,
+            'size': file_size,
+            'is_file': os.path.isfile(file_path)  # 在加锁前检查，处理队列时不再访问文件系统
+        })
+
+    def enqueue_pull(self, remote_path, save_path="", file_size=0):
+        """将对方的文件或文件夹加入传输队列，拉取到本机的 save_path，返回传输项的路径"""
+        if len(remote_path) > 1:
+            remote_path = remote_path.rstrip('/\\')  # 文件夹路径末尾的分隔符会使文件名为空
+        return self.add_to_queue({
+            'file_path': remote_path,
+            'save_path': save_path or self.engine.save_dir,
+            'size': file_size,
+            'is_pull': True  # 标记这是一个拉取请求
+        })
+
+    def add_to_queue(self, file_info):
+        file_info['state'] = 'queued'
+        with self.queue_condition:
+            self.transfer_queue.append(file_info)
+        self.signals.emit('queue_item_added', file_info['file_path'], file_info['size'])
+
+        self.process_transfer_queue()
+        return file_info['file_path']
+
+    def process_transfer_queue(self):
+        """按传输窗口启动队列中的项目，并提前准备接下来要推送的文件
+
+        同一条连接上同一时间只能发送一个文件的数据，推送一次只进行一项；拉取的文件由对方发送，
+        可以同时向对方请求多项，对方发完一项立即发送下一项，不需要等待请求往返。同时进行的项目
+        不超过 engine.max_active_transfers 个。推送进行时，接下来的几个文件在后台提前计算摘要，
+        轮到它们时文件头直接带上摘要，发送过程中不再计算
+        """
+        to_start = []
+        to_prepare = []
+        with self.queue_condition:
+            if not self.connected:
+                return
+            queue = self.transfer_queue
+            now = time.time()
+            for file_info in queue:
+                if file_info['state'] == 'retry' and file_info['retry_at'] <= now:
+                    file_info['state'] = 'queued'
+
+            pushing = any(item['state'] == 'active' and not item.get('is_pull') for item in queue)
+            pulling = sum(1 for item in queue if item['state'] == 'active' and item.get('is_pull'))
+            free = self.engine.max_active_transfers - pulling - pushing
+            for index, file_info in enumerate(queue):
+                if free <= 0:
+                    break
+                if file_info['state'] == 'preparing' and not file_info.get('is_pull', False):
+                    # 推送按加入的顺序进行，前面的文件还在计算摘要时后面的推送也要等待，计算完成后再处理队列
+                    pushing = True
+                    continue
+                if file_info['state'] not in ('queued', 'ready'):
+                    continue
+                if file_info.get('is_pull', False):
+                    file_info['state'] = 'active'
+                elif not pushing:
+                    file_info['batch'] = self.collect_batch(index)
+                    for item in file_info['batch']:
+                        item['state'] = 'active'
+                    pushing = True
+                else:
+                    continue
+                to_start.append(file_info)
+                free -= 1
+
+            prepared = sum(1 for item in queue if item['state'] in ('preparing', 'ready'))
+            for file_info in queue:
+                if prepared >= self.engine.prepare_ahead:
+                    break
+                if file_info['state'] != 'queued' or file_info.get('is_pull', False):
+                    continue
+                file_info['state'] = 'preparing' if self.needs_prepare(file_info) else 'ready'
+                if file_info['state'] == 'preparing':
+                    to_prepare.append(file_info)
+                prepared += 1
+
+            retry_at = min((item['retry_at'] for item in queue if item['state'] == 'retry'), default=None)
+
+        for file_info in to_prepare:
+            self.engine.io_pool.submit(self.prepare_item, file_info)
+        for file_info in to_start:
+            self.start_transfer(file_info)
+        if retry_at is not None:
+            # 到时间后再处理等待续传的项目，其他项目不受影响
+            if self.retry_timer is not None:
+                self.retry_timer.cancel()
+            self.retry_timer = threading.Timer(max(0, retry_at - time.time()), self.process_transfer_queue)
+            self.retry_timer.daemon = True
+            self.retry_timer.start()
+
+    def needs_prepare(self, file_info):
+        """摘要可以放进缓存、又不至于太大的推送文件值得提前计算摘要，调用方需持有 queue_condition"""
+        return (self.engine.digest_cache is not None
+                and self.engine.digest_cache.min_size <= file_info['size'] <= self.engine.prepare_digest_limit
+                and file_info['is_file'])
+
+    def prepare_item(self, file_info):
+        """在后台计算即将推送的文件的摘要并存入缓存，发送时从缓存中取得"""
+        try:
+            self.engine.digest_cache.hash_file(file_info['file_path'], self.engine.hash_algorithm)
+        except Exception as e:
+            logger.warning(f"提前计算摘要失败: {str(e)}")  # 发送时照常计算
+        with self.queue_condition:
+            if file_info['state'] == 'preparing':
+                file_info['state'] = 'ready'
+        self.process_transfer_queue()
+
+    def start_transfer(self, file_info):
+        """开始一个已标记为传输中的项目"""
+        file_path = file_info['file_path']
+        try:
+            # 更新传输状态
+            for item in file_info.get('batch') or [file_info]:
+                self.signals.emit('queue_item_updated', item['file_path'], "传输中", 0)
+
+            if file_info.get('is_pull', False):
+                # 文件由对方发送，request_id 随文件信息一起返回，用来对应队列中的项目
+                file_info['request_id'] = uuid.uuid4().hex
+                request = {
+                    'type': 'pull_request',
+                    'request_id': file_info['request_id'],
+                    'file_names': [os.path.basename(file_path)],
+                    'paths': [os.path.dirname(file_path)],
+                    'save_paths': [file_info['save_path']],
+                    'hash_algorithm': self.engine.hash_algorithm,  # 由接收方指定校验算法
+                    'parallel': self.engine.server_socket is not None  # 本机在监听时对方才能建立并行连接
+                }
+                self.connection.send_json(request)
+            else:
+                # 创建并启动传输线程，多个小文件合成一批发送
+                batch_files = None
+                if len(file_info['batch']) > 1:
+                    batch_files = [item['file_path'] for item in file_info['batch']]
+                self.transfer_thread = FileTransferThread(
+                    self.connection,
+                    file_path,
+                    file_info['save_path'],
+                    signals=self.forward_signals(
+                        [item['file_path'] for item in file_info['batch']],
+                        lambda success, msg: self.finish_transfer(file_info, success, msg)
+                    ),
+                    hash_algorithm=self.engine.hash_algorithm,
+                    streams=self.engine.parallel_streams,
+                    peer_address=self.get_peer_address(),
+                    wait_reply=self.wait_for_reply,
+                    batch_files=batch_files,
+                    compression=self.negotiated_compression,
+                    digest_cache=self.engine.digest_cache,
+                    send_slot=self.send_slot,
+                    rate_limiters=self.rate_limiters(),
+                    tuning=self.tuning,
+                    tuning_store=self.engine.tuning,
+                    pipeline_depth=self.engine.pipeline_depth,
+                    buffer_pool=self.engine.buffer_pool,
+                    metrics_recorder=self.engine.metrics,
+                    retries=file_info.get('retries', 0)
+                )
+                self.transfer_thread.start()
+
+        except Exception as e:
+            self.finish_transfer(file_info, False, str(e))
+
+    def rate_limiters(self):
+        """一次发送使用的限速器：全局、这个对方和这次传输各一个"""
+        engine = self.engine
+        return [engine.rate_limiter, self.rate_limiter, RateLimiter(lambda: engine.transfer_rate_limit)]
+
+    def is_batchable(self, file_info):
+        """可以和相邻项目合成一批发送的小文件推送"""
+        return (not file_info.get('is_pull', False)
+                and file_info['size'] < self.engine.batch_file_limit
+                and file_info['is_file'])
+
+    def collect_batch(self, start):
+        """从第 start 项开始收集可以合成一批发送的小文件，中间的拉取项跳过，调用方需持有 queue_condition"""
+        head = self.transfer_queue[start]
+        if not self.is_batchable(head):
+            return [head]
+        batch = [head]
+        names = {os.path.basename(head['file_path'])}
+        for file_info in self.transfer_queue[start + 1:]:
+            if len(batch) >= self.engine.batch_max_files:
+                break
+            if file_info.get('is_pull', False):
+                continue
+            # 同一批文件保存到同一个目录，同名文件留给下一批，避免互相覆盖
+            name = os.path.basename(file_info['file_path'])
+            if (file_info['state'] not in ('queued', 'ready') or not self.is_batchable(file_info)
+                    or file_info['save_path'] != head['save_path'] or name in names):
+                break
+            batch.append(file_info)
+            names.add(name)
+        return batch
+
+    def forward_signals(self, file_paths, on_finished):
+        """为一次发送创建信号处理器，进度转发为各传输项的更新，结束时调用 on_finished(是否成功, 消息)"""
+        signals = FileTransferSignals()
+
+        def on_transfer_complete(msg):
+            self.signals.emit('transfer_completed', msg)
+            on_finished(True, msg)
+
+        def on_transfer_error(msg):
+            on_finished(False, msg)
+
+        # 进度更新处理
+        def on_progress_update(progress):
+            for file_path in file_paths:
+                self.signals.emit('queue_item_updated', file_path, None, progress)
+            self.signals.emit('progress_updated', progress)
+
+        # 连接信号到新的处理器
+        signals.connect('transfer_completed', on_transfer_complete)
+        signals.connect('error_occurred', on_transfer_error)
+        signals.connect('progress_updated', on_progress_update)
+        signals.connect('speed_updated', lambda speed: self.signals.emit('speed_updated', speed))
+        signals.connect('status_updated', lambda status: self.signals.emit('status_updated', status))
+        return signals
+
+    def finish_transfer(self, file_info, success, message=""):
+        """传输项结束：成功时移出队列；失败时还有重试次数则稍后从中断处续传，否则移出队列
+
+        一批小文件整批一起完成或失败；等待续传期间队列中的其他项目照常进行
+        """
+        with self.queue_condition:
+            if file_info['state'] != 'active' or not any(item is file_info for item in self.transfer_queue):
+                return  # 连接断开时队列已被清空
+            items = file_info.get('batch') or [file_info]
+            if success:
+                status = "完成"
+            else:
+                file_info['retries'] = file_info.get('retries', 0) + 1
+                if self.connected and file_info['retries'] <= self.engine.transfer_retry_limit:
+                    status = "等待续传"
+                else:
+                    status = "失败"
+
+        # 先通知结果再移出队列，等待队列清空的调用方能看到最后一项的结果
+        for item in items:
+            self.signals.emit('queue_item_updated', item['file_path'], status, 100 if success else None)
+        with self.queue_condition:
+            if status == "等待续传":
+                for item in items:
+                    item['state'] = 'retry'
+                    item['retry_at'] = time.time() + 1
+            else:
+                finished = {id(item) for item in items}
+                self.transfer_queue[:] = [item for item in self.transfer_queue if id(item) not in finished]
+            self.queue_condition.notify_all()
+
+        if not success:
+            self.signals.emit('warning_occurred', f"传输错误: {message}")
+        self.process_transfer_queue()
+
+    def find_pull_request(self, request_id):
+        """查找正在等待对方发送的拉取项"""
+        if not request_id:
+            return None
+        with self.queue_condition:
+            for file_info in self.transfer_queue:
+                if file_info['state'] == 'active' and file_info.get('request_id') == request_id:
+                    return file_info
+        return None
+
+    def pull_retries(self, request_id):
+        """本机拉取的传输项被队列重新安排的次数，计入接收的性能记录"""
+        file_info = self.find_pull_request(request_id)
+        return file_info.get('retries', 0) if file_info is not None else 0
+
+    def finish_pull_request(self, request_id, success, message=""):
+        file_info = self.find_pull_request(request_id)
+        if file_info is not None:
+            self.finish_transfer(file_info, success, message)
+
+    def wait_idle(self, timeout=None):
+        """等待传输队列清空或连接断开，超时返回 False"""
+        with self.queue_condition:
+            return self.queue_condition.wait_for(
+                lambda: not self.connected or not self.transfer_queue,
+                timeout
+            )
+
+    def handle_json_message(self, msg_data):
+        """处理JSON格式的消息"""
+        try:
+            if msg_data['type'] == 'list_request' and msg_data.get('recursive'):
+                # 递归清单需要遍历整个目录，可能还要计算摘要，放到后台线程中避免阻塞消息接收
+                logger.info(f"收到目录清单请求: {msg_data.get('path')}")
+                self.engine.io_pool.submit(self.send_manifest, msg_data)
+            elif msg_data['type'] == 'list_request':
+                logger.info("收到文件列表请求")
+                path = msg_data.get('path')
+                if path is not None:
+                    self.current_local_directory = path
+                # 很大的目录需要扫描较长时间，放到后台线程中分页发送
+                listing_id = msg_data.get('listing_id')
+                self.serving_listing = listing_id
+                self.engine.io_pool.submit(self.send_file_list, self.current_local_directory, listing_id,
+                                           msg_data.get('known_mtime'), not msg_data.get('refresh'))
+            elif msg_data['type'] == 'file_list' and msg_data.get('recursive'):
+                with self.reply_condition:
+                    self.pending_replies[msg_data['request_id']] = msg_data
+                    self.reply_condition.notify_all()
+            elif msg_data['type'] == 'file_list':
+                if msg_data.get('listing_id') != self.listing_id:
+                    return  # 已经请求了其他目录，忽略旧列表剩余的分页
+                if msg_data.get('not_modified'):
+                    logger.info(f"对方目录未变化: {msg_data.get('path')}")
+                    return  # 已经显示了缓存的列表
+                entries = msg_data.get('entries', [])
+                logger.info(f"收到文件列表第 {msg_data.get('page', 0) + 1} 页: {len(entries)} 项")
+                if msg_data.get('page', 0) == 0:
+                    self.listing_entries = []
+                self.listing_entries.extend(entries)
+                if msg_data.get('done', True) and not msg_data.get('error'):
+                    self.remote_listings.put(msg_data.get('path', ''), msg_data.get('dir_mtime'), self.listing_entries)
+                self.signals.emit('remote_files_updated', entries, msg_data.get('path', ''),
+                                  msg_data.get('page', 0) == 0, msg_data.get('done', True))
+            elif msg_data['type'] == 'pull_request':
+                logger.info(f"收到文件拉取请求: {msg_data}")
+                self.handle_pull_request(msg_data)
+            elif msg_data['type'] == 'pull_failed':
+                logger.warning(f"对方无法发送文件: {msg_data.get('error')}")
+                self.finish_pull_request(msg_data.get('request_id'), False, msg_data.get('error', ''))
+            elif msg_data['type'] == 'capabilities':
+                logger.info(f"对方支持的压缩算法: {msg_data.get('codecs')}")
+                with self.reply_condition:
+                    self.peer_capabilities = msg_data
+                    self.reply_condition.notify_all()
+            elif msg_data['type'] in ('resume_offer', 'transfer_verified'):
+                with self.reply_condition:
+                    self.pending_replies[msg_data['transfer_id']] = msg_data
+                    self.reply_condition.notify_all()
+            elif msg_data['type'] == 'parallel_file':
+                logger.info(f"收到并行传输请求: {msg_data}")
+                self.start_parallel_receive(msg_data)
+            elif msg_data['type'] == 'parallel_abort':
+                # 发送方的并行传输失败，不会再有数据，立即结束接收
+                for receiver in self.engine.drop_parallel_receives(
+                        lambda r: r.transfer_id == msg_data.get('transfer_id') and r.session is self,
+                        "对方已放弃发送"):
+                    self.abandon_parallel_receive(receiver, msg_data.get('error') or "对方已放弃发送")
+            elif msg_data['type'] == 'parallel_done':
+                # 校验需要读完整个文件，放到单独线程中避免阻塞消息接收
+                threading.Thread(
+                    target=self.finish_parallel_receive,
+                    args=(msg_data,),
+                    daemon=True
+                ).start()
+        except Exception as e:
+            logger.warning(f"处理JSON消息失败: {str(e)}")
+            self.signals.emit('error_occurred', str(e))
+
+    def handle_pull_request(self, msg_data):
+        """处理文件拉取请求，请求的文件在后台线程中依次发送"""
+        request_id = msg_data.get('request_id')
+        try:
+            file_names = msg_data['file_names']
+            paths = msg_data.get('paths', [])
+            save_paths = msg_data.get('save_paths', [])
+
+            if not paths:
+                raise Exception("无效的文件路径")
+
+            # 使用拉取方指定的摘要算法，不支持时退回本机默认算法
+            hash_algorithm = msg_data.get('hash_algorithm', self.engine.hash_algorithm)
+            if not is_supported(hash_algorithm):
+                hash_algorithm = self.engine.hash_algorithm
+            # 拉取方没有监听端口时只能使用控制连接
+            streams = self.engine.parallel_streams if msg_data.get('parallel', True) else 1
+
+            transfers = []
+            for file_name, path, save_path in zip(file_names, paths, save_paths):
+                file_path = os.path.join(path, file_name)
+                if not os.path.exists(file_path):
+                    raise Exception(f"文件 {file_name} 不存在")
+                transfers.append((file_path, save_path))
+        except Exception as e:
+            logger.warning(f"处理拉取请求失败: {str(e)}")
+            self.signals.emit('warning_occurred', f"处理拉取请求失败: {str(e)}")
+            # 通知拉取方，避免对方一直等待
+            try:
+                self.connection.send_json({
+                    'type': 'pull_failed',
+                    'request_id': request_id,
+                    'error': str(e)
+                })
+            except Exception as send_error:
+                logger.warning(f"发送拉取失败通知失败: {str(send_error)}")
+            return
+
+        threading.Thread(
+            target=self.serve_pull_request,
+            args=(request_id, transfers, hash_algorithm, streams),
+            daemon=True
+        ).start()
+
+    def serve_pull_request(self, request_id, transfers, hash_algorithm, streams):
+        """依次发送被拉取的文件，与本机的推送和其他拉取请求轮流使用连接"""
+        for file_path, save_path in transfers:
+            if not self.connected:
+                break
+
+            # 添加到传输列表
+            self.signals.emit('queue_item_added', file_path, path_size(file_path))
+            self.signals.emit('queue_item_updated', file_path, "传输中", 0)
+
+            def on_finished(success, msg, file_path=file_path):
+                self.signals.emit('queue_item_updated', file_path, "完成" if success else "失败",
+                                  100 if success else None)
+                if not success:
+                    self.signals.emit('warning_occurred', f"传输错误: {msg}")
+
+            transfer = FileTransferThread(
+                self.connection,
+                file_path,
+                save_path,
+                signals=self.forward_signals([file_path], on_finished),
+                hash_algorithm=hash_algorithm,
+                streams=streams,
+                peer_address=self.get_peer_address(),
+                wait_reply=self.wait_for_reply,
+                request_id=request_id,
+                compression=self.negotiated_compression,
+                digest_cache=self.engine.digest_cache,
+                send_slot=self.send_slot,
+                rate_limiters=self.rate_limiters(),
+                tuning=self.tuning,
+                tuning_store=self.engine.tuning,
+                pipeline_depth=self.engine.pipeline_depth,
+                buffer_pool=self.engine.buffer_pool,
+                metrics_recorder=self.engine.metrics
+            )
+            transfer.run()
+
+    def handle_file_transfer(self, header):
+        """收到文件信息：在后台线程中核对已接收部分、计算块签名后回复发送方
+
+        这些计算可能需要读完整个已有文件，放在接收线程中会阻塞这个连接上的所有消息；
+        发送方随后的 resume_start 由 receive_file_data 在接收线程中处理
+        """
+        request_id = header.get('request_id')  # 本机拉取的文件带有拉取请求的编号
+        try:
+            # 解析文件信息
+            try:
+                receive = {
+                    'file_name': os.path.basename(header['file_name']),
+                    'file_size': int(header['file_size']),
+                    'save_path': header.get('save_path', '') or self.engine.save_dir,
+                    'hash_algorithm': header['hash_algorithm'],
+                    'transfer_id': header['transfer_id'],
+                    'request_id': request_id,
+                    'allow_delta': bool(header.get('delta', False)),
+                    'mtime': None if header.get('mtime') is None else float(header['mtime']),
+                    'expected_digest': header.get('digest'),  # 发送方缓存中已有的摘要
+                    'sparse': bool(header.get('sparse', False))  # 源文件是稀疏文件
+                }
+            except (KeyError, TypeError, ValueError):
+                raise ValueError("无效的文件信息格式")
+            if not is_supported(receive['hash_algorithm']):
+                raise ValueError(f"不支持的摘要算法: {receive['hash_algorithm']}")
+
+            save_path = receive['save_path']
+            logger.info(f"保存文件到: {save_path}")
+            self.signals.emit('status_updated', f"正在接收: {receive['file_name']}")
+
+            # 创建保存目录，数据先写入 .part 文件，校验通过后再改名
+            os.makedirs(save_path, exist_ok=True)
+            receive['full_save_path'] = safe_join(save_path, receive['file_name'])
+            receive['part_path'] = receive['full_save_path'] + ".part"
+            receive['state_path'] = receive['part_path'] + ".json"
+        except Exception as e:
+            logger.warning(f"文件接收失败: {str(e)}")
+            self.signals.emit('error_occurred', f"文件接收失败: {str(e)}")
+            self.finish_pull_request(request_id, False, str(e))
+            raise
+
+        self.pending_receives[receive['transfer_id']] = receive
+        self.engine.io_pool.submit(self.send_file_offer, receive)
+
+    def send_file_offer(self, receive):
+        """在后台线程中准备并发送续传、增量传输的回复；计算较久时定期告知发送方仍在准备，发送方不会超时"""
+        transfer_id = receive['transfer_id']
+        done = threading.Event()
+        send_lock = threading.Lock()  # 最终回复发出后不再发送“仍在准备”
+
+        def keepalive():
+            while not done.wait(self.engine.offer_keepalive_interval):
+                with send_lock:
+                    if done.is_set():
+                        return
+                    try:
+                        self.connection.send_json({'type': 'resume_offer', 'transfer_id': transfer_id,
+                                                   'pending': True})
+                    except Exception:
+                        return
+
+        threading.Thread(target=keepalive, daemon=True).start()
+        try:
+            offer = self.build_file_offer(receive)
+        except Exception as e:
+            offer = {'type': 'resume_offer', 'transfer_id': transfer_id, 'error': str(e)}
+            logger.warning(f"文件接收失败: {str(e)}")
+            self.signals.emit('error_occurred', f"文件接收失败: {str(e)}")
+            self.finish_pull_request(receive['request_id'], False, str(e))
+        if offer.get('identical') or offer.get('error'):
+            self.pending_receives.pop(transfer_id, None)  # 发送方不会再发送这个文件的数据
+        with send_lock:
+            done.set()
+            try:
+                self.connection.send_json(offer)
+            except Exception as e:
+                if self.connected:
+                    logger.warning(f"发送续传信息失败: {str(e)}")
+
+    def build_file_offer(self, receive):
+        """核对上次中断留下的 .part 文件、已有的同名文件和磁盘空间，返回给发送方的回复"""
+        file_name = receive['file_name']
+        file_size = receive['file_size']
+        hash_algorithm = receive['hash_algorithm']
+        transfer_id = receive['transfer_id']
+        full_save_path = receive['full_save_path']
+        part_path = receive['part_path']
+        mtime = receive['mtime']
+        expected_digest = receive['expected_digest']
+        # 同一文件之前未完成的并行接收不会再有数据，先结束它再使用 .part 文件
+        self.engine.drop_parallel_receives(lambda r: r.file_path == full_save_path, "同一文件开始了新的传输")
+
+        # 检查上次中断留下的 .part 文件，计算已接收部分的摘要供发送方核对
+        hasher = new_hasher(hash_algorithm)
+        offset = self.load_resume_offset(part_path, receive['state_path'], file_size, hash_algorithm)
+        if offset:
+            self.signals.emit('status_updated', f"校验已接收部分: {file_name}")
+            hash_range(part_path, hasher, 0, offset)
+        receive['offset'] = offset
+        receive['hasher'] = hasher
+        # 并行传输中断留下的 .part 文件：计算各区间已接收部分的摘要，发送方核对后从各区间中断处继续
+        ranges = None
+        if not offset:
+            ranges = self.load_parallel_state(part_path, receive['state_path'], file_size, hash_algorithm)
+        if ranges:
+            self.signals.emit('status_updated', f"校验已接收部分: {file_name}")
+            digests = hash_ranges(part_path, hash_algorithm, [(start, done) for start, _, done in ranges])
+            ranges = [r + [digest] for r, digest in zip(ranges, digests)]
+        # 已有文件与发送方的摘要相同（按本机缓存判断）时不需要传输
+        if (expected_digest and not offset and not ranges and os.path.isfile(full_save_path)
+                and os.path.getsize(full_save_path) == file_size
+                and self.engine.digest_cache.get(full_save_path, hash_algorithm) == expected_digest):
+            if mtime is not None:
+                os.utime(full_save_path, (mtime, mtime))  # 保留源文件的修改时间
+                self.engine.digest_cache.put(full_save_path, hash_algorithm, expected_digest,
+                                             os.stat(full_save_path))
+            logger.info(f"已有相同文件: {full_save_path}")
+            self.signals.emit('transfer_completed', f"已有相同文件: {file_name}")
+            self.finish_pull_request(receive['request_id'], True)
+            return {'type': 'resume_offer', 'transfer_id': transfer_id, 'identical': True}
+
+        # 磁盘空间不够时告知发送方，不必传到最后才失败；稀疏文件实际占用的空间无法预知，不检查，
+        # 并行续传的 .part 文件已经分配了整个文件的空间
+        if not receive['sparse'] and not ranges:
+            try:
+                check_free_space(receive['save_path'], file_size - offset)
+            except OSError as e:
+                raise Exception(e.strerror or str(e))
+
+        offer = {
+            'type': 'resume_offer',
+            'transfer_id': transfer_id,
+            'offset': offset,
+            'prefix_digest': hasher.hexdigest()
+        }
+        if ranges:
+            offer['ranges'] = ranges
+
+        # 没有可续传的部分但已有同名文件时，发送已有文件的块签名，对方只需发送变化的数据
+        receive['basis_size'] = 0
+        if (not offset and not ranges and receive['allow_delta'] and self.engine.delta_transfer
+                and os.path.isfile(full_save_path)):
+            receive['basis_size'] = os.path.getsize(full_save_path)
+        if receive['basis_size']:
+            self.signals.emit('status_updated', f"计算已有文件的块签名: {file_name}")
+            receive['block_size'] = block_size_for(receive['basis_size'])
+            offer['delta'] = {
+                'block_size': receive['block_size'],
+                'basis_size': receive['basis_size'],
+                'signatures': file_signatures(full_save_path, receive['block_size'])
+            }
+        return offer
+
+    def receive_file_data(self, start):
+        """发送方核对续传信息后开始发送数据：在接收线程中接收、写入并校验文件"""
+        receive = self.pending_receives.pop(start.get('transfer_id'), None)
+        if receive is None:
+            raise ProtocolError("无效的续传响应")
+        file_name = receive['file_name']
+        file_size = receive['file_size']
+        hash_algorithm = receive['hash_algorithm']
+        transfer_id = receive['transfer_id']
+        request_id = receive['request_id']
+        full_save_path = receive['full_save_path']
+        part_path = receive['part_path']
+        state_path = receive['state_path']
+        mtime = receive['mtime']
+        sparse = receive['sparse']
+        offset = receive['offset']
+        hasher = receive['hasher']
+        basis_size = receive['basis_size']
+        block_size = receive.get('block_size')
+        keep_partial = True
+        reply_pending = False  # 发送方已发完数据，正在等待校验结果
+        metrics = None
+        try:
+            if start.get('parallel'):
+                # 发送方改用并行连接重新发送这个文件
+                logger.info(f"改为并行接收: {file_name}")
+                return
+            # 发送方核对摘要后决定实际的起始位置，不一致时从头开始
+            if start['offset'] != offset:
+                offset = 0
+                hasher = new_hasher(hash_algorithm)
+            basis = None
+            if start.get('delta') and basis_size:
+                logger.info(f"增量接收: {file_name}")
+                self.signals.emit('status_updated', f"增量接收: {file_name}")
+                basis = open(full_save_path, 'rb')
+            elif offset:
+                logger.info(f"从 {format_size(offset)} 处续传: {file_name}")
+                self.signals.emit('status_updated', f"续传: {file_name}")
+            else:
+                self.signals.emit('status_updated', f"正在接收: {file_name}")
+
+            # 接收文件内容，边接收边计算摘要，避免接收完成后再读一遍文件；
+            # 写盘和摘要在写入线程中进行，与接收同时进行
+            metrics = TransferMetrics('receive', file_name, self.peer_host)
+            metrics.retries = self.pull_retries(request_id)
+            self.last_transfer_time = time.time()
+            with open(part_path, 'r+b' if offset else 'wb', buffering=262144) as f:
+                # 先截掉续传位置之后的旧数据，再预先分配整个文件；稀疏文件跳过的部分因此保持为空洞
+                f.truncate(offset)
+                preallocate(f, file_size, sparse)
+                f.seek(offset)
+                bytes_received = offset
+                bytes_written = offset  # 写入线程已写入的位置，续传记录以它为准
+                last_checkpoint = time.time()
+                last_progress_update = time.time()
+                self.compression_saved = 0
+                self.save_resume_state(state_path, file_name, file_size, hash_algorithm, offset)
+                tuner = TransferTuner(self.client_socket, self.tuning, self.engine.tuning, sending=False)
+                if basis is not None:
+                    tuner.cancel()  # 增量传输时接收量不反映网络吞吐量
+                writer = WriteBehind(self.engine.pipeline_depth, self.engine.buffer_pool)
+
+                def written(n):
+                    # 在写入线程中执行：定期记录已写入磁盘的位置，中断后可以从这里续传
+                    nonlocal bytes_written, last_checkpoint
+                    bytes_written += n
+                    if time.time() - last_checkpoint >= self.engine.resume_checkpoint_interval:
+                        # 数据落盘后才记录位置，断电后续传记录不会超前于磁盘上的数据
+                        f.flush()
+                        os.fsync(f.fileno())
+                        self.save_resume_state(state_path, file_name, file_size,
+                                               hash_algorithm, bytes_written)
+                        last_checkpoint = time.time()
+
+                def write(data):
+                    with metrics.timing('hashing'):
+                        hasher.update(data)
+                    with metrics.timing('disk_write'):
+                        if sparse and is_zero(data):
+                            f.seek(len(data), os.SEEK_CUR)  # 全零的数据不写入，保持为空洞
+                        else:
+                            f.write(data)
+                    written(len(data))
+
+                def copy(block, count):
+                    # 从已有文件复制的块在本机读写，不计入传输的字节数
+                    with metrics.timing('disk_write'):
+                        written(copy_blocks(basis, basis_size, block_size, block, count, f, hasher))
+
+                try:
+                    while bytes_received < file_size:
+                        try:
+                            # 文件数据按帧到达，帧之间可能穿插对方的控制消息
+                            with metrics.timing('socket_recv'):
+                                msg_type, length = self.next_transfer_frame()
+                            if msg_type == MSG_FILE_COPY and basis is not None:
+                                # 增量传输中与已有文件相同的块，直接从已有文件复制
+                                block, count = int(length['block']), int(length['count'])
+                                bytes_received += blocks_length(basis_size, block_size, block, count)
+                                if bytes_received > file_size:
+                                    raise ProtocolError("文件数据超出声明的大小")
+                                writer.submit(copy, block, count)
+                            elif msg_type == MSG_FILE_COMPRESSED:
+                                tuner.cancel()  # 压缩传输时接收量受对方压缩速度限制
+                                data = self.recv_compressed(length, metrics, file_size - bytes_received)
+                                if bytes_received + len(data) > file_size:
+                                    raise ProtocolError("文件数据超出声明的大小")
+                                writer.submit(write, data)
+                                bytes_received += len(data)
+                                metrics.add_bytes(len(data))
+                            elif msg_type != MSG_FILE_DATA:
+                                raise ProtocolError("文件数据不完整")
+                            elif bytes_received + length > file_size:
+                                raise ProtocolError("文件数据超出声明的大小")
+
+                            while msg_type == MSG_FILE_DATA and length > 0:
+                                n = min(length, self.tuning.recv_chunk)
+                                buffer = writer.take_buffer(n)
+                                view = memoryview(buffer)[:n]
+                                with metrics.timing('socket_recv'):
+                                    self.connection.recv_into_exact(view)
+                                writer.submit(write, view, buffer=buffer)
+                                bytes_received += n
+                                length -= n
+                                metrics.add_bytes(n)
+
+                            # 降低进度更新频率
+                            current_time = time.time()
+                            if current_time - last_progress_update >= 0.2:
+                                progress = int((bytes_received / file_size) * 100)
+                                self.signals.emit('progress_updated', progress)
+                                self.report_pull_progress(request_id, progress)
+                                self.calculate_speed(bytes_received)
+                                last_progress_update = current_time
+                                tuner.update(bytes_received)
+                        except ProtocolError:
+                            raise
+                        except Exception as e:
+                            raise ConnectionError(f"接收数据失败: {str(e)}")
+                    try:
+                        writer.finish()
+                    except Exception as e:
+                        raise ConnectionError(f"写入文件失败: {str(e)}")
+                finally:
+                    # 出错时已收到的数据仍然写完，续传时不必重新接收
+                    writer.close()
+                    if basis is not None:
+                        basis.close()
+                    f.flush()
+                    os.fsync(f.fileno())
+                    self.save_resume_state(state_path, file_name, file_size,
+                                           hash_algorithm, bytes_written)
+                self.report_receive_stalls(file_name, writer)
+                disk_stalls, network_stalls = writer.stalls()
+                metrics.stalls = {'disk': disk_stalls.seconds, 'network': network_stalls.seconds}
+
+            # 读取发送方在数据之后追加的摘要并校验
+            msg_type, trailer = self.next_transfer_frame()
+            if msg_type != MSG_FILE_TRAILER or trailer.get('transfer_id') != transfer_id:
+                raise ProtocolError("缺少文件摘要")
+            reply_pending = True
+            digest = hasher.hexdigest()
+            if digest != trailer.get('digest'):
+                keep_partial = False
+                raise ValueError("文件校验失败，传输可能不完整")
+
+            os.replace(part_path, full_save_path)
+            os.remove(state_path)
+            if mtime is not None:
+                os.utime(full_save_path, (mtime, mtime))  # 保留源文件的修改时间
+            # 记录刚校验过的摘要，这个文件再发送给其他对方时不需要重新计算
+            self.engine.digest_cache.put(full_save_path, hash_algorithm, digest, os.stat(full_save_path))
+            reply_pending = False
+            self.send_verify_result(transfer_id)
+
+            self.record_receive_metrics(metrics, True)
+            self.signals.emit('transfer_completed', f"已接收: {file_name}")
+            self.signals.emit('speed_updated', "0 MB/s")
+            self.finish_pull_request(request_id, True)
+
+            if not self.is_server:
+                logger.info("文件接收完成，请求更新文件列表")
+                self.request_file_list()
+
+        except Exception as e:
+            self.record_receive_metrics(metrics, False)
+            logger.warning(f"文件接收失败: {str(e)}")
+            self.signals.emit('error_occurred', f"文件接收失败: {str(e)}")
+            self.finish_pull_request(request_id, False, str(e))
+            # 保留 .part 文件以便续传，校验失败时才删除
+            if not keep_partial:
+                for path in (part_path, state_path):
+                    if os.path.exists(path):
+                        try:
+                            os.remove(path)
+                        except:
+                            pass
+            if reply_pending:
+                # 数据已经完整读完，连接仍然可用，把失败告知等待结果的发送方
+                self.send_verify_result(transfer_id, str(e))
+                return
+            raise
+
+    def send_verify_result(self, transfer_id, error=None):
+        """告知发送方文件是否校验通过并已保存，发送方据此把传输记为成功或失败"""
+        reply = {'type': 'transfer_verified', 'transfer_id': transfer_id, 'ok': error is None}
+        if error is not None:
+            reply['error'] = error
+        try:
+            self.connection.send_json(reply)
+        except Exception as e:
+            if self.connected:
+                logger.warning(f"发送校验结果失败: {str(e)}")
+
+    def handle_folder_transfer(self, header):
+        """接收文件夹或一批文件：按清单一次建好目录结构，然后依次接收各文件"""
+        request_id = header.get('request_id')  # 本机拉取的文件夹带有拉取请求的编号
+        receiver = None
+        writer = None
+        metrics = None
+        reply_pending = False  # 发送方已发完数据，正在等待校验结果
+        try:
+            # 解析文件夹清单
+            try:
+                folder_name = os.path.basename(header['folder_name'])
+                save_path = header.get('save_path', '') or self.engine.save_dir
+                hash_algorithm = header['hash_algorithm']
+                transfer_id = header['transfer_id']
+                dirs = list(header['dirs'])
+                files = [(str(entry['path']), int(entry['size']), float(entry['mtime']))
+                         for entry in header['files']]
+            except (KeyError, TypeError, ValueError):
+                raise ValueError("无效的文件夹清单格式")
+            if not is_supported(hash_algorithm):
+                raise ValueError(f"不支持的摘要算法: {hash_algorithm}")
+
+            # 清单中的路径先全部检查，确保不会写到保存目录之外；文件夹名为空表示一批文件
+            root = safe_join(save_path, folder_name) if folder_name else save_path
+            dir_paths = [safe_join(root, path) for path in dirs]
+            file_paths = [safe_join(root, path) for path, _, _ in files]
+
+            logger.info(f"保存文件到: {root}")
+            os.makedirs(save_path, exist_ok=True)
+            check_free_space(save_path, sum(size for _, size, _ in files))
+            if folder_name:
+                self.signals.emit('status_updated', f"正在接收文件夹: {folder_name}")
+            else:
+                self.signals.emit('status_updated', f"正在接收 {len(files)} 个文件")
+            os.makedirs(root, exist_ok=True)
+            for dir_path in dir_paths:
+                os.makedirs(dir_path, exist_ok=True)
+
+            # 数据帧是各文件内容按清单顺序拼接成的连续数据流，摘要尾部校验已写完的文件
+            metrics = TransferMetrics('receive', folder_name or f"{len(files)} 个文件", self.peer_host)
+            metrics.retries = self.pull_retries(request_id)
+            receiver = ManifestReceiver(files, file_paths, hash_algorithm, self.engine.digest_cache, metrics)
+            total_size = sum(size for _, size, _ in files)
+            total_received = 0
+            last_progress_update = time.time()
+            self.compression_saved = 0
+            tuner = TransferTuner(self.client_socket, self.tuning, self.engine.tuning, sending=False)
+            # 写入、摘要和校验都在写入线程中按顺序进行，与接收同时进行
+            writer = WriteBehind(self.engine.pipeline_depth, self.engine.buffer_pool)
+            trailer_count = 0  # 已收到摘要尾部的文件数
+            self.last_transfer_time = time.time()
+            while trailer_count < len(files):
+                with metrics.timing('socket_recv'):
+                    msg_type, frame = self.next_transfer_frame()
+                if msg_type == MSG_FILE_DATA:
+                    length = frame
+                    while length > 0:
+                        n = min(length, self.tuning.recv_chunk)
+                        buffer = writer.take_buffer(n)
+                        view = memoryview(buffer)[:n]
+                        with metrics.timing('socket_recv'):
+                            self.connection.recv_into_exact(view)
+                        writer.submit(receiver.write, view, buffer=buffer)
+                        total_received += n
+                        length -= n
+                        metrics.add_bytes(n)
+                elif msg_type == MSG_FILE_COMPRESSED:
+                    tuner.cancel()  # 压缩传输时接收量受对方压缩速度限制
+                    data = self.recv_compressed(frame, metrics, total_size - total_received)
+                    writer.submit(receiver.write, data)
+                    total_received += len(data)
+                    metrics.add_bytes(len(data))
+                elif msg_type == MSG_FILE_TRAILER and frame.get('transfer_id') == transfer_id:
+                    digests = list(frame['digests'])
+                    writer.submit(receiver.verify, int(frame['index']), digests)
+                    trailer_count += len(digests)
+                else:
+                    raise ProtocolError("文件数据不完整")
+
+                # 降低进度更新频率
+                current_time = time.time()
+                if total_size and current_time - last_progress_update >= 0.2:
+                    progress = int((total_received / total_size) * 100)
+                    self.signals.emit('progress_updated', progress)
+                    self.report_pull_progress(request_id, progress)
+                    self.calculate_speed(total_received)
+                    last_progress_update = current_time
+                    tuner.update(total_received)
+            reply_pending = True
+            writer.finish()
+            self.report_receive_stalls(folder_name or f"{len(files)} 个文件", writer)
+            disk_stalls, network_stalls = writer.stalls()
+            metrics.stalls = {'disk': disk_stalls.seconds, 'network': network_stalls.seconds}
+            reply_pending = False
+            self.send_verify_result(transfer_id)
+            self.record_receive_metrics(metrics, True)
+
+            if folder_name:
+                self.signals.emit('transfer_completed', f"已接收文件夹: {folder_name}（{len(files)} 个文件）")
+            else:
+                self.signals.emit('transfer_completed', f"已接收 {len(files)} 个文件")
+            self.signals.emit('speed_updated', "0 MB/s")
+            self.finish_pull_request(request_id, True)
+
+            if not self.is_server:
+                logger.info("文件接收完成，请求更新文件列表")
+                self.request_file_list()
+
+        except Exception as e:
+            self.record_receive_metrics(metrics, False)
+            logger.warning(f"文件夹接收失败: {str(e)}")
+            self.signals.emit('error_occurred', f"文件夹接收失败: {str(e)}")
+            self.finish_pull_request(request_id, False, str(e))
+            if writer is not None:
+                writer.close()
+            if receiver is not None:
+                receiver.abort()
+            if reply_pending:
+                self.send_verify_result(transfer_id, str(e))
+                return
+            raise
+
+    def record_receive_metrics(self, metrics, ok):
+        """补全接收的性能记录并交给引擎汇总，没有开始接收数据时 metrics 为 None"""
+        if metrics is None or metrics.wall_time is not None:
+            return
+        if metrics.chunk_size is None:
+            metrics.chunk_size = self.tuning.recv_chunk
+        metrics.finish(ok)
+        self.engine.metrics.record(metrics)
+
+    def report_receive_stalls(self, name, writer):
+        """输出接收时等待写盘和等待网络的统计，用于判断瓶颈在哪一方"""
+        disk_stalls, network_stalls = writer.stalls()
+        if disk_stalls.count or network_stalls.count:
+            logger.info(f"接收 {name}: 等待写入磁盘 {disk_stalls}，等待网络接收 {network_stalls}")
+
+    def report_pull_progress(self, request_id, progress):
+        """本机拉取的文件接收进度转发为传输项的更新"""
+        file_info = self.find_pull_request(request_id)
+        if file_info is not None:
+            self.signals.emit('queue_item_updated', file_info['file_path'], None, progress)
+
+    def next_transfer_frame(self):
+        """文件接收过程中读取下一个帧
+
+        数据帧和压缩数据帧只读取帧头，返回 (类型, 负载长度)，由调用方读取负载；
+        增量复制指令和摘要尾部返回 (类型, 消息)；其他控制消息照常处理后继续等待
+        """
+        while True:
+            msg_type, length = self.connection.recv_frame_header()
+            if msg_type in (MSG_FILE_DATA, MSG_FILE_COMPRESSED):
+                return msg_type, length
+
+            message = decode_json(self.connection.recv_exact(length))
+            if msg_type in (MSG_FILE_TRAILER, MSG_FILE_COPY):
+                return msg_type, message
+            if msg_type != MSG_JSON:
+                raise ProtocolError(f"文件接收过程中收到意外的消息类型: {msg_type}")
+            self.handle_json_message(message)
+
+    def recv_compressed(self, length, metrics, remaining):
+        """读取并解压一个压缩数据帧，记录节省的字节数；压缩数据读入池中的缓冲区，解压后立即还回
+
+        解压后的长度不超过 remaining（还未收到的数据量）和单帧上限，不按对方声明的长度分配内存
+        """
+        buffer = self.engine.buffer_pool.acquire(length)
+        payload = memoryview(buffer)[:length]
+        with metrics.timing('socket_recv'):
+            self.connection.recv_into_exact(payload)
+        try:
+            with metrics.timing('compression'):
+                data = decompress_payload(payload, min(remaining, MAX_FRAME_SIZE))
+        except Exception as e:
+            raise ProtocolError(f"无法解压数据: {str(e)}")
+        finally:
+            self.engine.buffer_pool.release(buffer)
+        self.compression_saved += len(data) - length
+        return data
+
+    def load_resume_offset(self, part_path, state_path, file_size, hash_algorithm):
+        """读取续传记录，返回可以续传的起始位置"""
+        try:
+            if not os.path.exists(part_path) or not os.path.exists(state_path):
+                return 0
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get('file_size') != file_size or state.get('hash_algorithm') != hash_algorithm:
+                return 0
+            # .part 文件已预先分配到完整大小，长度不能说明数据是否落盘；记录只在 fsync 之后写入，
+            # 续传前发送方还会核对这一段的摘要
+            offset = int(state.get('offset', 0))
+            if offset <= 0 or offset > file_size:
+                return 0
+            return offset
+        except Exception as e:
+            logger.warning(f"读取续传记录失败: {str(e)}")
+            return 0
+
+    def load_parallel_state(self, part_path, state_path, file_size, hash_algorithm):
+        """读取并行传输中断时的续传记录，返回各区间的 [偏移, 长度, 已完成]，没有可续传的部分时返回 None"""
+        try:
+            if not os.path.exists(part_path) or not os.path.exists(state_path):
+                return None
+            with open(state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get('file_size') != file_size or state.get('hash_algorithm') != hash_algorithm:
+                return None
+            ranges = valid_ranges(state.get('ranges') or [], file_size)
+            if ranges is None or not any(done for _, _, done in ranges):
+                return None
+            if os.path.getsize(part_path) != file_size:
+                return None
+            return ranges
+        except Exception as e:
+            logger.warning(f"读取续传记录失败: {str(e)}")
+            return None
+
+    def save_resume_state(self, state_path, file_name, file_size, hash_algorithm, offset):
+        """记录已写入 .part 文件的位置"""
+        write_resume_state(state_path, {
+            'file_name': file_name,
+            'file_size': file_size,
+            'hash_algorithm': hash_algorithm,
+            'offset': offset
+        })
+
+    def start_parallel_receive(self, msg_data):
+        """准备接收并行传输的文件"""
+        try:
+            hash_algorithm = msg_data['hash_algorithm']
+            if not is_supported(hash_algorithm):
+                raise ValueError(f"不支持的摘要算法: {hash_algorithm}")
+
+            # 只取文件名，并拒绝 .. 等名称，确保不会写到保存目录之外
+            file_name = os.path.basename(msg_data['file_name'])
+            save_path = msg_data.get('save_path') or self.engine.save_dir
+            full_save_path = safe_join(save_path, file_name)
+            os.makedirs(save_path, exist_ok=True)
+            file_size = int(msg_data['file_size'])
+            sparse = bool(msg_data.get('sparse', False))
+            ranges = msg_data.get('ranges')
+            if ranges is not None:
+                ranges = valid_ranges(ranges, file_size)
+                if ranges is None:
+                    raise ValueError("无效的并行区间")
+            resume = bool(msg_data.get('resume')) and ranges is not None
+            if not sparse and not resume:
+                check_free_space(save_path, file_size)
+
+            logger.info(f"保存文件到: {save_path}")
+            self.signals.emit('status_updated', f"正在接收: {file_name}")
+
+            # 同一文件之前未完成的并行接收不会再有数据，先结束它，避免两次接收写同一个 .part 文件
+            self.engine.drop_parallel_receives(lambda r: r.file_path == full_save_path, "同一文件开始了新的传输")
+            receiver = ParallelFileReceiver(
+                msg_data['transfer_id'],
+                full_save_path,
+                file_size,
+                hash_algorithm,
+                self.signals,
+                request_id=msg_data.get('request_id'),
+                buffer_pool=self.engine.buffer_pool,
+                sparse=sparse,
+                use_mmap=self.engine.mmap_writes and file_size >= self.engine.mmap_min_size,
+                peer=self.peer_host,
+                session=self,
+                ranges=ranges,
+                state_path=full_save_path + ".part.json",
+                checkpoint_interval=self.engine.resume_checkpoint_interval,
+                resume=resume
+            )
+            if resume:
+                logger.info(f"并行续传: {file_name}，已接收 {format_size(receiver.bytes_received)}")
+            receiver.metrics.retries = self.pull_retries(receiver.request_id)
+            self.engine.add_parallel_receive(receiver)
+        except Exception as e:
+            logger.warning(f"准备并行接收失败: {str(e)}")
+            self.signals.emit('error_occurred', f"文件接收失败: {str(e)}")
+            self.finish_pull_request(msg_data.get('request_id'), False, str(e))
+
+    def finish_parallel_receive(self, msg_data):
+        """所有区间发送完毕后校验整个文件，通过后把 .part 文件改为正式文件"""
+        with self.engine.parallel_condition:
+            receiver = self.engine.parallel_transfers.pop(msg_data['transfer_id'], None)
+        if receiver is None:
+            self.send_verify_result(msg_data['transfer_id'], "未知的并行传输")
+            return
+
+        file_name = os.path.basename(receiver.file_path)
+        try:
+            receiver.wait_complete(timeout=60)
+            receiver.close()
+
+            # 所有区间到齐后统一校验一次
+            self.signals.emit('status_updated', f"正在校验: {file_name}")
+            with receiver.metrics.timing('hashing'):
+                digest = hash_file(receiver.part_path, receiver.hash_algorithm)
+            if digest != msg_data['digest']:
+                receiver.discard()  # 数据有误，不能在此基础上续传
+                raise ValueError("文件校验失败，传输可能不完整")
+            os.replace(receiver.part_path, receiver.file_path)
+            receiver.discard()  # 删除续传记录
+            if msg_data.get('mtime') is not None:
+                mtime = float(msg_data['mtime'])
+                os.utime(receiver.file_path, (mtime, mtime))  # 保留源文件的修改时间
+            self.engine.digest_cache.put(receiver.file_path, receiver.hash_algorithm,
+                                         msg_data['digest'], os.stat(receiver.file_path))
+            self.send_verify_result(receiver.transfer_id)
+
+            self.record_receive_metrics(receiver.metrics, True)
+            self.signals.emit('transfer_completed', f"已接收: {file_name}")
+            self.signals.emit('speed_updated', "0 MB/s")
+            self.finish_pull_request(receiver.request_id, True)
+
+            if not self.is_server:
+                logger.info("文件接收完成，请求更新文件列表")
+                self.request_file_list()
+        except Exception as e:
+            receiver.abort(e)
+            self.abandon_parallel_receive(receiver, str(e))
+            self.send_verify_result(receiver.transfer_id, str(e))
+
+    def abandon_parallel_receive(self, receiver, message):
+        """并行接收失败或被放弃后通知界面和拉取队列"""
+        self.record_receive_metrics(receiver.metrics, False)
+        logger.warning(f"文件接收失败: {message}")
+        self.signals.emit('error_occurred', f"文件接收失败: {message}")
+        self.finish_pull_request(receiver.request_id, False, message)
+
+    def wait_for_reply(self, transfer_id, timeout):
+        """等待对方针对某个传输的回复消息"""
+        with self.reply_condition:
+            self.reply_condition.wait_for(
+                lambda: transfer_id in self.pending_replies or not self.connected,
+                timeout
+            )
+            reply = self.pending_replies.pop(transfer_id, None)
+        if reply is None:
+            raise Exception("等待对方响应超时")
+        return reply
+
+    def get_peer_address(self):
+        """获取对方的监听地址，用于建立并行数据连接"""
+        try:
+            return (self.client_socket.getpeername()[0], self.engine.port)
+        except Exception:
+            return None
+
+    def calculate_speed(self, total_bytes):
+        """计算实际每秒传输速度"""
+        current_time = time.time()
+
+        # 检查是否达到更新间隔
+        if current_time - self.last_speed_update >= self.speed_update_interval:
+            # 计算这个间隔内传输的字节数
+            bytes_diff = total_bytes - self.last_bytes
+            time_diff = current_time - self.last_speed_update
+
+            if time_diff > 0:
+                # 计算实际每秒速度，收到过压缩数据时附带压缩前后的数据量
+                speed = bytes_diff / time_diff
+                if self.compression_saved:
+                    speed_str = format_speed(speed, total_bytes, total_bytes - self.compression_saved)
+                else:
+                    speed_str = format_speed(speed)
+                self.signals.emit('speed_updated', speed_str)
+
+            # 更新记录
+            self.last_bytes = total_bytes
+            self.last_speed_update = current_time
@@ -1,38 +1,16 @@
 import os
 import socket
-import threading
-import json
-import time
-import hashlib
 import customtkinter as ctk
 from tkinter import ttk
 import sys
 from PIL import Image
 import io
-import re
+import queue
+import time
+from engine import TransferEngine, format_size, list_drives, scan_entries
+from virtual_list import VirtualList
+from ratelimit import parse_rate
 
-class FileTransferSignals:
-    """自定义信号类"""
-    def __init__(self):
-        self._callbacks = {
-            'progress_updated': [],
-            'transfer_completed': [],
-            'error_occurred': [],
-            'remote_files_updated': [],
-            'speed_updated': [],
-            'status_updated': []  # 添加状态更新信号
-        }
-    
-    def connect(self, signal, callback):
-        """连接信号到回调函数"""
-        if signal in self._callbacks:
-            self._callbacks[signal].append(callback)
-    
-    def emit(self, signal, *args):
-        """发送信号"""
-        if signal in self._callbacks:
-            for callback in self._callbacks[signal]:
-                callback(*args)
 
 def get_resource_path(relative_path):
     """获取资源文件的绝对路径"""
@@ -44,241 +22,37 @@ def get_resource_path(relative_path):
     
     return os.path.join(base_path, relative_path)
 
-class FileTransferThread(threading.Thread):
-    """文件传输线程"""
-    def __init__(self, socket, file_path, save_path, is_upload=True, signals=None):
-        super().__init__()
-        self.socket = socket
-        self.file_path = file_path
-        self.save_path = save_path
-        self.is_upload = is_upload
-        self.running = True
-        self.signals = signals or FileTransferSignals()
-        self._last_time = time.time()
-        self._last_update = time.time()
-        self._update_interval = 0.5
-        self._last_bytes = 0
-        self._chunk_size = 262144  # 256KB的块大小
-        self._progress_update_interval = 0.2
-        self._timeout = 30  # 30秒超时
-        self._retry_count = 3  # 最大重试次数
-
-    def _handle_timeout(self, operation):
-        """处理超时情况"""
-        retry_count = 0
-        last_error = None
-        
-        while retry_count < self._retry_count and self.running:
-            try:
-                return operation()
-            except socket.timeout as e:
-                retry_count += 1
-                last_error = e
-                if retry_count >= self._retry_count:
-                    break
-                time.sleep(1)  # 等待1秒后重试
-            except socket.error as e:
-                retry_count += 1
-                last_error = e
-                if retry_count >= self._retry_count:
-                    break
-                time.sleep(1)
-                
-        if last_error:
-            raise Exception(f"操作失败，已重试{self._retry_count}次: {str(last_error)}")
-        return None
-
-    def run(self):
-        try:
-            if self.is_upload:
-                self._upload_file()
-            else:
-                self._download_file()
-        except Exception as e:
-            self.signals.emit('error_occurred', str(e))
+ENTRY_TYPES = {'drive': (0, "驱动器"), 'dir': (1, "文件夹"), 'file': (2, "文件")}  # 目录项类型 -> (排序顺序, 显示名称)
 
-    def _upload_file(self):
-        try:
-            file_size = os.path.getsize(self.file_path)
-            file_name = os.path.basename(self.file_path)
-            
-            self.signals.emit('status_updated', f"正在发送: {file_name}")
-            self.signals.emit('status_updated', "计算文件MD5...")
-            md5_value = self._calculate_md5()
+def entry_values(entry):
+    """文件列表中一行显示的类型、名称和大小"""
+    label = ENTRY_TYPES.get(entry['type'], (3, entry['type']))[1]
+    if entry['type'] == 'drive':
+        return (label, entry['name'].rstrip('\\'), "")
+    size = format_size(entry['size']) if entry['type'] == 'file' else ""
+    return (label, entry['name'], size)
 
-            # 发送文件信息
-            header = f"{file_name}|{file_size}|{self.save_path}|{md5_value}<<END>>"
-            self._handle_timeout(lambda: self.socket.sendall(header.encode()))
-
-            # 优化socket配置
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1048576)  # 1MB发送缓冲区
-            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            self.socket.settimeout(self._timeout)
-            
-            # 发送文件内容
-            bytes_sent = 0
-            last_progress_update = time.time()
-            self._last_bytes = 0
-            self._last_update = time.time()
-            retry_count = 0
-            
-            with open(self.file_path, 'rb') as f:
-                while bytes_sent < file_size and self.running:
-                    try:
-                        chunk = f.read(self._chunk_size)
-                        if not chunk:
-                            break
-                            
-                        def send_chunk():
-                            self.socket.sendall(chunk)
-                            return len(chunk)
-                            
-                        sent = self._handle_timeout(send_chunk)
-                        if sent is None:
-                            # 如果发送失败，尝试重试
-                            retry_count += 1
-                            if retry_count > self._retry_count:
-                                raise Exception(f"发送数据失败，已重试{self._retry_count}次")
-                            time.sleep(1)  # 等待1秒后重试
-                            continue
-                            
-                        bytes_sent += sent
-                        retry_count = 0  # 成功发送后重置重试计数
-                        
-                        # 降低进度更新频率
-                        current_time = time.time()
-                        if current_time - last_progress_update >= self._progress_update_interval:
-                            progress = int((bytes_sent / file_size) * 100)
-                            self.signals.emit('progress_updated', progress)
-                            self._update_speed(bytes_sent)
-                            last_progress_update = current_time
-                            
-                        # 每发送一定量的数据后暂停一下，防止发送过快
-                        if bytes_sent % (self._chunk_size * 32) == 0:
-                            time.sleep(0.001)
-                            
-                    except socket.timeout:
-                        retry_count += 1
-                        if retry_count > self._retry_count:
-                            raise Exception(f"发送数据超时，已重试{self._retry_count}次")
-                        time.sleep(1)
-                        continue
-                    except Exception as e:
-                        raise Exception(f"发送数据时发生错误: {str(e)}")
-
-            if bytes_sent == file_size:
-                self.signals.emit('progress_updated', 100)
-                self._update_speed(bytes_sent)
-                self.signals.emit('transfer_completed', f"已发送: {file_name}")
-                self.signals.emit('status_updated', "传输完成")
-            else:
-                raise Exception("传输未完成")
-            
-        except Exception as e:
-            self.signals.emit('error_occurred', f"上传失败: {str(e)}")
-            self.signals.emit('status_updated', "传输失败")
-        finally:
-            self.running = False
-
-    def _calculate_md5(self):
-        md5_hash = hashlib.md5()
-        with open(self.file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                md5_hash.update(chunk)
-        return md5_hash.hexdigest()
-
-    def _update_speed(self, total_bytes):
-        """计算实际每秒传输速度"""
-        current_time = time.time()
-        
-        # 检查是否达到更新间隔
-        if current_time - self._last_update >= self._update_interval:
-            # 计算这个间隔内传输的字节数
-            bytes_diff = total_bytes - self._last_bytes
-            time_diff = current_time - self._last_update
-            
-            if time_diff > 0:
-                # 计算实际每秒速度
-                speed = bytes_diff / time_diff
-                speed_mb = speed / (1024 * 1024)
-                speed_str = f"{speed_mb:.2f} MB/s"
-                self.signals.emit('speed_updated', speed_str)
-            
-            # 更新记录
-            self._last_bytes = total_bytes
-            self._last_update = current_time
-
-    def _download_file(self):
-        """处理文件下载"""
-        try:
-            if not os.path.exists(self.file_path):
-                raise Exception("文件不存在")
-            
-            file_size = os.path.getsize(self.file_path)
-            file_name = os.path.basename(self.file_path)
-            
-            self.signals.emit('status_updated', f"正在下载: {file_name}")
-            
-            # 创建保存目录
-            os.makedirs(self.save_path, exist_ok=True)
-            save_file_path = os.path.join(self.save_path, file_name)
-            
-            # 优化socket配置
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 524288)
-            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            
-            with open(save_file_path, 'wb', buffering=262144) as f:
-                bytes_received = 0
-                last_progress_update = time.time()
-                self._last_bytes = 0
-                self._last_update = time.time()
-                
-                while bytes_received < file_size and self.running:
-                    chunk = self.socket.recv(min(262144, file_size - bytes_received))
-                    if not chunk:
-                        break
-                    
-                    f.write(chunk)
-                    bytes_received += len(chunk)
-                    
-                    # 更新进度
-                    current_time = time.time()
-                    if current_time - last_progress_update >= self._progress_update_interval:
-                        progress = int((bytes_received / file_size) * 100)
-                        self.signals.emit('progress_updated', progress)
-                        self._update_speed(bytes_received)
-                        last_progress_update = current_time
-                
-                if bytes_received == file_size:
-                    self.signals.emit('progress_updated', 100)
-                    self._update_speed(bytes_received)
-                    self.signals.emit('transfer_completed', f"已下载: {file_name}")
-                    self.signals.emit('status_updated', "下载完成")
-                else:
-                    raise Exception("下载未完成")
-                
-        except Exception as e:
-            self.signals.emit('error_occurred', f"下载失败: {str(e)}")
-            self.signals.emit('status_updated', "下载失败")
+def entry_sort_keys(entry):
+    """类型、名称、大小三列的排序键；按类型排序时同类再按名称排列"""
+    name = entry['name'].casefold()
+    return ((ENTRY_TYPES.get(entry['type'], (3,))[0], name), name, entry.get('size', 0))
 
 class FileTransferWindow(ctk.CTk):
     def __init__(self, port=5000):
         super().__init__()
         self.port = port
-        self.signals = FileTransferSignals()
-        self.client_socket = None
-        self.connected = False
-        self.is_server = True
+        # 连接、协议和传输队列都由引擎处理，窗口只负责显示和操作
+        self.engine = TransferEngine(port=port)
+        self.signals = self.engine.signals
         self.save_dir = os.path.join(os.path.expanduser("~"), "Downloads")
-        self.remote_files = []
-        self.buffer = ""
+        self.remote_files = []  # 对方当前目录的目录项
+        self.remote_history = []  # 浏览过的远程目录，用于后退和前进
+        self.remote_history_index = -1  # 当前目录在浏览历史中的位置
         self.current_remote_directory = ""  # 初始为空，显示所有驱动器
         self.current_local_directory = ""   # 初始为空，显示所有驱动器
-        self.last_transfer_time = time.time()
-        self.transfer_thread = None
-        self.last_speed_update = time.time()
-        self.speed_update_interval = 0.5
-        self.last_bytes = 0
+        self.local_listing_serial = 0  # 本地目录读取请求的序号，只显示最近一次请求的结果
+        # 其他线程的回调和后台磁盘操作的结果都放入这个队列，由界面线程定时取出执行
+        self.ui_queue = queue.Queue()
         
         # IP 历史记录
         self.ip_history = []
@@ -298,12 +72,11 @@ class FileTransferWindow(ctk.CTk):
             print(f"设置图标失败: {str(e)}")
             
         self.setup_ui()  # 先设置UI
+        self.poll_ui_queue()
         
         # 在UI设置完成后，再进行其他初始化
         self.after(100, self.post_init)  # 使用after延迟执行其他初始化操作
 
-        self.transfer_queue = []
-        self.is_transferring = False
         self.transfer_items = {}  # 用于存储传输项的字典
 
     def post_init(self):
@@ -315,11 +88,11 @@ class FileTransferWindow(ctk.CTk):
             # 更新本地文件列表显示所有驱动器
             self.update_local_files("")
             
-            # 启动服务器
-            self.start_server()
-            
-            # 设置信号连接
+            # 设置信号连接，需在启动服务器之前完成，以免错过连接通知
             self.setup_signals()
+            
+            # 启动服务器
+            self.engine.start_server()
         except Exception as e:
             print(f"初始化失败: {str(e)}")
 
@@ -358,6 +131,12 @@ class FileTransferWindow(ctk.CTk):
         self.error_label = ctk.CTkLabel(status_frame, text="", text_color="red")
         self.error_label.pack(side="left", padx=10)
         
+        # 发送限速，可以在传输过程中修改
+        self.rate_limit_entry = ctk.CTkEntry(status_frame, width=90, placeholder_text="不限速")
+        self.rate_limit_entry.pack(side="right", padx=5)
+        self.rate_limit_entry.bind("<Return>", lambda event: self.apply_rate_limit())
+        ctk.CTkLabel(status_frame, text="发送限速 (如 10M):").pack(side="right")
+        
         # 文件浏览区域
         browser_frame = ctk.CTkFrame(self)
         browser_frame.pack(fill="both", expand=True, padx=10, pady=5)
@@ -387,6 +166,10 @@ class FileTransferWindow(ctk.CTk):
         )
         self.local_back_btn.pack(side="left", padx=5)
         
+        self.local_filter = ctk.CTkEntry(local_nav, width=120, placeholder_text="筛选")
+        self.local_filter.pack(side="right", padx=5)
+        self.local_filter.bind("<KeyRelease>", lambda event: self.local_view.set_filter(self.local_filter.get()))
+        
         self.current_local_path = ctk.CTkLabel(local_nav, text="")
         self.current_local_path.pack(side="left", padx=5)
         
@@ -409,9 +192,9 @@ class FileTransferWindow(ctk.CTk):
             yscrollcommand=local_scrollbar_y.set,
             xscrollcommand=local_scrollbar_x.set
         )
-        self.local_list.heading("type", text="类型", command=lambda: self.treeview_sort_column(self.local_list, "type", False))
-        self.local_list.heading("name", text="名称", command=lambda: self.treeview_sort_column(self.local_list, "name", False))
-        self.local_list.heading("size", text="大小", command=lambda: self.treeview_sort_column(self.local_list, "size", False))
+        self.local_list.heading("type", text="类型", command=lambda: self.local_view.sort_by("type"))
+        self.local_list.heading("name", text="名称", command=lambda: self.local_view.sort_by("name"))
+        self.local_list.heading("size", text="大小", command=lambda: self.local_view.sort_by("size"))
         
         # 设置列宽
         self.local_list.column("type", width=80, minwidth=60)
@@ -421,8 +204,8 @@ class FileTransferWindow(ctk.CTk):
         self.local_list.pack(fill="both", expand=True)
         self.local_list.bind("<Double-1>", self.local_item_double_clicked)
         
-        # 配置滚动条
-        local_scrollbar_y.config(command=self.local_list.yview)
+        # 配置滚动条，纵向滚动由列表模型处理，表格中只有可见的行
+        self.local_view = VirtualList(self.local_list, local_scrollbar_y, entry_values, entry_sort_keys)
         local_scrollbar_x.config(command=self.local_list.xview)
         
         # 添加本地刷新按钮
@@ -470,6 +253,22 @@ class FileTransferWindow(ctk.CTk):
         self.remote_drive_combo.pack(side="left", padx=5)
         self.remote_drive_combo.set("选择驱动器")  # 设置默认提示文本
         
+        self.remote_back_btn = ctk.CTkButton(
+            remote_nav,
+            text="←",
+            width=30,
+            command=self.remote_go_back
+        )
+        self.remote_back_btn.pack(side="left", padx=(5, 0))
+        
+        self.remote_forward_btn = ctk.CTkButton(
+            remote_nav,
+            text="→",
+            width=30,
+            command=self.remote_go_forward
+        )
+        self.remote_forward_btn.pack(side="left", padx=(2, 0))
+        
         self.back_btn = ctk.CTkButton(
             remote_nav,
             text="返回上级",
@@ -477,6 +276,10 @@ class FileTransferWindow(ctk.CTk):
         )
         self.back_btn.pack(side="left", padx=5)
         
+        self.remote_filter = ctk.CTkEntry(remote_nav, width=120, placeholder_text="筛选")
+        self.remote_filter.pack(side="right", padx=5)
+        self.remote_filter.bind("<KeyRelease>", lambda event: self.remote_view.set_filter(self.remote_filter.get()))
+        
         self.current_remote_path = ctk.CTkLabel(remote_nav, text="")
         self.current_remote_path.pack(side="left", padx=5)
         
@@ -499,9 +302,9 @@ class FileTransferWindow(ctk.CTk):
             yscrollcommand=remote_scrollbar_y.set,
             xscrollcommand=remote_scrollbar_x.set
         )
-        self.remote_list.heading("type", text="类型", command=lambda: self.treeview_sort_column(self.remote_list, "type", False))
-        self.remote_list.heading("name", text="名称", command=lambda: self.treeview_sort_column(self.remote_list, "name", False))
-        self.remote_list.heading("size", text="大小", command=lambda: self.treeview_sort_column(self.remote_list, "size", False))
+        self.remote_list.heading("type", text="类型", command=lambda: self.remote_view.sort_by("type"))
+        self.remote_list.heading("name", text="名称", command=lambda: self.remote_view.sort_by("name"))
+        self.remote_list.heading("size", text="大小", command=lambda: self.remote_view.sort_by("size"))
         
         # 设置列宽
         self.remote_list.column("type", width=80, minwidth=60)
@@ -511,8 +314,8 @@ class FileTransferWindow(ctk.CTk):
         self.remote_list.pack(fill="both", expand=True)
         self.remote_list.bind("<Double-1>", self.remote_item_double_clicked)
         
-        # 配置滚动条
-        remote_scrollbar_y.config(command=self.remote_list.yview)
+        # 配置滚动条，纵向滚动由列表模型处理，表格中只有可见的行
+        self.remote_view = VirtualList(self.remote_list, remote_scrollbar_y, entry_values, entry_sort_keys)
         remote_scrollbar_x.config(command=self.remote_list.xview)
         
         refresh_btn = ctk.CTkButton(
@@ -563,479 +366,156 @@ class FileTransferWindow(ctk.CTk):
         scrollbar.config(command=self.transfer_list.yview)
         self.transfer_list.configure(yscrollcommand=scrollbar.set)
         
+    def call_in_ui(self, func):
+        """在界面线程中执行 func，可以从任意线程调用"""
+        self.ui_queue.put(func)
+
+    def poll_ui_queue(self):
+        """定时执行其他线程交给界面线程的操作，每次最多占用约 50 毫秒，避免界面失去响应"""
+        deadline = time.monotonic() + 0.05
+        try:
+            while time.monotonic() < deadline:
+                func = self.ui_queue.get_nowait()
+                try:
+                    func()
+                except Exception as e:
+                    print(f"界面更新失败: {str(e)}")
+        except queue.Empty:
+            pass
+        self.after(20, self.poll_ui_queue)
+
+    def run_io(self, func, on_done, on_error=None):
+        """在后台线程中执行可能很慢的磁盘操作 func，完成后在界面线程中以结果调用 on_done，出错时调用 on_error"""
+        def finished(future):
+            try:
+                result = future.result()
+            except Exception as e:
+                if on_error is not None:
+                    self.call_in_ui(lambda e=e: on_error(e))
+                return
+            self.call_in_ui(lambda: on_done(result))
+
+        self.engine.io_pool.submit(func).add_done_callback(finished)
+
     def setup_signals(self):
         """设置所有信号连接"""
         # 传输完成信号
         self.signals.connect('transfer_completed', 
-            lambda msg: self.after(0, lambda: self.on_transfer_completed(msg)))
+            lambda msg: self.call_in_ui(lambda: self.on_transfer_completed(msg)))
         
         # 错误信号
         self.signals.connect('error_occurred', 
-            lambda msg: self.after(0, lambda: self.on_error(msg)))
+            lambda msg: self.call_in_ui(lambda: self.on_error(msg)))
         
         # 远程文件列表更新信号
         self.signals.connect('remote_files_updated', 
-            lambda files, path: self.after(0, lambda: self.update_remote_files(files, path)))
+            lambda entries, path, first, done: self.call_in_ui(
+                lambda: self.update_remote_files(entries, path, first, done)))
         
         # 速度更新信号
         self.signals.connect('speed_updated', 
-            lambda speed: self.after(0, lambda: self.update_speed_display(speed)))
+            lambda speed: self.call_in_ui(lambda: self.update_speed_display(speed)))
         
         # 状态更新信号
         self.signals.connect('status_updated',
-            lambda status: self.after(0, lambda: self.status_label.configure(text=status)))
+            lambda status: self.call_in_ui(lambda: self.status_label.configure(text=status)))
+        
+        # 不影响连接的错误提示
+        self.signals.connect('warning_occurred',
+            lambda msg: self.call_in_ui(lambda: self.on_warning(msg)))
+        
+        # 连接状态变化信号
+        self.signals.connect('connection_changed',
+            lambda connected, host: self.call_in_ui(lambda: self.on_connection_changed(connected, host)))
+        
+        # 传输列表信号
+        self.signals.connect('queue_item_added',
+            lambda file_path, size: self.call_in_ui(lambda: self.add_transfer_item(file_path, size)))
+        self.signals.connect('queue_item_updated',
+            lambda file_path, status, progress: self.call_in_ui(
+                lambda: self.update_transfer_item(file_path, status=status, progress=progress)))
 
     def transfer_selected_file(self):
         """处理文件传输"""
-        if not self.connected:
+        if not self.engine.connected:
             self.error_label.configure(text="请先连接到对方")
             return
         
-        # 获取所有选中的文件
-        selected_items = self.local_list.selection()
-        if not selected_items:
-            return
+        # 文件夹会连同其中的所有文件一起发送
+        file_paths = [os.path.join(self.current_local_directory, entry['name'])
+                      for entry in self.local_view.selected_entries() if entry['type'] in ('file', 'dir')]
+        save_path = self.current_remote_directory
         
-        # 将所有选中的文件添加到传输队列
-        for item in selected_items:
-            values = self.local_list.item(item)['values']
-            if not values or values[0] != "文件":  # 检查是否为文件
-                continue
-            
-            file_name = values[1]  # 获取文件名
-            file_path = os.path.join(self.current_local_directory, file_name)
-            
-            if not os.path.isfile(file_path):
-                continue
-            
-            file_size = os.path.getsize(file_path)
-            self.add_transfer_item(file_path, file_size)  # 添加到传输列表
-                
-            self.transfer_queue.append({
-                'file_path': file_path,
-                'save_path': self.current_remote_directory or os.path.join(os.path.expanduser("~"), "Downloads")
-            })
-        
-        # 如果当前没有在传输，开始传输队列
-        if not self.is_transferring:
-            self.process_transfer_queue()
+        def enqueue():
+            # 统计文件夹大小需要遍历其中所有文件，在后台线程中加入传输队列
+            errors = []
+            for file_path in file_paths:
+                if not os.path.exists(file_path):
+                    continue
+                # 加入引擎的传输队列，保存位置为空时由对方决定
+                try:
+                    self.engine.enqueue_push(file_path, save_path)
+                except Exception as e:
+                    print(f"添加传输失败: {str(e)}")
+                    errors.append(str(e))
+            return errors
+        
+        def show_errors(errors):
+            if errors:
+                self.error_label.configure(text=f"添加传输失败: {errors[-1]}")
+        
+        self.run_io(enqueue, show_errors)
     
-    def process_transfer_queue(self):
-        """处理传输队列"""
-        if not self.transfer_queue or self.is_transferring:
-            return
-            
-        self.is_transferring = True
-        try:
-            # 获取队列中的下一个文件
-            file_info = self.transfer_queue[0]  # 不立即移除，等传输成功后再移除
-            file_path = file_info['file_path']
-            
-            # 更新传输状态
-            self.update_transfer_item(file_path, status="传输中", progress=0)
-            
-            if file_info.get('is_pull', False):
-                # 创建新的信号处理器
-                signals = FileTransferSignals()
-                
-                def on_transfer_complete(msg):
-                    self.is_transferring = False
-                    self.update_transfer_item(file_path, status="完成", progress=100)
-                    self.transfer_queue.pop(0)  # 传输成功后移除
-                    # 继续处理队列中的下一个文件
-                    self.after(100, self.process_transfer_queue)
-                    
-                def on_transfer_error(msg):
-                    self.is_transferring = False
-                    self.update_transfer_item(file_path, status="失败")
-                    self.transfer_queue.pop(0)  # 传输失败后移除
-                    self.error_label.configure(text=f"传输错误: {msg}")
-                    self.after(3000, lambda: self.error_label.configure(text=""))
-                    # 继续处理队列中的下一个文件
-                    self.after(1000, self.process_transfer_queue)
-                
-                # 进度更新处理
-                def on_progress_update(progress):
-                    self.update_transfer_item(file_path, progress=progress)
-                    
-                # 速度更新处理
-                def on_speed_update(speed):
-                    self.transfer_status.configure(text=f"传输速度: {speed}")
-                
-                # 连接信号到新的处理器
-                signals.connect('transfer_completed', on_transfer_complete)
-                signals.connect('error_occurred', on_transfer_error)
-                signals.connect('progress_updated', on_progress_update)
-                signals.connect('speed_updated', on_speed_update)
-                
-                # 发送拉取请求
-                request = {
-                    'type': 'pull_request',
-                    'file_names': [os.path.basename(file_path)],
-                    'paths': [os.path.dirname(file_path)],
-                    'save_paths': [file_info['save_path']]
-                }
-                message = json.dumps(request) + "<<END>>"
-                self.client_socket.send(message.encode())
-                
-                # 保存信号处理器
-                self.signals = signals
-                
-            else:
-                # 创建并启动传输线程
-                self.transfer_thread = FileTransferThread(
-                    self.client_socket,
-                    file_path,
-                    file_info['save_path'],
-                    is_upload=True,
-                    signals=self.signals
-                )
-                
-                # 创建新的信号处理器
-                signals = FileTransferSignals()
-                
-                def on_transfer_complete(msg):
-                    self.is_transferring = False
-                    self.update_transfer_item(file_path, status="完成", progress=100)
-                    self.transfer_queue.pop(0)  # 传输成功后移除
-                    # 继续处理队列中的下一个文件
-                    self.after(100, self.process_transfer_queue)
-                    
-                def on_transfer_error(msg):
-                    self.is_transferring = False
-                    self.update_transfer_item(file_path, status="失败")
-                    self.transfer_queue.pop(0)  # 传输失败后移除
-                    self.error_label.configure(text=f"传输错误: {msg}")
-                    self.after(3000, lambda: self.error_label.configure(text=""))
-                    # 继续处理队列中的下一个文件
-                    self.after(1000, self.process_transfer_queue)
-                
-                # 进度更新处理
-                def on_progress_update(progress):
-                    self.update_transfer_item(file_path, progress=progress)
-                    
-                # 速度更新处理
-                def on_speed_update(speed):
-                    self.transfer_status.configure(text=f"传输速度: {speed}")
-                
-                # 连接信号到新的处理器
-                signals.connect('transfer_completed', on_transfer_complete)
-                signals.connect('error_occurred', on_transfer_error)
-                signals.connect('progress_updated', on_progress_update)
-                signals.connect('speed_updated', on_speed_update)
-                
-                # 设置线程的信号
-                self.transfer_thread.signals = signals
-                
-                # 启动线程
-                self.transfer_thread.start()
-            
-        except Exception as e:
-            self.is_transferring = False
-            if 'file_path' in locals():
-                self.update_transfer_item(file_path, status="失败")
-            self.error_label.configure(text=f"传输错误: {str(e)}")
-            self.after(3000, lambda: self.error_label.configure(text=""))
-            # 继续处理队列中的下一个文件
-            self.after(1000, self.process_transfer_queue)
-
-    def send_file(self, file_path):
-        try:
-            if not self.connected or not self.client_socket:
-                raise Exception("未连接到对方")
-                
-            file_size = os.path.getsize(file_path)
-            file_name = os.path.basename(file_path)
-            
-            if file_size == 0:
-                raise Exception("文件为空")
-                
-            # 计算文件MD5
-            md5_value = self.calculate_md5(file_path)
-            self.signals.emit('status_updated', f"正在发送: {file_name}")
-            
-            save_path = self.current_remote_directory
-            if not save_path:
-                save_path = os.path.join(os.path.expanduser("~"), "Downloads")
-            
-            # 发送文件信息（包含MD5值）
-            header = f"{file_name}|{file_size}|{save_path}|{md5_value}<<END>>".encode()
-            self.client_socket.send(header)
-            
-            self.last_transfer_time = time.time()
-            with open(file_path, 'rb') as f:
-                bytes_sent = 0
-                while bytes_sent < file_size:
-                    chunk = f.read(8192)
-                    if not chunk:
-                        break
-                    self.client_socket.send(chunk)
-                    bytes_sent += len(chunk)
-                    progress = int((bytes_sent / file_size) * 100)
-                    self.signals.emit('progress_updated', progress)
-                    self.calculate_speed(bytes_sent)
-                    
-            self.signals.emit('transfer_completed', f"已发送: {file_name}")
-            self.signals.emit('speed_updated', "传输速度: 0 B/s")
-            
-        except Exception as e:
-            self.signals.emit('error_occurred', str(e))
-            self.disconnect_peer()
-            
     def request_file_list(self):
         """请求远程文件列表"""
-        if not self.connected:
+        if not self.engine.connected:
             self.error_label.configure(text="未连接到对方")
             return
         try:
-            print("发送文件列表请求")  # 添加调试信息
-            request = {
-                'type': 'list_request'
-            }
-            message = json.dumps(request) + "<<END>>"
-            self.client_socket.send(message.encode())
+            # 刷新时要求对方重新扫描，不使用任何一方的缓存
+            self.engine.request_file_list(use_cache=False)
         except Exception as e:
             print(f"请求文件列表失败: {str(e)}")  # 添加调试信息
             self.error_label.configure(text=f"请求文件列表失败: {str(e)}")
 
-    def send_file_list(self):
-        """发送本地文件列表给对方"""
+    def update_remote_files(self, entries, current_path="", first=True, done=True):
+        """更新远程文件列表显示，大目录分多页到达，第一页时清空原有内容"""
         try:
-            # 获取所有驱动器
-            drives = []
-            if os.name == 'nt':  # Windows系统
-                import win32api
-                drives = win32api.GetLogicalDriveStrings().split('\000')[:-1]
-                drives = [drive.rstrip('\\') for drive in drives if drive]  # 移除空值并去掉反斜杠
-            else:  # Linux/Mac系统
-                drives = ['/']
-
-            files = []
-            current_path = self.current_local_directory
-            
-            # 如果是驱动器根目录（如 D:\）或空路径，显示驱动器列表
-            if os.name == 'nt':
-                if not current_path or current_path == "":
-                    # 显示驱动器列表
-                    for drive in drives:
-                        files.append(f"[驱动器] {drive}")
-                    print(f"发送驱动器列表: {files}")
-                    current_path = ""  # 重置为空字符串表示根目录
-                else:
-                    # 显示当前目录的内容
-                    try:
-                        for item in os.listdir(current_path):
-                            item_path = os.path.join(current_path, item)
-                            try:
-                                if os.path.isfile(item_path):
-                                    size = os.path.getsize(item_path)
-                                    size_str = self.format_size(size)
-                                    files.append(f"[文件] {item} ({size_str})")
-                                else:
-                                    files.append(f"[文件夹] {item}")
-                            except Exception as e:
-                                print(f"处理文件 {item} 时出错: {str(e)}")
-                                continue
-                    except Exception as e:
-                        print(f"读取目录 {current_path} 失败: {str(e)}")
-                        # 如果读取失败，返回到驱动器列表
-                        for drive in drives:
-                            files.append(f"[驱动器] {drive}")
-                        current_path = ""
-            else:
-                # Linux/Mac 系统的处理逻辑
-                if not current_path or current_path == "/":
-                    files.append("[驱动器] /")
-                    current_path = "/"
+            if first:
+                self.remote_files = []
+                self.current_remote_directory = current_path
+                if not self.remote_history:
+                    # 连接后自动显示的第一个目录
+                    self.remote_history = [current_path]
+                    self.remote_history_index = 0
+
+                # 更新当前路径显示
+                if current_path:
+                    self.current_remote_path.configure(text=f"当前位置: {current_path}")
                 else:
-                    # 显示当前目录的内容
-                    try:
-                        for item in os.listdir(current_path):
-                            item_path = os.path.join(current_path, item)
-                            try:
-                                if os.path.isfile(item_path):
-                                    size = os.path.getsize(item_path)
-                                    size_str = self.format_size(size)
-                                    files.append(f"[文件] {item} ({size_str})")
-                                else:
-                                    files.append(f"[文件夹] {item}")
-                            except Exception as e:
-                                print(f"处理文件 {item} 时出错: {str(e)}")
-                                continue
-                    except Exception as e:
-                        print(f"读取目录 {current_path} 失败: {str(e)}")
-                        files.append("[驱动器] /")
-                        current_path = "/"
-            
-            print(f"准备发送文件列表: {files}, 当前路径: {current_path}")
-            response = {
-                'type': 'file_list',
-                'files': files,
-                'path': current_path
-            }
-            message = json.dumps(response) + "<<END>>"
-            self.client_socket.send(message.encode())
-            print("文件列表已发送")
-        except Exception as e:
-            print(f"发送文件列表失败: {str(e)}")
-            self.error_label.configure(text=f"发送文件列表失败: {str(e)}")
-            
-    def format_size(self, size):
-        """格式化文件大小显示"""
-        for unit in ['B', 'KB', 'MB', 'GB']:
-            if size < 1024:
-                return f"{size:.1f}{unit}"
-            size /= 1024
-        return f"{size:.1f}TB"
+                    self.current_remote_path.configure(text="当前位置: 根目录")
 
-    def update_remote_files(self, files, current_path=""):
-        """更新远程文件列表显示"""
-        try:
-            self.remote_list.delete(*self.remote_list.get_children())
-            self.remote_files = files
-            self.current_remote_directory = current_path
-            
-            # 更新当前路径显示
-            if current_path:
-                self.current_remote_path.configure(text=f"当前位置: {current_path}")
                 # 更新驱动器下拉框
-                if os.name == 'nt':
+                drives = [entry['name'] for entry in entries if entry['type'] == 'drive']
+                if drives:
+                    self.remote_drive_combo.configure(values=drives)
+                    self.remote_drive_combo.set(drives[0])
+                elif os.name == 'nt':
                     drive = os.path.splitdrive(current_path)[0]
                     if drive:
                         self.remote_drive_combo.set(drive)
-                else:
-                    drives = []
-                    for file in files:
-                        if file.startswith("[驱动器]"):
-                            drive = file.split("] ")[1].strip().rstrip('\\')
-                            drives.append(drive)
-                    self.remote_drive_combo.configure(values=drives)
-                    if drives:
-                        self.remote_drive_combo.set(drives[0])
-            else:
-                self.current_remote_path.configure(text="当前位置: 根目录")
-                # 更新远程驱动器列表
-                drives = []
-                for file in files:
-                    if file.startswith("[驱动器]"):
-                        drive = file.split("] ")[1].strip()
-                        drives.append(drive)
-                self.remote_drive_combo.configure(values=drives)
-                if drives:
-                    self.remote_drive_combo.set(drives[0])
-            
+
             # 更新文件列表
-            for file in files:
-                if file.startswith("[驱动器]"):
-                    drive = file.split("] ")[1].strip()
-                    self.remote_list.insert("", "end", values=("驱动器", drive.rstrip('\\'), ""))
-                elif file.startswith("[文件夹]"):
-                    folder = file.split("] ")[1].strip()
-                    self.remote_list.insert("", "end", values=("文件夹", folder, ""))
-                elif file.startswith("[文件]"):
-                    parts = file.split("] ")[1].split(" (")
-                    name = parts[0].strip()
-                    size = parts[1].rstrip(")")
-                    self.remote_list.insert("", "end", values=("文件", name, size))
-                
+            self.remote_files.extend(entries)
+            if first:
+                self.remote_view.set_entries(entries)
+            else:
+                self.remote_view.append_entries(entries)
+
         except Exception as e:
             print(f"更新远程文件列表失败: {str(e)}")
             self.error_label.configure(text=f"更新远程文件列表失败: {str(e)}")
 
-    def handle_json_message(self, msg_data):
-        """处理JSON格式的消息"""
-        try:
-            if msg_data['type'] == 'list_request':
-                print("收到文件列表请求")
-                path = msg_data.get('path', '')
-                if path:
-                    self.current_local_directory = path
-                self.send_file_list()
-            elif msg_data['type'] == 'file_list':
-                print(f"收到文件列表: {msg_data['files']}")
-                self.signals.emit('remote_files_updated', msg_data['files'], msg_data.get('path', ''))
-            elif msg_data['type'] == 'pull_request':
-                print(f"收到文件拉取请求: {msg_data}")
-                self.handle_pull_request(msg_data)
-        except Exception as e:
-            print(f"处理JSON消息失败: {str(e)}")
-            self.signals.emit('error_occurred', str(e))
-
-    def handle_file_transfer(self, message, remaining):
-        """处理文件传输消息"""
-        full_save_path = None
-        try:
-            # 解析文件信息
-            file_info = message.split('|')
-            if len(file_info) != 4:
-                raise ValueError("无效的文件信息格式")
-
-            file_name, file_size, save_path, md5_value = file_info
-            file_size = int(file_size)
-
-            if not save_path:
-                save_path = os.path.join(os.path.expanduser("~"), "Downloads")
-
-            print(f"保存文件到: {save_path}")
-            self.signals.emit('status_updated', f"正在接收: {file_name}")
-
-            # 创建保存目录
-            os.makedirs(save_path, exist_ok=True)
-            full_save_path = os.path.join(save_path, file_name)
-
-            # 优化socket配置
-            self.client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 524288)
-            self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-            
-            # 接收文件内容
-            self.last_transfer_time = time.time()
-            with open(full_save_path, 'wb', buffering=262144) as f:
-                bytes_received = 0
-                if remaining:
-                    f.write(remaining)
-                    bytes_received = len(remaining)
-
-                while bytes_received < file_size:
-                    try:
-                        chunk = self.client_socket.recv(min(262144, file_size - bytes_received))
-                        if not chunk:
-                            raise ConnectionError("连接已断开")
-                        f.write(chunk)
-                        bytes_received += len(chunk)
-                        
-                        # 降低进度更新频率
-                        if bytes_received % (262144 * 4) == 0:
-                            progress = int((bytes_received / file_size) * 100)
-                            self.signals.emit('progress_updated', progress)
-                            self.calculate_speed(bytes_received)
-                    except socket.timeout:
-                        continue
-                    except Exception as e:
-                        raise ConnectionError(f"接收数据失败: {str(e)}")
-
-            # 验证文件MD5
-            received_md5 = self.calculate_md5(full_save_path)
-            if received_md5 != md5_value:
-                raise ValueError("文件校验失败，传输可能不完整")
-
-            self.signals.emit('transfer_completed', f"已接收: {file_name}")
-            self.signals.emit('speed_updated', "0 MB/s")
-
-            if not self.is_server:
-                print("文件接收完成，请求更新文件列表")
-                self.request_file_list()
-
-        except Exception as e:
-            print(f"文件接收失败: {str(e)}")
-            self.signals.emit('error_occurred', f"文件接收失败: {str(e)}")
-            # 如果文件接收失败，删除未完成的文件
-            if full_save_path and os.path.exists(full_save_path):
-                try:
-                    os.remove(full_save_path)
-                except:
-                    pass
-            raise
-
     def get_local_ip(self):
         try:
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -1046,33 +526,8 @@ class FileTransferWindow(ctk.CTk):
         except:
             return "127.0.0.1"
         
-    def start_server(self):
-        try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.bind(('0.0.0.0', self.port))
-            self.server_socket.listen(1)
-            threading.Thread(target=self.accept_connections, daemon=True).start()
-        except Exception as e:
-            self.signals.emit('error_occurred', f"启动服务器失败: {str(e)}")
-        
-    def accept_connections(self):
-        while True:
-            try:
-                client_socket, addr = self.server_socket.accept()
-                if self.client_socket:  # 如果已经有连接，拒绝新连接
-                    client_socket.close()
-                    continue
-                    
-                self.client_socket = client_socket
-                self.connected = True
-                self.status_label.configure(text=f"已连接到: {addr[0]}")
-                threading.Thread(target=self.receive_files, daemon=True).start()
-            except Exception as e:
-                self.signals.emit('error_occurred', str(e))
-                break
-            
     def connect_to_peer(self):
-        if self.connected:
+        if self.engine.connected:
             self.disconnect_peer()
             return
             
@@ -1092,20 +547,12 @@ class FileTransferWindow(ctk.CTk):
                 # 更新下拉列表
                 self.ip_combo.configure(values=list(self.ip_history))
                 
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((ip, self.port))
-            self.connected = True
-            self.is_server = False
-            self.status_label.configure(text=f"已连接到: {ip}")
-            self.connect_button.configure(text="断开连接")
-            self.ip_combo.configure(state="disabled")
-            
-            threading.Thread(target=self.receive_files, daemon=True).start()
+            # 界面状态在 connection_changed 信号中更新
+            self.engine.connect(ip)
             self.after(500, self.request_file_list)
             
         except Exception as e:
-            self.signals.emit('error_occurred', str(e))
-            self.client_socket = None
+            self.on_error(str(e))
 
     def load_ip_history(self):
         """加载IP历史记录"""
@@ -1128,30 +575,26 @@ class FileTransferWindow(ctk.CTk):
             print(f"保存IP历史记录失败: {str(e)}")
 
     def disconnect_peer(self):
-        if self.transfer_thread and self.transfer_thread.is_alive():
-            self.transfer_thread.running = False
-            self.transfer_thread.join()
-            
-        self.connected = False
-        if self.client_socket:
-            try:
-                self.client_socket.shutdown(socket.SHUT_RDWR)
-                self.client_socket.close()
-            except:
-                pass
-            self.client_socket = None
+        # 引擎会停止传输并清空队列，界面在 connection_changed 信号中重置
+        self.engine.disconnect()
 
+    def on_connection_changed(self, connected, host):
+        """连接建立或断开时更新界面"""
+        if connected:
+            self.status_label.configure(text=f"已连接到: {host}")
+            self.connect_button.configure(text="断开连接")
+            self.ip_combo.configure(state="disabled")
+            return
+        
         self.status_label.configure(text="等待连接...")
         self.connect_button.configure(text="连接")
+        self.remote_history = []  # 浏览历史属于断开的对方
+        self.remote_history_index = -1
         self.ip_combo.configure(state="normal")
         self.transfer_status.configure(text="传输速度: 0 MB/s")
-        self.error_label.configure(text="")
-        self.is_server = True
         
-        # 清理传输队列和列表
-        self.transfer_queue.clear()
+        # 清理传输列表
         self.clear_transfer_list()
-        self.is_transferring = False
 
     def on_transfer_completed(self, message):
         """传输完成处理"""
@@ -1171,17 +614,18 @@ class FileTransferWindow(ctk.CTk):
         # 3秒后清除错误提示
         self.after(3000, lambda: self.error_label.configure(text=""))
         
-        # 重置状态
+        # 重置状态，连接出错时引擎已自行断开
         self.transfer_status.configure(text="传输速度: 0 MB/s")
-        self.disconnect_peer()
+        
+    def on_warning(self, message):
+        """显示不影响连接的错误提示"""
+        self.error_label.configure(text=message)
+        self.after(3000, lambda: self.error_label.configure(text=""))
         
     def close(self):
         """关闭窗口时保存IP历史记录"""
         self.save_ip_history()
-        if self.client_socket:
-            self.client_socket.close()
-        if hasattr(self, 'server_socket'):
-            self.server_socket.close()
+        self.engine.close()
         self.destroy()
         
     def select_save_directory(self):
@@ -1193,19 +637,20 @@ class FileTransferWindow(ctk.CTk):
     def local_item_double_clicked(self, event):
         """处理本地文件列表的双击事件"""
         try:
-            selected_item = self.local_list.selection()[0]
-            values = self.local_list.item(selected_item)['values']
-            item_type = values[0]  # 第一列是类型
-            item_name = values[1]  # 第二列是名称
+            entry = self.local_view.entry_at(event.y)
+            if entry is None:
+                return
+            item_type = entry['type']
+            item_name = entry['name']
             
-            if item_type == "驱动器":
+            if item_type == 'drive':
                 # 如果是驱动器，直接使用驱动器路径
                 path = item_name
                 if os.name == 'nt' and not path.endswith('\\'):
                     path = path + '\\'
                 print(f"打开本地驱动器: {path}")
                 self.update_local_files(path)
-            elif item_type == "文件夹":
+            elif item_type == 'dir':
                 # 如果是文件夹，拼接完整路径
                 if self.current_local_directory:
                     path = os.path.join(self.current_local_directory, item_name)
@@ -1220,22 +665,21 @@ class FileTransferWindow(ctk.CTk):
     def remote_item_double_clicked(self, event):
         """处理远程文件列表的双击事件"""
         try:
-            selected_item = self.remote_list.selection()[0]
-            values = self.remote_list.item(selected_item)['values']
-            if not values:  # 检查是否有选中的项目
+            entry = self.remote_view.entry_at(event.y)
+            if entry is None:  # 检查是否双击在某一行上
                 return
             
-            item_type = values[0]  # 第一列是类型
-            item_name = values[1]  # 第二列是名称
+            item_type = entry['type']
+            item_name = entry['name']
             
-            if item_type == "驱动器":
+            if item_type == 'drive':
                 # 如果是驱动器，直接使用驱动器路径
                 path = item_name
                 if os.name == 'nt' and not path.endswith('\\'):
                     path = path + '\\'
                 print(f"请求打开远程驱动器: {path}")
                 self.current_remote_directory = path
-            elif item_type == "文件夹":
+            elif item_type == 'dir':
                 # 如果是文件夹，拼接完整路径
                 if self.current_remote_directory:
                     path = os.path.join(self.current_remote_directory, item_name)
@@ -1247,13 +691,8 @@ class FileTransferWindow(ctk.CTk):
                 return
 
             # 发送请求获取该路径下的文件列表
-            request = {
-                'type': 'list_request',
-                'path': path
-            }
-            message = json.dumps(request) + "<<END>>"
             try:
-                self.client_socket.send(message.encode())
+                self.navigate_remote(path)
             except Exception as e:
                 print(f"发送远程文件列表请求失败: {str(e)}")
                 self.error_label.configure(text=f"请求远程文件列表失败: {str(e)}")
@@ -1264,6 +703,33 @@ class FileTransferWindow(ctk.CTk):
             self.error_label.configure(text=f"打开远程文件夹失败: {str(e)}")
             self.after(3000, lambda: self.error_label.configure(text=""))
 
+    def navigate_remote(self, path):
+        """打开远程目录并记入浏览历史，最近浏览过的目录立即显示缓存的列表"""
+        del self.remote_history[self.remote_history_index + 1:]
+        self.remote_history.append(path)
+        self.remote_history_index = len(self.remote_history) - 1
+        self.engine.request_file_list(path)
+
+    def remote_go_back(self):
+        """后退到上一个浏览的远程目录"""
+        self.remote_go_history(-1)
+
+    def remote_go_forward(self):
+        """前进到后退前浏览的远程目录"""
+        self.remote_go_history(1)
+
+    def remote_go_history(self, step):
+        index = self.remote_history_index + step
+        if not self.engine.connected or not 0 <= index < len(self.remote_history):
+            return
+        try:
+            self.engine.request_file_list(self.remote_history[index])
+            self.remote_history_index = index
+        except Exception as e:
+            print(f"打开远程目录失败: {str(e)}")
+            self.error_label.configure(text=f"打开远程目录失败: {str(e)}")
+            self.after(3000, lambda: self.error_label.configure(text=""))
+
     def go_to_parent_directory(self):
         """返回远程上级目录"""
         try:
@@ -1288,13 +754,8 @@ class FileTransferWindow(ctk.CTk):
                     parent_path = '/'
             
             print(f"返回上级目录: 当前={self.current_remote_directory}, 父级={parent_path}")
-            request = {
-                'type': 'list_request',
-                'path': parent_path
-            }
-            message = json.dumps(request) + "<<END>>"
             try:
-                self.client_socket.send(message.encode())
+                self.navigate_remote(parent_path)
             except Exception as e:
                 print(f"返回上级目录失败: {str(e)}")
                 self.error_label.configure(text=f"返回上级目录失败: {str(e)}")
@@ -1305,56 +766,43 @@ class FileTransferWindow(ctk.CTk):
             self.after(3000, lambda: self.error_label.configure(text=""))
 
     def update_local_files(self, path):
-        """更新本地文件列表显示"""
-        try:
-            self.local_list.delete(*self.local_list.get_children())
-            self.current_local_directory = path
-            
-            # 更新当前路径显示
-            if path:
-                self.current_local_path.configure(text=f"当前位置: {path}")
-            else:
-                self.current_local_path.configure(text="当前位置: 根目录")
-            
-            # 获取驱动器列表
-            if os.name == 'nt':  # Windows系统
-                import win32api
-                drives = win32api.GetLogicalDriveStrings().split('\000')[:-1]
-                drives = [drive.rstrip('\\') for drive in drives if drive]
-            else:  # Linux/Mac系统
-                drives = ['/']
-            
-            # 如果是空路径或根目录，显示驱动器列表
+        """更新本地文件列表显示，目录在后台线程中读取，较慢的磁盘不会使界面失去响应"""
+        self.local_listing_serial += 1
+        serial = self.local_listing_serial
+        
+        def drive_entries():
+            return [{'name': drive, 'type': 'drive'} for drive in list_drives()]
+        
+        def list_path():
+            # 如果是空路径，显示驱动器列表
             if not path:
-                for drive in drives:
-                    self.local_list.insert("", "end", values=("驱动器", drive, ""))
-                return
-            
-            # 显示当前目录的文件和文件夹
+                return path, drive_entries()
             try:
-                for item in os.listdir(path):
-                    item_path = os.path.join(path, item)
-                    try:
-                        if os.path.isfile(item_path):
-                            size = os.path.getsize(item_path)
-                            size_str = self.format_size(size)
-                            self.local_list.insert("", "end", values=("文件", item, size_str))
-                        else:
-                            self.local_list.insert("", "end", values=("文件夹", item, ""))
-                    except Exception as e:
-                        print(f"处理文件 {item} 时出错: {str(e)}")
-                        continue
+                return path, list(scan_entries(path))
             except Exception as e:
                 print(f"读取目录 {path} 失败: {str(e)}")
                 # 如果读取失败，显示驱动器列表
-                for drive in drives:
-                    self.local_list.insert("", "end", values=("驱动器", drive, ""))
-                self.current_local_directory = ""
-                self.current_local_path.configure(text="当前位置: 根目录")
+                return "", drive_entries()
+        
+        def show(result):
+            if serial != self.local_listing_serial:
+                return  # 已经打开了其他目录
+            listed_path, entries = result
+            self.current_local_directory = listed_path
             
-        except Exception as e:
+            # 更新当前路径显示
+            if listed_path:
+                self.current_local_path.configure(text=f"当前位置: {listed_path}")
+            else:
+                self.current_local_path.configure(text="当前位置: 根目录")
+            self.local_view.set_entries(entries)
+        
+        def show_error(e):
             print(f"更新本地文件列表失败: {str(e)}")
             self.error_label.configure(text=f"更新本地文件列表失败: {str(e)}")
+        
+        self.current_local_path.configure(text=f"正在读取: {path or '根目录'}")
+        self.run_io(list_path, show, show_error)
 
     def local_go_to_parent_directory(self):
         """返回本地上级目录"""
@@ -1379,66 +827,31 @@ class FileTransferWindow(ctk.CTk):
 
     def pull_selected_file(self):
         """处理文件拉取"""
-        if not self.connected:
+        if not self.engine.connected:
             self.error_label.configure(text="请先连接到对方")
             return
         
-        # 获取所有选中的远程文件
-        selected_items = self.remote_list.selection()
-        if not selected_items:
-            return
-        
         # 将选中的文件添加到传输队列
-        for item in selected_items:
-            values = self.remote_list.item(item)['values']
-            if not values or values[0] != "文件":  # 检查是否为文件
+        for entry in self.remote_view.selected_entries():
+            if entry['type'] not in ('file', 'dir'):  # 文件夹会连同其中的所有文件一起拉取
                 continue
             
-            file_name = values[1]  # 获取文件名
-            file_size_str = values[2]  # 获取文件大小字符串
-            
-            # 将文件大小字符串转换为字节数
-            try:
-                file_size = self.parse_size_str(file_size_str)
-            except:
-                file_size = 0
-            
-            # 添加到传输列表UI
-            file_path = os.path.join(self.current_remote_directory, file_name)
-            self.add_transfer_item(file_path, file_size)
+            file_size = entry.get('size', 0)  # 文件夹的大小由对方在发送时统计
             
-            # 添加到传输队列
-            self.transfer_queue.append({
-                'file_path': file_path,
-                'save_path': self.current_local_directory or os.path.join(os.path.expanduser("~"), "Downloads"),
-                'is_pull': True  # 标记这是一个拉取请求
-            })
-        
-        # 如果当前没有在传输，开始传输队列
-        if not self.is_transferring:
-            self.process_transfer_queue()
+            # 加入引擎的传输队列，传输列表在 queue_item_added 信号中更新
+            file_path = os.path.join(self.current_remote_directory, entry['name'])
+            self.engine.enqueue_pull(file_path, self.current_local_directory, file_size)
 
-    def parse_size_str(self, size_str):
-        """将大小字符串转换为字节数"""
+    def apply_rate_limit(self):
+        """修改发送总限速，正在进行的传输立即生效"""
         try:
-            match = re.match(r"([\d.]+)([KMGT]?B)", size_str)
-            if not match:
-                return 0
-                
-            number = float(match.group(1))
-            unit = match.group(2)
-            
-            multipliers = {
-                'B': 1,
-                'KB': 1024,
-                'MB': 1024 ** 2,
-                'GB': 1024 ** 3,
-                'TB': 1024 ** 4
-            }
-            
-            return int(number * multipliers.get(unit, 1))
-        except:
-            return 0
+            self.engine.rate_limit = parse_rate(self.rate_limit_entry.get())
+        except ValueError as e:
+            self.error_label.configure(text=str(e))
+            self.after(3000, lambda: self.error_label.configure(text=""))
+            return
+        limit = self.engine.rate_limit
+        self.status_label.configure(text=f"发送限速: {format_size(limit) + '/s' if limit else '不限速'}")
 
     def update_status(self, status):
         """更新状态显示"""
@@ -1452,88 +865,10 @@ class FileTransferWindow(ctk.CTk):
         """更新速度显示"""
         self.transfer_status.configure(text=f"传输速度: {speed}")
 
-    def calculate_speed(self, total_bytes):
-        """计算实际每秒传输速度"""
-        current_time = time.time()
-        
-        # 检查是否达到更新间隔
-        if current_time - self.last_speed_update >= self.speed_update_interval:
-            # 计算这个间隔内传输的字节数
-            bytes_diff = total_bytes - self.last_bytes
-            time_diff = current_time - self.last_speed_update
-            
-            if time_diff > 0:
-                # 计算实际每秒速度
-                speed = bytes_diff / time_diff
-                speed_mb = speed / (1024 * 1024)
-                speed_str = f"{speed_mb:.2f} MB/s"
-                self.signals.emit('speed_updated', speed_str)
-            
-            # 更新记录
-            self.last_bytes = total_bytes
-            self.last_speed_update = current_time
-
-    def calculate_md5(self, file_path):
-        """计算文件MD5值"""
-        md5_hash = hashlib.md5()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                md5_hash.update(chunk)
-        return md5_hash.hexdigest()
-
-    def receive_files(self):
-        while self.connected and self.client_socket:
-            try:
-                data = b""
-                # 添加超时设置
-                self.client_socket.settimeout(60)  # 60秒超时
-                
-                # 接收消息头
-                while b"<<END>>" not in data:
-                    try:
-                        chunk = self.client_socket.recv(1024)
-                        if not chunk:
-                            raise ConnectionError("连接已断开")
-                        data += chunk
-                    except socket.timeout:
-                        continue
-                    except Exception as e:
-                        raise ConnectionError(f"接收数据失败: {str(e)}")
-
-                if not data:
-                    break
-
-                # 处理消息
-                if b"<<END>>" in data:
-                    parts = data.split(b"<<END>>", 1)
-                    message = parts[0].decode('utf-8', errors='ignore')
-                    remaining = parts[1] if len(parts) > 1 else b""
-
-                    try:
-                        # 尝试解析为JSON消息
-                        msg_data = json.loads(message)
-                        self.handle_json_message(msg_data)
-                    except json.JSONDecodeError:
-                        # 不是JSON消息，尝试处理为文件传输
-                        self.handle_file_transfer(message, remaining)
-
-            except ConnectionError as e:
-                print(f"连接错误: {str(e)}")
-                self.signals.emit('error_occurred', str(e))
-                break
-            except Exception as e:
-                print(f"接收错误: {str(e)}")
-                self.signals.emit('error_occurred', str(e))
-                break
-
-        self.disconnect_peer()
-
     def update_drive_list(self, combo_box):
         """更新驱动器列表"""
         if os.name == 'nt':  # Windows系统
-            import win32api
-            drives = win32api.GetLogicalDriveStrings().split('\000')[:-1]
-            drives = [drive.rstrip('\\') for drive in drives if drive]  # 移除空值并去掉反斜杠
+            drives = list_drives()
             combo_box.configure(values=drives)  # 设置所有驱动器为下拉选项
             
             # 不设置默认值，让用户自己选择
@@ -1557,7 +892,7 @@ class FileTransferWindow(ctk.CTk):
 
     def on_remote_drive_changed(self, drive):
         """处理远程驱动器选择变化"""
-        if drive and self.connected:
+        if drive and self.engine.connected:
             if os.name == 'nt':
                 # 确保驱动器路径格式正确
                 drive = drive.rstrip('\\') + '\\'
@@ -1568,13 +903,8 @@ class FileTransferWindow(ctk.CTk):
             self.current_remote_directory = drive  # 更新当前远程目录
             
             # 发送请求获取该驱动器的文件列表
-            request = {
-                'type': 'list_request',
-                'path': drive
-            }
-            message = json.dumps(request) + "<<END>>"
             try:
-                self.client_socket.send(message.encode())
+                self.navigate_remote(drive)
             except Exception as e:
                 print(f"请求远程目录失败: {str(e)}")
                 self.error_label.configure(text=f"请求远程目录失败: {str(e)}")
@@ -1593,53 +923,10 @@ class FileTransferWindow(ctk.CTk):
             self.error_label.configure(text=f"刷新本地文件列表失败: {str(e)}")
             self.after(3000, lambda: self.error_label.configure(text="")) 
 
-    def treeview_sort_column(self, tree, col, reverse):
-        """排序 Treeview 的列"""
-        l = [(tree.set(k, col), k) for k in tree.get_children('')]
-        
-        # 自定义排序函数
-        def convert_size(size_str):
-            if not size_str:
-                return 0
-            try:
-                # 提取数字和单位
-                match = re.match(r"([\d.]+)([KMGT]?B)", size_str)
-                if not match:
-                    return 0
-                    
-                number = float(match.group(1))
-                unit = match.group(2)
-                
-                # 转换到字节
-                multipliers = {
-                    'B': 1,
-                    'KB': 1024,
-                    'MB': 1024 ** 2,
-                    'GB': 1024 ** 3,
-                    'TB': 1024 ** 4
-                }
-                
-                return number * multipliers.get(unit, 1)
-            except:
-                return 0
-        
-        # 根据列类型选择排序方法
-        if col == "size":
-            l.sort(key=lambda x: convert_size(x[0]), reverse=reverse)
-        else:
-            l.sort(reverse=reverse)
-        
-        # 重新排列项目
-        for index, (val, k) in enumerate(l):
-            tree.move(k, '', index)
-        
-        # 切换排序方向
-        tree.heading(col, command=lambda: self.treeview_sort_column(tree, col, not reverse)) 
-
     def add_transfer_item(self, file_path, size):
         """添加传输项到列表"""
         file_name = os.path.basename(file_path)
-        size_str = self.format_size(size)
+        size_str = format_size(size)
         item = self.transfer_list.insert("", "end", values=(file_name, size_str, "等待中", "0%"))
         self.transfer_items[file_path] = item
         return item
@@ -1672,89 +959,4 @@ class FileTransferWindow(ctk.CTk):
     def clear_transfer_list(self):
         """清空传输列表"""
         self.transfer_list.delete(*self.transfer_list.get_children())
-        self.transfer_items.clear() 
-
-    def handle_pull_request(self, msg_data):
-        """处理文件拉取请求"""
-        try:
-            file_names = msg_data['file_names']
-            paths = msg_data.get('paths', [])
-            save_paths = msg_data.get('save_paths', [])
-
-            if not paths:
-                raise Exception("无效的文件路径")
-
-            for file_name, path, save_path in zip(file_names, paths, save_paths):
-                file_path = os.path.join(path, file_name)
-                if not os.path.isfile(file_path):
-                    raise Exception(f"文件 {file_name} 不存在")
-                
-                # 获取文件大小
-                file_size = os.path.getsize(file_path)
-                
-                # 添加到传输列表UI
-                self.add_transfer_item(file_path, file_size)
-                
-                # 创建并启动传输线程
-                transfer_thread = FileTransferThread(
-                    self.client_socket,
-                    file_path,
-                    save_path,
-                    is_upload=True,
-                    signals=self.signals
-                )
-                
-                # 创建新的信号处理器
-                signals = FileTransferSignals()
-                
-                def on_transfer_complete(msg):
-                    self.is_transferring = False
-                    self.update_transfer_item(file_path, status="完成", progress=100)
-                    self.signals.emit('status_updated', "传输完成")
-                    # 继续处理队列中的下一个文件
-                    self.after(100, self.process_transfer_queue)
-                    
-                def on_transfer_error(msg):
-                    self.is_transferring = False
-                    self.update_transfer_item(file_path, status="失败")
-                    self.signals.emit('status_updated', f"传输错误: {msg}")
-                    self.error_label.configure(text=f"传输错误: {msg}")
-                    self.after(3000, lambda: self.error_label.configure(text=""))
-                    # 继续处理队列中的下一个文件
-                    self.after(1000, self.process_transfer_queue)
-                
-                # 进度更新处理
-                def on_progress_update(progress):
-                    self.update_transfer_item(file_path, progress=progress)
-                    self.signals.emit('progress_updated', progress)
-                    
-                # 速度更新处理
-                def on_speed_update(speed):
-                    self.signals.emit('speed_updated', speed)
-                    self.transfer_status.configure(text=f"传输速度: {speed}")
-                
-                # 状态更新处理
-                def on_status_update(status):
-                    self.signals.emit('status_updated', status)
-                
-                # 连接信号到新的处理器
-                signals.connect('transfer_completed', on_transfer_complete)
-                signals.connect('error_occurred', on_transfer_error)
-                signals.connect('progress_updated', on_progress_update)
-                signals.connect('speed_updated', on_speed_update)
-                signals.connect('status_updated', on_status_update)
-                
-                # 设置线程的信号
-                transfer_thread.signals = signals
-                
-                # 更新初始状态
-                self.signals.emit('status_updated', f"正在发送: {file_name}")
-                self.update_transfer_item(file_path, status="传输中", progress=0)
-                
-                # 启动线程
-                transfer_thread.start()
-
-        except Exception as e:
-            print(f"处理拉取请求失败: {str(e)}")
-            self.error_label.configure(text=f"处理拉取请求失败: {str(e)}")
-            self.after(3000, lambda: self.error_label.configure(text="")) 
\ No newline at end of file
+        self.transfer_items.clear()
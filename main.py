@@ -1,16 +1,241 @@
 import sys
-import customtkinter as ctk
 import os
-from file_transfer import FileTransferWindow
+import time
+import argparse
+import logging
+from digest import DEFAULT_HASH_ALGORITHM, HASH_ALGORITHMS
+from compress import available_codecs
+from ratelimit import parse_rate, parse_schedule
+from pipeline import DEFAULT_PIPELINE_DEPTH
+from engine import TransferEngine, format_size
+
+def run_gui():
+    # 图形界面依赖 customtkinter，只在需要时导入，命令行模式不需要显示环境
+    import customtkinter as ctk
+    from file_transfer import FileTransferWindow
 
-def main():
     ctk.set_appearance_mode("System")  # 跟随系统主题
     ctk.set_default_color_theme("blue")  # 设置默认颜色主题
-    
+
     window = FileTransferWindow(port=5000)
     window.geometry("1200x800")  # 设置初始窗口大小
     window.minsize(800, 600)     # 设置最小窗口大小
     window.mainloop()
 
+def build_parser():
+    """命令行参数：不带参数运行时打开图形界面"""
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--port', type=int, default=5000, help="监听和连接的端口（默认 5000）")
+    common.add_argument('--hash', default=DEFAULT_HASH_ALGORITHM, choices=sorted(HASH_ALGORITHMS),
+                        help=f"文件校验使用的摘要算法（默认 {DEFAULT_HASH_ALGORITHM}）")
+    common.add_argument('--streams', type=int, default=4,
+                        help="大文件并行传输使用的连接数，1 表示关闭并行传输（默认 4）")
+    common.add_argument('--compress', choices=['auto'] + available_codecs(),
+                        help="传输时压缩数据，auto 选择双方都支持的最佳算法；对方启用压缩时也会压缩")
+    common.add_argument('--limit', type=parse_rate, metavar='RATE',
+                        help="发送总限速，每秒字节数，可用 K/M/G 后缀，如 10M")
+    common.add_argument('--limit-peer', type=parse_rate, metavar='RATE', help="发送给每个对方的限速")
+    common.add_argument('--limit-transfer', type=parse_rate, metavar='RATE', help="每次传输的限速")
+    common.add_argument('--limit-schedule', type=parse_schedule, action='append', default=[], metavar='TIME',
+                        help="按时段限速，如 08:00-19:00=5M，时段内代替 --limit，可以重复指定")
+    common.add_argument('--pipeline-depth', type=int, default=DEFAULT_PIPELINE_DEPTH, metavar='N',
+                        help=f"发送时提前读入、接收时等待写盘的最多块数（默认 {DEFAULT_PIPELINE_DEPTH}）")
+    common.add_argument('--mmap-write', action='store_true',
+                        help="并行接收 1GB 以上的文件时通过内存映射写入")
+    common.add_argument('--metrics-prom', metavar='FILE',
+                        help="每次传输结束后把累计的性能指标以 Prometheus 文本格式写入该文件")
+    common.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help="在本机该端口的 /metrics 上提供 Prometheus 格式的性能指标")
+
+    parser = argparse.ArgumentParser(description="局域网文件传输，不带参数运行时打开图形界面")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve', parents=[common], help="等待对方连接，接收推送并响应浏览和拉取")
+    serve.add_argument('--dir', help="对方未指定保存位置时的保存目录，也是对方浏览时的初始目录")
+
+    ls = commands.add_parser('ls', parents=[common], help="列出对方的文件")
+    ls.add_argument('host', help="对方地址")
+    ls.add_argument('path', nargs='?', help="对方的目录，默认为对方当前所在的目录")
+
+    push = commands.add_parser('push', parents=[common], help="推送文件或文件夹到对方")
+    push.add_argument('host', help="对方地址")
+    push.add_argument('files', nargs='+', help="本地文件或文件夹")
+    push.add_argument('--to', default="", help="对方的保存目录，默认由对方决定")
+
+    pull = commands.add_parser('pull', parents=[common], help="从对方拉取文件或文件夹")
+    pull.add_argument('host', help="对方地址")
+    pull.add_argument('files', nargs='+', help="对方文件或文件夹的完整路径")
+    pull.add_argument('--to', default=None, help="本地保存目录，默认为当前目录")
+
+    sync = commands.add_parser('sync', parents=[common], help="让对方目录与本地目录一致，只推送缺少或变化的文件")
+    sync.add_argument('host', help="对方地址")
+    sync.add_argument('local', help="本地目录")
+    sync.add_argument('remote', help="对方目录，不存在时自动创建")
+    sync.add_argument('--dry-run', action='store_true', help="只列出需要传输的文件，不实际传输")
+    sync.add_argument('--checksum', action='store_true',
+                      help="大小相同的文件比较摘要而不是修改时间，较慢但更可靠")
+    return parser
+
+class ConsoleReporter:
+    """在终端输出引擎的状态和传输进度，并记录每个传输项的结果"""
+    def __init__(self, engine):
+        self.results = {}  # 传输项的最终状态，按文件路径索引
+        self.speed = ""
+        self._progress_shown = False
+        self._interactive = sys.stdout.isatty()
+        signals = engine.signals
+        signals.connect('status_updated', self.on_status)
+        signals.connect('speed_updated', self.on_speed)
+        signals.connect('queue_item_updated', self.on_item_updated)
+        signals.connect('warning_occurred', self.on_error)
+        signals.connect('error_occurred', self.on_error)
+
+    def write_line(self, text, stream=None):
+        if self._progress_shown:
+            print()
+            self._progress_shown = False
+        print(text, file=stream or sys.stdout, flush=True)
+
+    def on_status(self, status):
+        self.write_line(status)
+
+    def on_speed(self, speed):
+        self.speed = speed
+
+    def on_error(self, message):
+        self.write_line(message, sys.stderr)
+
+    def on_item_updated(self, file_path, status, progress):
+        if status in ("完成", "失败"):
+            self.results[file_path] = status
+            self.write_line(f"{status}: {file_path}")
+        elif status is not None:
+            self.write_line(f"{status}: {file_path}")
+        elif progress is not None and self._interactive:
+            # 进度在同一行刷新，输出重定向到文件时不显示
+            print(f"\r  {progress:3d}%  {self.speed}    ", end="", flush=True)
+            self._progress_shown = True
+
+ENTRY_TYPES = {'drive': "驱动器", 'dir': "文件夹", 'file': "文件"}
+
+def format_entry(entry):
+    """ls 输出的一行：类型、大小、修改时间、名称"""
+    if entry['type'] == 'drive':
+        return f"  {ENTRY_TYPES['drive']}  {entry['name']}"
+    size = format_size(entry['size']) if entry['type'] == 'file' else ""
+    mtime = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry.get('mtime', 0)))
+    return f"  {ENTRY_TYPES.get(entry['type'], entry['type'])}  {size:>9}  {mtime}  {entry['name']}"
+
+def run_serve(engine, args):
+    if args.dir:
+        engine.save_dir = os.path.abspath(args.dir)
+        engine.current_local_directory = engine.save_dir
+    if not engine.start_server():
+        return 1
+    print(f"等待连接，端口 {args.port}，按 Ctrl+C 退出")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.close()
+    return 0
+
+def run_transfers(engine, reporter, file_paths, enqueue):
+    """将文件加入队列并等待全部完成，全部成功时返回 0
+
+    推送只有在对方校验通过并回复确认后才算完成，对方校验失败或没有确认时返回 1
+    """
+    queued = []
+    for file_path in file_paths:
+        try:
+            queued.append(enqueue(file_path))
+        except Exception as e:
+            reporter.write_line(f"无法添加 {file_path}: {str(e)}", sys.stderr)
+    engine.wait_idle()
+
+    # 连接中途断开时，未完成的传输项不会有结果
+    succeeded = sum(1 for path in queued if reporter.results.get(path) == "完成")
+    print(f"完成 {succeeded}/{len(file_paths)} 个文件")
+    return 0 if succeeded == len(file_paths) else 1
+
+def run_sync(engine, reporter, args):
+    """比较两边的目录清单，只推送缺少或变化的文件"""
+    plan, extra = engine.plan_sync(args.local, args.remote, compare_digest=args.checksum)
+    for item in plan:
+        print(f"{item['action']}: {item['path']} ({format_size(item['size'])})")
+    total_size = sum(item['size'] for item in plan)
+    print(f"需要传输 {len(plan)} 个文件，共 {format_size(total_size)}")
+    if extra:
+        print(f"对方另有 {len(extra)} 个本地没有的文件，不会删除")
+    if args.dry_run or not plan:
+        return 0
+
+    save_paths = {item['local_path']: item['save_path'] for item in plan}
+    return run_transfers(engine, reporter, list(save_paths),
+                         lambda path: engine.enqueue_push(path, save_paths[path]))
+
+def run_cli(args):
+    engine = TransferEngine(port=args.port)
+    engine.hash_algorithm = args.hash
+    engine.parallel_streams = max(1, args.streams)
+    if args.compress:
+        engine.compression = available_codecs() if args.compress == 'auto' else [args.compress]
+    engine.rate_limit = args.limit
+    engine.peer_rate_limit = args.limit_peer
+    engine.transfer_rate_limit = args.limit_transfer
+    engine.rate_schedule = args.limit_schedule
+    engine.pipeline_depth = max(1, args.pipeline_depth)
+    engine.mmap_writes = args.mmap_write
+    engine.metrics.prometheus_path = args.metrics_prom
+    if args.metrics_port:
+        try:
+            engine.metrics.serve(args.metrics_port)
+        except OSError as e:
+            print(f"无法在端口 {args.metrics_port} 提供性能指标: {str(e)}", file=sys.stderr)
+            return 1
+
+    if args.command == 'serve':
+        ConsoleReporter(engine)
+        return run_serve(engine, args)
+
+    try:
+        engine.connect(args.host)
+    except Exception as e:
+        print(f"连接 {args.host} 失败: {str(e)}", file=sys.stderr)
+        return 1
+
+    reporter = ConsoleReporter(engine)
+    try:
+        if args.command == 'ls':
+            entries, path = engine.list_remote(args.path)
+            print(f"{path or '根目录'}:")
+            for entry in entries:
+                print(format_entry(entry))
+            return 0
+        if args.command == 'sync':
+            return run_sync(engine, reporter, args)
+        if args.command == 'push':
+            file_paths = [os.path.abspath(path) for path in args.files]
+            return run_transfers(engine, reporter, file_paths,
+                                 lambda path: engine.enqueue_push(path, args.to))
+        save_path = os.path.abspath(args.to or os.getcwd())
+        return run_transfers(engine, reporter, args.files,
+                             lambda path: engine.enqueue_pull(path, save_path))
+    except Exception as e:
+        print(f"错误: {str(e)}", file=sys.stderr)
+        return 1
+    finally:
+        engine.close()
+
+def main():
+    # 引擎的运行信息和警告通过 logging 输出到标准错误，与命令行的结果输出分开
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if len(sys.argv) == 1:
+        run_gui()
+        return
+    sys.exit(run_cli(build_parser().parse_args()))
+
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    main()
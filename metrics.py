@@ -0,0 +1,213 @@
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 传输的性能记录：每次传输结束时追加一行 JSON，同时累计为 Prometheus 文本格式的指标，
+# 可以写入文件供 node_exporter 的 textfile collector 读取，也可以在本机端口上提供 /metrics。
+# 各阶段的时间分别在执行它的线程中累计，读盘、发送和写盘同时进行时总和可以超过传输的总时间；
+# 哪个阶段占用的时间接近总时间，传输就受限于哪一方。
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_METRICS_PATH = os.path.join(os.path.expanduser("~"), ".file_transfer_metrics.jsonl")
+
+# 阶段名 -> 说明
+PHASES = {
+    'disk_read': "读取源文件",
+    'socket_send': "发送数据（sendfile 时包含内核读盘）",
+    'socket_recv': "等待和接收数据",
+    'disk_write': "写入目标文件",
+    'hashing': "计算摘要",
+    'compression': "压缩和解压",
+    'throttle': "限速等待",
+}
+
+
+class _PhaseTimer:
+    __slots__ = ('metrics', 'phase', 'start')
+
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.add(self.phase, time.perf_counter() - self.start)
+
+
+class TransferMetrics:
+    """一次传输（发送或接收一个文件、文件夹或一批文件）的性能记录"""
+
+    def __init__(self, direction, name, peer=""):
+        self.direction = direction  # send 或 receive
+        self.name = name
+        self.peer = peer
+        self.started = time.time()
+        self.wall_time = None  # 传输结束时记录的总时间
+        self.bytes = 0  # 实际传输的文件数据字节数，不含跳过的续传部分和增量传输中复制的块
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.retries = 0
+        self.chunk_size = None
+        self.stalls = {}  # 流水线中等待磁盘和等待网络的秒数
+        self.status = 'failed'
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def timing(self, phase):
+        """计时上下文：with metrics.timing('disk_read'): ..."""
+        return _PhaseTimer(self, phase)
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.phases[phase] += seconds
+
+    def add_bytes(self, n):
+        with self._lock:
+            self.bytes += n
+
+    def finish(self, ok):
+        self.wall_time = time.perf_counter() - self._start
+        self.status = 'ok' if ok else 'failed'
+
+    def to_dict(self):
+        wall_time = self.wall_time if self.wall_time is not None else time.perf_counter() - self._start
+        record = {
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            'direction': self.direction,
+            'name': self.name,
+            'peer': self.peer,
+            'status': self.status,
+            'bytes': self.bytes,
+            'wall_time': round(wall_time, 6),
+            'throughput': round(self.bytes / wall_time) if wall_time > 0 else None,
+            'retries': self.retries,
+            'chunk_size': self.chunk_size,
+        }
+        for phase, seconds in self.phases.items():
+            record[f'{phase}_time'] = round(seconds, 6)
+        for side, seconds in self.stalls.items():
+            record[f'stall_{side}_time'] = round(seconds, 6)
+        return record
+
+
+class MetricsRecorder:
+    """汇总所有传输的性能记录
+
+    每条记录追加到 path 指定的 JSON lines 文件，超过 max_size 时改名为 .1 重新开始；
+    设置 prometheus_path 后每次记录都重写该文件；serve 在本机端口提供同样的内容。
+    写文件失败时只输出提示，不影响传输。
+    """
+
+    def __init__(self, path=DEFAULT_METRICS_PATH, max_size=10485760):
+        self.path = path  # 为 None 时不写 JSON lines 文件
+        self.max_size = max_size
+        self.prometheus_path = None  # Prometheus 文本格式的输出文件
+        self._lock = threading.Lock()
+        self._transfers = {}  # (方向, 状态) -> 传输数
+        self._bytes = {}  # 方向 -> 字节数
+        self._wall_time = {}  # 方向 -> 秒数
+        self._phases = {}  # (方向, 阶段) -> 秒数
+        self._retries = {}  # 方向 -> 重试次数
+        self._last_throughput = {}  # 方向 -> 最近一次传输的吞吐量
+        self._server = None
+
+    def record(self, metrics):
+        record = metrics.to_dict()
+        direction = record['direction']
+        with self._lock:
+            key = (direction, record['status'])
+            self._transfers[key] = self._transfers.get(key, 0) + 1
+            self._bytes[direction] = self._bytes.get(direction, 0) + record['bytes']
+            self._wall_time[direction] = self._wall_time.get(direction, 0.0) + record['wall_time']
+            self._retries[direction] = self._retries.get(direction, 0) + record['retries']
+            for phase, seconds in metrics.phases.items():
+                self._phases[direction, phase] = self._phases.get((direction, phase), 0.0) + seconds
+            if record['status'] == 'ok' and record['throughput'] is not None:
+                self._last_throughput[direction] = record['throughput']
+            self._append(record)
+            if self.prometheus_path:
+                self._write_prometheus()
+
+    def _append(self, record):
+        if not self.path:
+            return
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_size:
+                os.replace(self.path, self.path + ".1")
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.warning(f"写入传输记录失败: {str(e)}")
+
+    def _write_prometheus(self):
+        try:
+            temp_path = self.prometheus_path + ".tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(self._prometheus_text())
+            os.replace(temp_path, self.prometheus_path)
+        except Exception as e:
+            logger.warning(f"写入指标文件失败: {str(e)}")
+
+    def prometheus_text(self):
+        """Prometheus 文本格式的累计指标"""
+        with self._lock:
+            return self._prometheus_text()
+
+    def _prometheus_text(self):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+                lines.append(f"{name}{{{label_text}}} {value}")
+
+        metric("file_transfer_transfers_total", "counter", "结束的传输数",
+               [((('direction', d), ('status', s)), n) for (d, s), n in sorted(self._transfers.items())])
+        metric("file_transfer_bytes_total", "counter", "传输的文件数据字节数",
+               [((('direction', d),), n) for d, n in sorted(self._bytes.items())])
+        metric("file_transfer_seconds_total", "counter", "传输所用的总时间",
+               [((('direction', d),), round(n, 6)) for d, n in sorted(self._wall_time.items())])
+        metric("file_transfer_phase_seconds_total", "counter", "各阶段所用的时间",
+               [((('direction', d), ('phase', p)), round(n, 6)) for (d, p), n in sorted(self._phases.items())])
+        metric("file_transfer_retries_total", "counter", "超时后重试的次数",
+               [((('direction', d),), n) for d, n in sorted(self._retries.items())])
+        metric("file_transfer_last_throughput_bytes", "gauge", "最近一次成功传输的每秒字节数",
+               [((('direction', d),), n) for d, n in sorted(self._last_throughput.items())])
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """在本机端口上提供 /metrics，返回实际监听的端口"""
+        recorder = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = recorder.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # 不输出每个请求
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address[1]
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
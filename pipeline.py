@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import deque
+
+# 磁盘和网络同时工作：发送时读取线程提前把文件数据读入有界队列，接收时写入线程在后台写盘，
+# 吞吐量取决于较慢的一方，而不是两者交替进行时的 1/(1/磁盘 + 1/网络)。
+# 两端各自统计等待次数和时间，哪一方等得多，另一方就是瓶颈。
+
+DEFAULT_PIPELINE_DEPTH = 8  # 队列中最多等待的块数
+DEFAULT_POOL_BYTES = 67108864  # 缓冲区池最多保留 64MB 空闲缓冲区
+
+
+class StallCounter:
+    """一方因另一方跟不上而等待的次数和总时间"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+
+    def __str__(self):
+        return f"{self.count} 次，共 {self.seconds:.2f} 秒"
+
+
+class BufferPool:
+    """多个传输共用的缓冲区池
+
+    缓冲区大小取整到 2 的幂，按大小分组复用；池中空闲缓冲区的总大小不超过 max_bytes，
+    超出时还回的缓冲区直接丢弃。稳定传输时每块数据都使用池中已有的缓冲区，不再分配内存。
+    """
+
+    def __init__(self, max_bytes=DEFAULT_POOL_BYTES):
+        self.max_bytes = max_bytes
+        self.idle_bytes = 0  # 池中空闲缓冲区的总大小
+        self.allocations = 0  # 池中没有合适的缓冲区、新分配的次数
+        self._free = {}  # 大小 -> 空闲缓冲区列表
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        """返回至少 size 字节的缓冲区，用完后通过 release 还回"""
+        size = 1 << max(0, size - 1).bit_length()
+        with self._lock:
+            buffers = self._free.get(size)
+            if buffers:
+                self.idle_bytes -= size
+                return buffers.pop()
+            self.allocations += 1
+        return bytearray(size)
+
+    def release(self, buffer):
+        size = len(buffer)
+        if size & (size - 1):
+            return  # 不是池分配的缓冲区
+        with self._lock:
+            if self.idle_bytes + size <= self.max_bytes:
+                self._free.setdefault(size, []).append(buffer)
+                self.idle_bytes += size
+
+
+class BufferQueue:
+    """生产者和消费者线程之间的有界队列
+
+    最多 depth 项等待处理。队列满时生产者等待，计入 producer_stalls，说明消费者是瓶颈；
+    队列空时消费者等待，计入 consumer_stalls，说明生产者是瓶颈。缓冲区从 pool 中取出，
+    用完后通过 recycle 还回。任何一方出错时调用 close(error)，另一方正在进行和之后的 put/get 抛出该异常。
+    """
+
+    def __init__(self, depth=DEFAULT_PIPELINE_DEPTH, pool=None):
+        self.depth = max(1, depth)
+        self.pool = pool or BufferPool()
+        self.producer_stalls = StallCounter()
+        self.consumer_stalls = StallCounter()
+        self.error = None  # 出错的一方传入的异常
+        self._items = deque()
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def take_buffer(self, size):
+        """返回至少 size 字节的缓冲区"""
+        return self.pool.acquire(size)
+
+    def recycle(self, buffer):
+        self.pool.release(buffer)
+
+    def put(self, item):
+        with self._condition:
+            if len(self._items) >= self.depth and self.error is None:
+                start = time.monotonic()
+                self._condition.wait_for(lambda: len(self._items) < self.depth or self.error is not None)
+                self.producer_stalls.add(time.monotonic() - start)
+            if self.error is not None:
+                raise self.error
+            self._items.append(item)
+            self._condition.notify_all()
+
+    def get(self):
+        """取出下一项，生产者已结束且队列为空时返回 None"""
+        with self._condition:
+            if not self._items and not self._closed and self.error is None:
+                start = time.monotonic()
+                self._condition.wait_for(lambda: self._items or self._closed or self.error is not None)
+                self.consumer_stalls.add(time.monotonic() - start)
+            if self.error is not None:
+                raise self.error
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._condition.notify_all()
+            return item
+
+    def close(self, error=None):
+        """生产者结束时不带参数调用，消费者取完剩余的项后 get 返回 None；出错时传入异常"""
+        with self._condition:
+            self._closed = True
+            if error is not None and self.error is None:
+                self.error = error
+            self._condition.notify_all()
+
+
+class WriteBehind:
+    """在后台线程中按提交顺序执行写入操作
+
+    接收线程把收到的数据和写入它的函数交给 submit 后立即继续接收；数据所在的缓冲区执行完后还回缓冲区池，
+    接收线程直接读入池中的缓冲区，写入线程直接写出它的视图，中间不复制。
+    finish 等待已提交的操作全部完成，写入出错时抛出该错误。
+    """
+
+    def __init__(self, depth=DEFAULT_PIPELINE_DEPTH, pool=None):
+        self.queue = BufferQueue(depth, pool)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def take_buffer(self, size):
+        return self.queue.take_buffer(size)
+
+    def submit(self, func, *args, buffer=None):
+        """提交 func(*args)，写入线程已出错时抛出该错误"""
+        self.queue.put((func, args, buffer))
+
+    def _run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    return
+                func, args, buffer = item
+                func(*args)
+                if buffer is not None:
+                    self.queue.recycle(buffer)
+        except Exception as e:
+            self.queue.close(e)
+
+    def close(self):
+        """不再提交，等待写入线程执行完已提交的操作"""
+        self.queue.close()
+        self._thread.join()
+
+    def finish(self):
+        self.close()
+        if self.queue.error is not None:
+            raise self.queue.error
+
+    def stalls(self):
+        """(等待写盘, 等待网络)：前者多说明磁盘是瓶颈，后者多说明网络是瓶颈"""
+        return self.queue.producer_stalls, self.queue.consumer_stalls
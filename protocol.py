@@ -0,0 +1,125 @@
+import json
+import socket
+import struct
+import threading
+
+# 帧格式：版本(1字节) + 类型(1字节) + 负载长度(4字节，网络字节序) + 负载
+PROTOCOL_VERSION = 1
+FRAME_HEADER = struct.Struct('!BBI')
+MAX_FRAME_SIZE = 67108864  # 单帧负载最大 64MB
+
+MSG_JSON = 1           # 控制消息，负载为 JSON
+MSG_FILE_HEADER = 2    # 文件信息，负载为 JSON
+MSG_FILE_DATA = 3      # 文件数据，负载为原始字节
+MSG_FILE_TRAILER = 4   # 文件摘要，负载为 JSON
+MSG_STREAM_HELLO = 5   # 并行数据连接的握手，负载为 JSON，之后是原始数据
+MSG_SESSION_HELLO = 6  # 控制连接的握手，负载为 JSON，每条控制连接是一个独立的会话
+MSG_FOLDER_HEADER = 7  # 文件夹清单，负载为 JSON，之后依次是各文件的数据帧和摘要尾部
+MSG_FILE_COPY = 8      # 增量传输的复制指令，负载为 JSON，接收方从已有文件中复制若干个块
+MSG_FILE_COMPRESSED = 9  # 压缩的文件数据，负载为压缩算法编号、原始长度和压缩后的数据
+
+
+class ProtocolError(Exception):
+    """收到不符合协议的数据"""
+
+
+class ConnectionClosed(ConnectionError):
+    """对方在两帧之间关闭了连接，属于正常断开"""
+
+
+def encode_frame(msg_type, payload=b""):
+    """编码一个完整的帧"""
+    return FRAME_HEADER.pack(PROTOCOL_VERSION, msg_type, len(payload)) + payload
+
+
+def encode_json(message):
+    return json.dumps(message, ensure_ascii=False).encode('utf-8')
+
+
+def decode_json(payload):
+    try:
+        return json.loads(bytes(payload).decode('utf-8'))
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ProtocolError(f"无效的消息内容: {str(e)}")
+
+
+class FrameSocket:
+    """在 socket 上收发带长度前缀的二进制帧
+
+    每条消息都是一次定长读取，不需要查找分隔符或猜测消息类型。
+    发送加可重入锁，多个线程可以共用一条连接，文件数据帧在锁内用 sendfile 发送。
+    """
+
+    def __init__(self, sock, wait_on_timeout=False):
+        self.sock = sock
+        self.send_lock = threading.RLock()
+        self.wait_on_timeout = wait_on_timeout  # 超时后是否继续等待（空闲的控制连接）
+        self._header = bytearray(FRAME_HEADER.size)
+
+    def send_frame(self, msg_type, payload=b""):
+        if len(payload) <= 65536:
+            # 小消息拼成一次发送
+            frame = encode_frame(msg_type, payload)
+            with self.send_lock:
+                self.sock.sendall(frame)
+            return
+        with self.send_lock:
+            self.send_frame_header(msg_type, len(payload))
+            self.sock.sendall(payload)
+
+    def send_frame_header(self, msg_type, length):
+        """只发送帧头，调用方需持有 send_lock 并随后发送 length 字节的负载"""
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"帧过大: {length}")
+        with self.send_lock:
+            self.sock.sendall(FRAME_HEADER.pack(PROTOCOL_VERSION, msg_type, length))
+
+    def send_message(self, msg_type, message):
+        self.send_frame(msg_type, encode_json(message))
+
+    def send_json(self, message):
+        """发送控制消息"""
+        self.send_message(MSG_JSON, message)
+
+    def recv_into_exact(self, view, between_frames=False):
+        """读满给定的缓冲区；between_frames 为真且一个字节都没有读到时连接关闭，抛出 ConnectionClosed"""
+        received = 0
+        while received < len(view):
+            try:
+                n = self.sock.recv_into(view[received:])
+            except socket.timeout:
+                if self.wait_on_timeout:
+                    continue
+                raise
+            if not n:
+                if between_frames and not received:
+                    raise ConnectionClosed("对方已关闭连接")
+                raise ConnectionError("连接已断开")
+            received += n
+
+    def recv_exact(self, length):
+        buffer = bytearray(length)
+        self.recv_into_exact(memoryview(buffer))
+        return buffer
+
+    def recv_frame_header(self):
+        """读取帧头，返回 (类型, 负载长度)"""
+        self.recv_into_exact(memoryview(self._header), between_frames=True)
+        version, msg_type, length = FRAME_HEADER.unpack(self._header)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError(f"不支持的协议版本: {version}")
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError(f"帧过大: {length}")
+        return msg_type, length
+
+    def recv_frame(self):
+        """读取一个完整的帧，返回 (类型, 负载)"""
+        msg_type, length = self.recv_frame_header()
+        return msg_type, self.recv_exact(length)
+
+    def recv_message(self):
+        """读取一个 JSON 负载的帧，返回 (类型, 消息)"""
+        msg_type, payload = self.recv_frame()
+        if msg_type == MSG_FILE_DATA:
+            raise ProtocolError("意外的文件数据帧")
+        return msg_type, decode_json(payload)
@@ -0,0 +1,93 @@
+import re
+import threading
+import time
+
+# 发送限速：全局、每个对方和每次传输各有一个令牌桶，发送一块数据前向所有相关的桶预约额度，
+# 按最晚可以发送的时间等待。每个发送线程每次只预约一块，同时进行的传输轮流取得额度，平分带宽。
+
+MIN_PACE_SIZE = 16384  # 限速时每块至少 16KB
+PACE_INTERVAL = 0.1  # 限速时每块数据约为 0.1 秒的额度，调整限速后很快生效
+
+_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(text):
+    """解析每秒字节数，支持 K/M/G 后缀（如 512K、10M），0、空字符串或 none 表示不限速"""
+    text = (text or "").strip().upper()
+    if text in ("", "0", "NONE"):
+        return None
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*([KMG]?)(?:B|B/S|/S)?", text)
+    if not match:
+        raise ValueError(f"无效的速度: {text}")
+    rate = int(float(match.group(1)) * _UNITS[match.group(2)])
+    return rate or None
+
+
+def parse_schedule(text):
+    """解析限速时段 "08:00-19:00=5M"，返回 (开始分钟, 结束分钟, 每秒字节数)；结束早于开始时跨过午夜，
+    结束时间可以写作 24:00 表示到当天结束"""
+    match = re.fullmatch(r"\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*=\s*(\S+)\s*", text)
+    if not match:
+        raise ValueError(f"无效的限速时段: {text}")
+    start_hour, start_minute, end_hour, end_minute = (int(value) for value in match.groups()[:4])
+    if (start_hour > 23 or start_minute > 59 or end_minute > 59
+            or end_hour > 24 or (end_hour == 24 and end_minute > 0)):
+        raise ValueError(f"无效的限速时段: {text}")
+    return start_hour * 60 + start_minute, end_hour * 60 + end_minute, parse_rate(match.group(5))
+
+
+def scheduled_rate(schedule, default, now=None):
+    """返回当前时刻所在时段的限速，不在任何时段内时返回 default"""
+    if schedule:
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for start, end, rate in schedule:
+            if start <= minute < end or (end < start and (minute >= start or minute < end)):
+                return rate
+    return default
+
+
+class RateLimiter:
+    """令牌桶限速器
+
+    rate 为每秒字节数或返回它的函数，每次预约时重新读取，修改后立即生效；为 None 或 0 时不限速。
+    空闲之后允许立即发送 burst 秒的额度。
+    """
+
+    def __init__(self, rate=None, burst=0.25):
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._next_time = 0.0  # 之前预约的额度全部用完的时刻
+
+    def current_rate(self):
+        rate = self.rate() if callable(self.rate) else self.rate
+        return rate or None
+
+    def reserve(self, size):
+        """预约 size 字节的发送额度，返回需要等待的秒数"""
+        rate = self.current_rate()
+        if rate is None:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next_time, now)
+            self._next_time = start + size / rate
+            return max(0.0, self._next_time - now - self.burst)
+
+
+def throttle(limiters, size):
+    """向所有限速器预约 size 字节的额度，等到都允许发送时返回"""
+    delay = 0.0
+    for limiter in limiters:
+        delay = max(delay, limiter.reserve(size))
+    if delay > 0:
+        time.sleep(delay)
+
+
+def pace_size(limiters, size):
+    """限速时把一次发送的数据量限制在约 0.1 秒的额度内，不限速时原样返回"""
+    rates = [rate for rate in (limiter.current_rate() for limiter in limiters) if rate]
+    if not rates:
+        return size
+    return min(size, max(MIN_PACE_SIZE, int(min(rates) * PACE_INTERVAL)))
@@ -0,0 +1,61 @@
+import os
+import zlib
+
+import pytest
+
+from compress import COMPRESSED_HEADER, ChunkCompressor, available_codecs, decompress_payload
+
+ZLIB = 1
+
+
+def compressed(data, size=None, codec_id=ZLIB):
+    return COMPRESSED_HEADER.pack(codec_id, len(data) if size is None else size) + zlib.compress(data)
+
+
+@pytest.mark.parametrize('codec', available_codecs())
+def test_round_trip(codec):
+    data = b"hello world " * 20000
+    payload = ChunkCompressor(codec).compress(data)
+    assert payload is not None and len(payload) < len(data)
+    assert decompress_payload(payload, len(data)) == data
+
+
+def test_incompressible_data_is_sent_as_is():
+    assert ChunkCompressor('zlib').compress(os.urandom(262144)) is None
+
+
+def test_size_within_limit():
+    data = b"a" * 1000
+    assert decompress_payload(compressed(data), 1000) == data
+
+
+def test_rejects_size_over_limit():
+    with pytest.raises(ValueError):
+        decompress_payload(compressed(b"a" * 1000), 999)
+
+
+def test_rejects_size_zero():
+    # 声明长度为 0 时解压函数不限制输出，必须在解压前拒绝
+    with pytest.raises(ValueError):
+        decompress_payload(compressed(bytes(10485760), size=0), 1048576)
+
+
+def test_output_bounded_by_declared_size():
+    # 实际数据比声明的长时只解压出声明的长度，之后由文件摘要发现数据不符
+    assert decompress_payload(compressed(b"a" * 1000, size=10), 1000) == b"a" * 10
+
+
+def test_rejects_overstated_size():
+    with pytest.raises(ValueError):
+        decompress_payload(compressed(b"a" * 10, size=1000), 1000)
+
+
+@pytest.mark.parametrize('payload', [b"", b"\x01\x00", COMPRESSED_HEADER.pack(99, 10) + b"x"])
+def test_rejects_malformed_header(payload):
+    with pytest.raises(ValueError):
+        decompress_payload(payload, 1000)
+
+
+def test_rejects_corrupt_data():
+    with pytest.raises(zlib.error):
+        decompress_payload(COMPRESSED_HEADER.pack(ZLIB, 10) + b"garbage", 1000)
@@ -0,0 +1,108 @@
+import base64
+import hashlib
+import io
+import os
+import random
+
+import pytest
+
+from delta import (LITERAL_LIMIT, DeltaEncoder, block_count, block_size_for, blocks_length, copy_blocks,
+                   file_signatures)
+
+
+def apply_delta(basis_path, basis_size, block_size, instructions):
+    """按增量指令重建文件，返回 (文件内容, 变化数据的字节数)"""
+    out = io.BytesIO()
+    literal = 0
+    with open(basis_path, 'rb') as basis:
+        for instruction in instructions:
+            if instruction[0] == 'data':
+                out.write(instruction[1])
+                literal += len(instruction[1])
+            else:
+                _, start, count, length = instruction
+                assert copy_blocks(basis, basis_size, block_size, start, count, out, hashlib.sha256()) == length
+    return out.getvalue(), literal
+
+
+def round_trip(tmp_path, old, new):
+    basis_path = tmp_path / "basis"
+    basis_path.write_bytes(old)
+    block_size = block_size_for(len(old))
+    encoder = DeltaEncoder(block_size, len(old), file_signatures(basis_path, block_size))
+    hasher = hashlib.sha256()
+    result, literal = apply_delta(basis_path, len(old), block_size,
+                                  encoder.instructions(io.BytesIO(new), len(new), hasher))
+    assert result == new
+    assert hasher.digest() == hashlib.sha256(new).digest()
+    return literal
+
+
+@pytest.fixture(scope='module')
+def old():
+    return random.Random(1).randbytes(3000000)
+
+
+def test_identical_file(tmp_path, old):
+    assert round_trip(tmp_path, old, old) == 0
+
+
+def test_edit_in_place(tmp_path, old):
+    new = bytearray(old)
+    new[1000000:1000100] = bytes(100)
+    assert round_trip(tmp_path, old, bytes(new)) <= block_size_for(len(old))
+
+
+def test_insert(tmp_path, old):
+    new = old[:5000] + b"inserted" + old[5000:]
+    assert round_trip(tmp_path, old, new) <= 2 * block_size_for(len(old))
+
+
+def test_changed_tail(tmp_path, old):
+    assert round_trip(tmp_path, old, old[:-10] + b"0123456789abc") <= 2 * block_size_for(len(old))
+
+
+def test_unrelated_file(tmp_path, old):
+    # 几乎没有相同的块时放弃查找，全部作为变化的数据发送
+    new = os.urandom(len(old) + 37)
+    assert round_trip(tmp_path, old, new) == len(new)
+
+
+def test_literal_chunks_are_bounded(tmp_path, old):
+    basis_path = tmp_path / "basis"
+    basis_path.write_bytes(old)
+    block_size = block_size_for(len(old))
+    encoder = DeltaEncoder(block_size, len(old), file_signatures(basis_path, block_size))
+    new = os.urandom(3 * LITERAL_LIMIT)
+    for instruction in encoder.instructions(io.BytesIO(new), len(new), hashlib.sha256()):
+        assert len(instruction[1]) <= LITERAL_LIMIT
+
+
+def test_truncated_source(tmp_path, old):
+    basis_path = tmp_path / "basis"
+    basis_path.write_bytes(old)
+    block_size = block_size_for(len(old))
+    encoder = DeltaEncoder(block_size, len(old), file_signatures(basis_path, block_size))
+    with pytest.raises(ValueError):
+        list(encoder.instructions(io.BytesIO(old[:1000]), len(old), hashlib.sha256()))
+
+
+def test_rejects_malformed_signatures(old):
+    block_size = block_size_for(len(old))
+    count = block_count(len(old), block_size)
+    with pytest.raises(ValueError):
+        DeltaEncoder(block_size, len(old), base64.b64encode(bytes(20 * (count - 1))).decode())
+    with pytest.raises(ValueError):
+        DeltaEncoder(block_size, len(old), base64.b64encode(bytes(20 * count + 3)).decode())
+    with pytest.raises(ValueError):
+        DeltaEncoder(0, len(old), "")
+
+
+@pytest.mark.parametrize('start, count', [(-1, 1), (0, 0), (184, 1), (183, 2), (0, 185)])
+def test_rejects_invalid_block_numbers(start, count):
+    with pytest.raises(ValueError):
+        blocks_length(3000000, 16384, start, count)
+
+
+def test_last_block_length():
+    assert blocks_length(3000000, 16384, 183, 1) == 3000000 - 183 * 16384
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from digest import HASH_ALGORITHMS, TreeHash, hash_file, hash_range, hash_ranges, is_supported, new_hasher
+
+LEAF = 4194304
+
+
+@pytest.fixture(scope='module')
+def data_file(tmp_path_factory):
+    # 两个半叶子块，覆盖叶子边界和最后不足一块的情况
+    path = tmp_path_factory.mktemp("digest") / "data.bin"
+    path.write_bytes(os.urandom(2 * LEAF + 12345))
+    return str(path)
+
+
+def streamed(path, algorithm, chunk):
+    hasher = new_hasher(algorithm)
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+@pytest.mark.parametrize('algorithm', sorted(HASH_ALGORITHMS))
+def test_parallel_matches_streaming(data_file, algorithm):
+    # 多线程计算与任意块大小的流式计算结果相同
+    expected = streamed(data_file, algorithm, 65536)
+    assert streamed(data_file, algorithm, 1000003) == expected
+    assert hash_file(data_file, algorithm, workers=4) == expected
+    assert hash_file(data_file, algorithm, workers=1) == expected
+
+
+@pytest.mark.parametrize('algorithm', ['tree-blake2b', 'tree-sha256'])
+def test_tree_hash_small_and_empty(tmp_path, algorithm):
+    for size in (0, 1, LEAF):
+        path = tmp_path / f"{size}.bin"
+        path.write_bytes(os.urandom(size))
+        assert hash_file(str(path), algorithm) == streamed(str(path), algorithm, 65536)
+
+
+def test_tree_hash_copy(data_file):
+    hasher = new_hasher('tree-blake2b')
+    with open(data_file, 'rb') as f:
+        hasher.update(f.read(LEAF + 100))
+        copy = hasher.copy()
+        rest = f.read()
+    hasher.update(rest)
+    copy.update(rest)
+    assert isinstance(copy, TreeHash)
+    assert copy.hexdigest() == hasher.hexdigest() == hash_file(data_file, 'tree-blake2b')
+
+
+def test_hash_ranges(data_file):
+    ranges = [(0, 100), (LEAF - 50, 200), (2 * LEAF, 12345), (10, 0)]
+    expected = [hash_range(data_file, new_hasher('sha256'), offset, length).hexdigest()
+                for offset, length in ranges]
+    assert hash_ranges(data_file, 'sha256', ranges) == expected
+
+
+def test_hash_range_past_end(data_file):
+    with pytest.raises(ValueError):
+        hash_range(data_file, new_hasher('sha256'), 2 * LEAF, 20000)
+
+
+def test_unsupported_algorithm():
+    assert not is_supported('sha1')
+    with pytest.raises(ValueError):
+        new_hasher('sha1')
@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+from pipeline import BufferPool, BufferQueue, WriteBehind
+
+
+def test_buffer_pool_reuses_buffers():
+    pool = BufferPool(max_bytes=4096)
+    buffer = pool.acquire(1000)
+    assert len(buffer) == 1024
+    pool.release(buffer)
+    assert pool.acquire(1024) is buffer
+    assert pool.allocations == 1
+
+
+def test_buffer_pool_limits_idle_bytes():
+    pool = BufferPool(max_bytes=4096)
+    buffers = [pool.acquire(4096), pool.acquire(4096)]
+    for buffer in buffers:
+        pool.release(buffer)
+    assert pool.idle_bytes == 4096
+    pool.release(bytearray(1000))  # 不是池分配的缓冲区
+    assert pool.idle_bytes == 4096
+
+
+def test_queue_keeps_order():
+    queue = BufferQueue(depth=2)
+
+    def produce():
+        for i in range(100):
+            queue.put(i)
+        queue.close()
+
+    thread = threading.Thread(target=produce)
+    thread.start()
+    items = []
+    while (item := queue.get()) is not None:
+        items.append(item)
+    thread.join()
+    assert items == list(range(100))
+
+
+def test_queue_error_reaches_both_sides():
+    queue = BufferQueue(depth=1)
+    queue.put(1)
+    queue.close(OSError("磁盘已满"))
+    with pytest.raises(OSError):
+        queue.get()
+    with pytest.raises(OSError):
+        queue.put(2)
+
+
+def test_write_behind_runs_in_order():
+    written = []
+    writer = WriteBehind(depth=4)
+    for i in range(50):
+        buffer = writer.take_buffer(16)
+        writer.submit(written.append, i, buffer=buffer)
+    writer.finish()
+    assert written == list(range(50))
+
+
+def test_write_behind_reports_error():
+    def fail():
+        raise OSError("磁盘已满")
+
+    writer = WriteBehind()
+    writer.submit(fail)
+    with pytest.raises(OSError):
+        writer.finish()
@@ -0,0 +1,87 @@
+import socket
+import struct
+import threading
+
+import pytest
+
+from protocol import (FRAME_HEADER, MAX_FRAME_SIZE, MSG_FILE_DATA, MSG_JSON, PROTOCOL_VERSION, ConnectionClosed,
+                      FrameSocket, ProtocolError, decode_json, encode_frame)
+
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield FrameSocket(a), FrameSocket(b)
+    a.close()
+    b.close()
+
+
+def test_frame_round_trip(pair):
+    sender, receiver = pair
+    sender.send_frame(MSG_FILE_DATA, b"abc")
+    sender.send_json({'type': 'ping', 'name': '文件'})
+    sender.send_frame(MSG_FILE_DATA)
+    assert receiver.recv_frame() == (MSG_FILE_DATA, b"abc")
+    msg_type, payload = receiver.recv_frame()
+    assert msg_type == MSG_JSON and decode_json(payload) == {'type': 'ping', 'name': '文件'}
+    assert receiver.recv_frame() == (MSG_FILE_DATA, b"")
+
+
+def test_large_frame_round_trip(pair):
+    # 超过 64KB 的负载先发帧头再发负载，发送方另起线程，避免双方都阻塞在缓冲区上
+    sender, receiver = pair
+    payload = bytes(range(256)) * 4096
+    thread = threading.Thread(target=sender.send_frame, args=(MSG_FILE_DATA, payload))
+    thread.start()
+    assert receiver.recv_frame() == (MSG_FILE_DATA, payload)
+    thread.join()
+
+
+def test_encode_frame_header():
+    frame = encode_frame(MSG_JSON, b"{}")
+    assert FRAME_HEADER.unpack(frame[:FRAME_HEADER.size]) == (PROTOCOL_VERSION, MSG_JSON, 2)
+    assert frame[FRAME_HEADER.size:] == b"{}"
+
+
+def test_rejects_unknown_version(pair):
+    sender, receiver = pair
+    sender.sock.sendall(FRAME_HEADER.pack(PROTOCOL_VERSION + 1, MSG_JSON, 0))
+    with pytest.raises(ProtocolError):
+        receiver.recv_frame()
+
+
+def test_rejects_oversized_frame(pair):
+    sender, receiver = pair
+    sender.sock.sendall(FRAME_HEADER.pack(PROTOCOL_VERSION, MSG_FILE_DATA, MAX_FRAME_SIZE + 1))
+    with pytest.raises(ProtocolError):
+        receiver.recv_frame()
+    with pytest.raises(ProtocolError):
+        sender.send_frame_header(MSG_FILE_DATA, MAX_FRAME_SIZE + 1)
+
+
+def test_close_between_frames(pair):
+    sender, receiver = pair
+    sender.send_frame(MSG_JSON, b"{}")
+    sender.sock.shutdown(socket.SHUT_WR)
+    assert receiver.recv_frame() == (MSG_JSON, b"{}")
+    with pytest.raises(ConnectionClosed):
+        receiver.recv_frame()
+
+
+@pytest.mark.parametrize('data', [
+    FRAME_HEADER.pack(PROTOCOL_VERSION, MSG_JSON, 10)[:3],  # 帧头不完整
+    FRAME_HEADER.pack(PROTOCOL_VERSION, MSG_JSON, 10) + b"abc",  # 负载不完整
+])
+def test_close_inside_frame(pair, data):
+    sender, receiver = pair
+    sender.sock.sendall(data)
+    sender.sock.shutdown(socket.SHUT_WR)
+    with pytest.raises(ConnectionError) as info:
+        receiver.recv_frame()
+    assert not isinstance(info.value, ConnectionClosed)
+
+
+@pytest.mark.parametrize('payload', [b"\xff\xfe", b"{not json", struct.pack('!I', 1)])
+def test_decode_json_rejects_malformed(payload):
+    with pytest.raises(ProtocolError):
+        decode_json(payload)
@@ -0,0 +1,65 @@
+import time
+
+import pytest
+
+from ratelimit import RateLimiter, pace_size, parse_rate, parse_schedule, scheduled_rate
+
+
+def at(hour, minute):
+    """本地时间当天 hour:minute 的时间戳"""
+    return time.mktime((2024, 6, 1, hour, minute, 0, 0, 0, -1))
+
+
+@pytest.mark.parametrize('text, rate', [
+    ("512K", 524288), ("10M", 10485760), ("1.5g", 1610612736), ("100", 100), ("5MB/s", 5242880),
+    ("", None), ("0", None), ("none", None), (None, None),
+])
+def test_parse_rate(text, rate):
+    assert parse_rate(text) == rate
+
+
+@pytest.mark.parametrize('text', ["fast", "10T", "-5M", "M"])
+def test_parse_rate_rejects_malformed(text):
+    with pytest.raises(ValueError):
+        parse_rate(text)
+
+
+def test_parse_schedule():
+    assert parse_schedule("08:00-19:00=5M") == (480, 1140, 5242880)
+    assert parse_schedule(" 22:30 - 6:15 = 0 ") == (1350, 375, None)
+    assert parse_schedule("19:00-24:00=1M") == (1140, 1440, 1048576)
+
+
+@pytest.mark.parametrize('text', [
+    "08:00-19:00", "8-19=5M", "08:00-19:00=fast", "08:60-19:00=5M", "08:00-19:61=5M",
+    "24:00-01:00=5M", "24:30-01:00=5M", "01:00-24:30=5M", "01:00-25:00=5M", "123:00-01:00=5M",
+])
+def test_parse_schedule_rejects_malformed(text):
+    with pytest.raises(ValueError):
+        parse_schedule(text)
+
+
+def test_scheduled_rate():
+    schedule = [parse_schedule("08:00-19:00=5M"), parse_schedule("22:00-06:00=0"), parse_schedule("19:00-24:00=1M")]
+    assert scheduled_rate(schedule, 7, at(8, 0)) == 5242880
+    assert scheduled_rate(schedule, 7, at(18, 59)) == 5242880
+    assert scheduled_rate(schedule, 7, at(19, 0)) == 1048576
+    assert scheduled_rate(schedule, 7, at(23, 59)) is None  # 跨过午夜的时段排在后面，先匹配到的是 22:00-06:00
+    assert scheduled_rate(schedule, 7, at(5, 59)) is None
+    assert scheduled_rate(schedule, 7, at(6, 0)) == 7
+    assert scheduled_rate([], 7, at(12, 0)) == 7
+
+
+def test_pace_size():
+    assert pace_size([RateLimiter(None)], 1048576) == 1048576
+    assert pace_size([RateLimiter(1048576), RateLimiter(None)], 1048576) == 104857
+    assert pace_size([RateLimiter(1024)], 1048576) == 16384
+
+
+def test_rate_limiter_reserve():
+    # 每次预约等到这份额度发送完为止，空闲之后前 burst 秒的额度不需要等待
+    limiter = RateLimiter(lambda: 1048576, burst=0.25)
+    assert limiter.reserve(262144) == 0
+    assert limiter.reserve(1048576) == pytest.approx(1, abs=0.05)
+    assert limiter.reserve(524288) == pytest.approx(1.5, abs=0.05)
+    assert RateLimiter(0).reserve(1 << 30) == 0
@@ -0,0 +1,85 @@
+import json
+import os
+
+import pytest
+
+from engine import FileTransferSignals, ParallelFileReceiver, valid_ranges
+
+SIZE = 1048576
+
+
+@pytest.fixture
+def data():
+    return os.urandom(SIZE)
+
+
+def receiver(tmp_path, ranges, resume=False):
+    path = str(tmp_path / "file.bin")
+    return ParallelFileReceiver("t1", path, SIZE, 'sha256', FileTransferSignals(), ranges=ranges,
+                                state_path=path + ".part.json", resume=resume)
+
+
+def test_resume_from_recorded_offsets(tmp_path, data):
+    half = SIZE // 2
+    first = receiver(tmp_path, [[0, half, 0], [half, SIZE - half, 0]])
+    first.write_at(0, data[:1000], 0)
+    first.write_at(half, data[half:half + 5000], 1)
+    first.abort(ConnectionError("连接已断开"))
+
+    # 中断后保留 .part 文件和续传记录，记录的是各区间已经落盘的长度
+    with open(first.part_path + ".json", encoding="utf-8") as f:
+        state = json.load(f)
+    assert state['file_size'] == SIZE and state['hash_algorithm'] == 'sha256'
+    ranges = valid_ranges(state['ranges'], SIZE)
+    assert ranges == [[0, half, 1000], [half, SIZE - half, 5000]]
+
+    second = receiver(tmp_path, ranges, resume=True)
+    assert second.bytes_received == 6000
+    for index, (offset, length, done) in enumerate(ranges):
+        second.write_at(offset + done, data[offset + done:offset + length], index)
+    second.close()
+    assert second.bytes_received == SIZE
+    with open(second.part_path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_new_receive_ignores_old_progress(tmp_path):
+    # 不续传时忽略传入的已完成长度，重新创建 .part 文件
+    first = receiver(tmp_path, [[0, SIZE, 500]])
+    assert first.ranges == [[0, SIZE, 0]] and first.bytes_received == 0
+    first.close()
+    assert os.path.getsize(first.part_path) == SIZE
+
+
+def test_resume_rejects_wrong_part_size(tmp_path):
+    (tmp_path / "file.bin.part").write_bytes(b"short")
+    with pytest.raises(ValueError):
+        receiver(tmp_path, [[0, SIZE, 10]], resume=True)
+
+
+def test_discard_removes_part_and_state(tmp_path):
+    first = receiver(tmp_path, [[0, SIZE, 0]])
+    first.close()
+    first.discard()
+    assert not os.path.exists(first.part_path)
+    assert not os.path.exists(first.part_path + ".json")
+
+
+def test_valid_ranges():
+    assert valid_ranges([[0, 10, 3], ["10", 5, 5]], 15) == [[0, 10, 3], [10, 5, 5]]
+
+
+@pytest.mark.parametrize('ranges', [
+    [],
+    [[0, 10, 0]],  # 没有覆盖整个文件
+    [[0, 10, 0], [12, 3, 0]],  # 区间之间有空隙
+    [[0, 10, 0], [8, 7, 0]],  # 区间重叠
+    [[0, 10, 11], [10, 5, 0]],  # 已完成的长度超出区间
+    [[0, 10, -1], [10, 5, 0]],
+    [[0, -5, 0], [-5, 20, 0]],
+    [[0, 15]],
+    [[0, "x", 0]],
+    None,
+])
+def test_valid_ranges_rejects_malformed(ranges):
+    assert valid_ranges(ranges, 15) is None
@@ -0,0 +1,206 @@
+class VirtualList:
+    """只把可见的行放进 ttk.Treeview 的文件列表
+
+    全部行保存在数据中，每行是 (排序键, 目录项)，排序键在加入时按列计算好；排序和筛选都在数据上进行，
+    表格中始终只有一屏的行，滚动时只更新这些行显示的内容，几十万个文件的目录也能立即打开。
+    选中状态同样记录在数据中，滚动后保持不变。
+    """
+
+    def __init__(self, tree, scrollbar, row_values, sort_keys, filter_column="name"):
+        self.tree = tree
+        self.scrollbar = scrollbar
+        self.row_values = row_values  # 目录项 -> 各列显示的值
+        self.sort_keys = sort_keys  # 目录项 -> 各列的排序键，顺序与表格的列相同
+        self.columns = list(tree['columns'])
+        self.filter_index = self.columns.index(filter_column)  # 按这一列筛选，该列的排序键须为小写字符串
+        self.headings = {column: tree.heading(column, 'text') for column in self.columns}
+        self.rows = []  # 全部行
+        self.view = []  # 筛选后按当前顺序排列的行
+        self.top = 0  # 第一个可见行在 view 中的位置
+        self.slots = []  # 表格中实际存在的行，依次显示 view[top:]
+        self.selected = set()  # 选中的行，按 id(行) 记录
+        self.sort_column = None
+        self.sort_reverse = False
+        self.filter_text = ""
+        self._render_pending = False
+
+        tree.configure(yscrollcommand=lambda first, last: None)  # 表格自身不再滚动
+        scrollbar.configure(command=self.yview)
+        tree.bind("<Configure>", lambda event: self.schedule_render())
+        tree.bind("<MouseWheel>", self.on_mouse_wheel)
+        tree.bind("<Button-4>", lambda event: self.scroll(-3))
+        tree.bind("<Button-5>", lambda event: self.scroll(3))
+        tree.bind("<Button-1>", self.on_click, add="+")
+        tree.bind("<<TreeviewSelect>>", self.on_select, add="+")
+        tree.bind("<Up>", lambda event: self.on_arrow(-1))
+        tree.bind("<Down>", lambda event: self.on_arrow(1))
+        tree.bind("<Prior>", lambda event: self.scroll(-max(1, len(self.slots) - 1)))
+        tree.bind("<Next>", lambda event: self.scroll(max(1, len(self.slots) - 1)))
+        tree.bind("<Home>", lambda event: self.scroll(-len(self.view)))
+        tree.bind("<End>", lambda event: self.scroll(len(self.view)))
+
+    def set_entries(self, entries):
+        """替换全部目录项，回到列表开头"""
+        self.rows = [(self.sort_keys(entry), entry) for entry in entries]
+        self.selected.clear()
+        self.top = 0
+        self._rebuild_view()
+
+    def append_entries(self, entries):
+        """追加目录项，保持当前的排序、筛选和滚动位置"""
+        rows = [(self.sort_keys(entry), entry) for entry in entries]
+        self.rows.extend(rows)
+        self.view.extend(row for row in rows if self._matches(row))
+        self._sort_view()
+        self.render()
+
+    def clear(self):
+        self.set_entries([])
+
+    def entries(self):
+        """筛选后按当前顺序排列的目录项"""
+        return [row[1] for row in self.view]
+
+    def selected_entries(self):
+        """选中的目录项，按当前显示顺序排列"""
+        return [row[1] for row in self.view if id(row) in self.selected]
+
+    def entry_at(self, y):
+        """返回表格中纵坐标 y 处显示的目录项，没有时返回 None"""
+        slot = self.tree.identify_row(y)
+        if slot not in self.slots:
+            return None
+        return self.view[self.top + self.slots.index(slot)][1]
+
+    def sort_by(self, column):
+        """按列排序，再次点击同一列时反向排序"""
+        if column == self.sort_column:
+            self.sort_reverse = not self.sort_reverse
+        else:
+            self.sort_column = column
+            self.sort_reverse = False
+        for name, text in self.headings.items():
+            if name == column:
+                text += " ▼" if self.sort_reverse else " ▲"
+            self.tree.heading(name, text=text)
+        self._sort_view()
+        self.render()
+
+    def set_filter(self, text):
+        """只显示筛选列包含 text 的行，不区分大小写"""
+        text = text.strip().casefold()
+        if text == self.filter_text:
+            return
+        self.filter_text = text
+        self.top = 0
+        self._rebuild_view()
+
+    def _matches(self, row):
+        return not self.filter_text or self.filter_text in row[0][self.filter_index]
+
+    def _rebuild_view(self):
+        self.view = [row for row in self.rows if self._matches(row)] if self.filter_text else list(self.rows)
+        self._sort_view()
+        self.render()
+
+    def _sort_view(self):
+        if self.sort_column is not None:
+            index = self.columns.index(self.sort_column)
+            self.view.sort(key=lambda row: row[0][index], reverse=self.sort_reverse)
+
+    def _visible_count(self):
+        """表格能完整显示的行数，由第一行的位置和高度推算"""
+        height = self.tree.winfo_height()
+        if height <= 1 or not self.slots:
+            return int(self.tree['height'])
+        bbox = self.tree.bbox(self.slots[0])
+        if not bbox:
+            # 表格还没有绘制，之后的 <Configure> 会重新计算
+            return max(len(self.slots), int(self.tree['height']))
+        _, y, _, row_height = bbox
+        return max(1, (height - y) // max(1, row_height))
+
+    def schedule_render(self):
+        # 窗口大小连续变化时只重新填充一次
+        if not self._render_pending:
+            self._render_pending = True
+            self.tree.after_idle(self.render)
+
+    def render(self):
+        """按滚动位置更新表格中的行"""
+        self._render_pending = False
+        if not self.slots and self.view:
+            # 先放入一行，用于测量行高
+            self.slots.append(self.tree.insert("", "end"))
+        count = min(self._visible_count(), len(self.view))
+        self.top = max(0, min(self.top, len(self.view) - count))
+        while len(self.slots) < count:
+            self.slots.append(self.tree.insert("", "end"))
+        if len(self.slots) > count:
+            self.tree.delete(*self.slots[count:])
+            del self.slots[count:]
+
+        selection = []
+        for slot, row in zip(self.slots, self.view[self.top:self.top + count]):
+            self.tree.item(slot, values=self.row_values(row[1]))
+            if id(row) in self.selected:
+                selection.append(slot)
+        self.tree.selection_set(selection)
+
+        if self.view:
+            self.scrollbar.set(self.top / len(self.view), (self.top + count) / len(self.view))
+        else:
+            self.scrollbar.set(0, 1)
+
+    def scroll(self, rows):
+        self.top += rows
+        self.render()
+        return "break"
+
+    def yview(self, *args):
+        """滚动条的回调：('moveto', 比例) 或 ('scroll', 数量, 'units'/'pages')"""
+        if not args:
+            return
+        if args[0] == 'moveto':
+            self.top = int(float(args[1]) * len(self.view))
+            self.render()
+        elif args[0] == 'scroll':
+            step = int(args[1])
+            if args[2] == 'pages':
+                step *= max(1, len(self.slots) - 1)
+            self.scroll(step)
+
+    def on_mouse_wheel(self, event):
+        # Windows 每格 120，macOS 为较小的整数
+        delta = event.delta // 120 if abs(event.delta) >= 120 else event.delta
+        return self.scroll(-3 * delta)
+
+    def on_click(self, event):
+        # 不按 Shift 或 Ctrl 单击时，屏幕外选中的行也取消选中
+        if not event.state & 0x0005:
+            self.selected.clear()
+
+    def on_select(self, event=None):
+        """把表格中可见行的选中状态同步到数据"""
+        selection = set(self.tree.selection())
+        for slot, row in zip(self.slots, self.view[self.top:self.top + len(self.slots)]):
+            if slot in selection:
+                self.selected.add(id(row))
+            else:
+                self.selected.discard(id(row))
+
+    def on_arrow(self, step):
+        """在第一行按上或最后一行按下时滚动列表，并选中新出现的行"""
+        if not self.slots:
+            return None
+        focus = self.tree.focus()
+        edge = self.slots[0] if step < 0 else self.slots[-1]
+        if focus != edge:
+            return None  # 可见范围内的移动由表格自己处理
+        index = self.top + self.slots.index(edge) + step
+        if not 0 <= index < len(self.view):
+            return "break"
+        self.selected = {id(self.view[index])}
+        self.scroll(step)
+        self.tree.focus(edge)
+        return "break"